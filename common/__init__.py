@@ -0,0 +1 @@
+"""Modules shared by the pet_store and pet_order services."""
@@ -0,0 +1,189 @@
+"""Admission control: rate limits, concurrency limits and priorities.
+
+Every request is put in a priority class (read, purchase, write, import;
+earlier classes win). A class may only hold its share of MAX_CONCURRENCY
+slots, and single routes can be capped further with ROUTE_LIMITS
+("endpoint=limit,..."). A request that finds no slot waits up to
+ADMISSION_QUEUE_SECONDS behind any request of a higher class that waits for
+the global or class capacity (not just for its own route's cap), and is
+refused with 503 after that or when its class queue is full. Each client
+also has a token bucket of RATE_LIMIT_PER_SECOND / RATE_LIMIT_BURST; an
+empty bucket is a 429. Both refusals carry Retry-After. Clients are told
+apart by their address, never by anything they send, and at most
+MAX_BUCKETS buckets are kept, least recently used first out.
+
+Calls between the services carry X-Service-Token; when it matches
+SERVICE_TOKEN they skip the rate limit, so pet_order's store calls do not
+share one bucket with each other or with its own clients.
+"""
+import hmac
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import g, jsonify, request
+
+PRIORITIES = ["read", "purchase", "write", "import"]
+
+MAX_CONCURRENCY = int(os.environ.get('MAX_CONCURRENCY', 64))
+# share of MAX_CONCURRENCY each class may hold
+CLASS_SHARES = {"read": 1.0, "purchase": 1.0, "write": 0.5, "import": 0.25}
+ADMISSION_QUEUE_SECONDS = float(os.environ.get('ADMISSION_QUEUE_SECONDS', 2))
+ADMISSION_QUEUE_LENGTH = int(os.environ.get('ADMISSION_QUEUE_LENGTH', 128))
+RATE_LIMIT_PER_SECOND = float(os.environ.get('RATE_LIMIT_PER_SECOND', 100))  # 0 disables
+RATE_LIMIT_BURST = float(os.environ.get('RATE_LIMIT_BURST', 200))
+MAX_BUCKETS = 10000
+SERVICE_TOKEN = os.environ.get('SERVICE_TOKEN', '')  # empty: no caller skips the rate limit
+
+
+def parse_route_limits(spec):
+    limits = {}
+    for item in spec.split(','):
+        if '=' in item:
+            endpoint, limit = item.split('=', 1)
+            limits[endpoint.strip()] = int(limit)
+    return limits
+
+
+ROUTE_LIMITS = parse_route_limits(os.environ.get('ROUTE_LIMITS', ''))
+
+_cond = threading.Condition()
+_in_flight = {"total": 0}
+# requests queued per class, and those of them held back by the global or
+# class capacity (a request waiting only on its own route's cap does not make
+# lower classes wait)
+_queued = {p: 0 for p in PRIORITIES}
+_waiting = {p: 0 for p in PRIORITIES}
+_buckets = OrderedDict()
+_stats = {"admitted": 0, "rate_limited": 0, "shed": 0}
+
+
+def class_limit(priority):
+    return max(1, int(MAX_CONCURRENCY * CLASS_SHARES[priority]))
+
+
+def _route_full(endpoint):
+    return endpoint in ROUTE_LIMITS and _in_flight.get(("route", endpoint), 0) >= ROUTE_LIMITS[endpoint]
+
+
+def _has_slot(priority, endpoint):
+    if _in_flight["total"] >= MAX_CONCURRENCY:
+        return False
+    if _in_flight.get(priority, 0) >= class_limit(priority):
+        return False
+    if _route_full(endpoint):
+        return False
+    # higher classes waiting for capacity go first
+    return not any(_waiting[p] for p in PRIORITIES[:PRIORITIES.index(priority)])
+
+
+def _take_token(client):
+    # returns 0 when a token was taken, else seconds until the next one
+    now = time.monotonic()
+    with _cond:
+        tokens, last = _buckets.pop(client, (RATE_LIMIT_BURST, now))
+        tokens = min(RATE_LIMIT_BURST, tokens + (now - last) * RATE_LIMIT_PER_SECOND)
+        taken = tokens >= 1
+        _buckets[client] = (tokens - 1 if taken else tokens, now)
+        while len(_buckets) > MAX_BUCKETS:
+            _buckets.popitem(last=False)
+        return 0 if taken else (1 - tokens) / RATE_LIMIT_PER_SECOND
+
+
+def is_service_request():
+    token = request.headers.get("X-Service-Token")
+    return bool(SERVICE_TOKEN) and token is not None and hmac.compare_digest(token, SERVICE_TOKEN)
+
+
+def _acquire(priority, endpoint):
+    deadline = time.monotonic() + ADMISSION_QUEUE_SECONDS
+    with _cond:
+        if not _has_slot(priority, endpoint):
+            if _queued[priority] >= ADMISSION_QUEUE_LENGTH:
+                return False
+            _queued[priority] += 1
+            counted = False
+            try:
+                while not _has_slot(priority, endpoint):
+                    route_full = _route_full(endpoint)
+                    if counted and route_full:
+                        _waiting[priority] -= 1
+                        counted = False
+                        _cond.notify_all()
+                    elif not counted and not route_full:
+                        _waiting[priority] += 1
+                        counted = True
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    _cond.wait(remaining)
+            finally:
+                _queued[priority] -= 1
+                if counted:
+                    _waiting[priority] -= 1
+                    _cond.notify_all()
+        _in_flight["total"] += 1
+        _in_flight[priority] = _in_flight.get(priority, 0) + 1
+        _in_flight[("route", endpoint)] = _in_flight.get(("route", endpoint), 0) + 1
+        return True
+
+
+def _release(priority, endpoint):
+    with _cond:
+        _in_flight["total"] -= 1
+        _in_flight[priority] -= 1
+        _in_flight[("route", endpoint)] -= 1
+        _cond.notify_all()
+
+
+def _refuse(status, message, retry_after):
+    resp = jsonify({"error": message})
+    resp.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return resp, status
+
+
+def install(app, endpoint_classes, exempt=()):
+    """Register the admission hooks.
+
+    endpoint_classes maps endpoint names to a priority class (others are
+    "read" for GET and "write" otherwise). Endpoints in exempt (health
+    probes) are never limited.
+    """
+    @app.before_request
+    def admit():
+        endpoint = request.endpoint
+        if endpoint is None or endpoint in exempt:
+            return None  # unknown routes are left to Flask's 404/405
+
+        if RATE_LIMIT_PER_SECOND > 0 and not is_service_request():
+            wait_for = _take_token(request.remote_addr)
+            if wait_for:
+                with _cond:
+                    _stats["rate_limited"] += 1
+                return _refuse(429, "Too many requests", wait_for)
+
+        priority = endpoint_classes.get(endpoint) or ("read" if request.method == "GET" else "write")
+        if not _acquire(priority, endpoint):
+            with _cond:
+                _stats["shed"] += 1
+            return _refuse(503, "Server busy", 1)
+
+        with _cond:
+            _stats["admitted"] += 1
+        g.admission = (priority, endpoint)
+        return None
+
+    @app.teardown_request
+    def release(exc):
+        admitted = g.pop("admission", None)
+        if admitted is not None:
+            _release(*admitted)
+
+
+def stats():
+    with _cond:
+        return dict(_stats,
+                    in_flight=_in_flight["total"],
+                    waiting={p: n for p, n in _queued.items() if n})
@@ -0,0 +1,115 @@
+"""Response encoding: a faster JSON provider, negotiated compression and
+pre-encoded cached responses.
+
+Compression is negotiated from Accept-Encoding. gzip is always available;
+brotli and zstd are used when the `brotli` / `zstandard` packages are
+installed, and orjson replaces the stdlib encoder when it is installed.
+"""
+import gzip
+import os
+
+from flask import request
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# responses smaller than this are not worth compressing
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', 1024))
+# "auto" picks orjson when installed, "std" forces the stdlib encoder
+JSON_ENCODER = os.environ.get('JSON_ENCODER', 'auto')
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 256))
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        if "indent" in kwargs:
+            # pretty printing (debug mode) stays on the stdlib encoder
+            return super().dumps(obj, **kwargs)
+        option = orjson.OPT_SORT_KEYS if kwargs.get("sort_keys", self.sort_keys) else 0
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+
+def _compressors():
+    # preferred first when the client weights encodings equally
+    out = {}
+    if zstandard is not None:
+        out["zstd"] = lambda data: zstandard.ZstdCompressor(level=3).compress(data)
+    if brotli is not None:
+        out["br"] = lambda data: brotli.compress(data, quality=5)
+    out["gzip"] = lambda data: gzip.compress(data, compresslevel=6)
+    return out
+
+
+COMPRESSORS = _compressors()
+
+
+def negotiate_encoding():
+    # best of our encodings by the client's q-values, or None for identity
+    return request.accept_encodings.best_match(list(COMPRESSORS))
+
+
+def encode_response(response):
+    # after_request hook: compress JSON bodies the client accepts
+    if (response.direct_passthrough
+            or response.status_code < 200 or response.status_code >= 300
+            or response.mimetype != "application/json"
+            or "Content-Encoding" in response.headers):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate_encoding()
+    data = response.get_data()
+    if encoding is None or len(data) < COMPRESS_MIN_BYTES:
+        return response
+
+    response.set_data(COMPRESSORS[encoding](data))
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def cached_json_response(app, cache, key, build):
+    """200 JSON response for key, serialized and compressed at most once.
+
+    cache is a plain dict owned by the caller; replacing it with a new dict
+    invalidates everything. A build that was running before the replacement
+    stores into the old dict and is never seen again, as long as build()
+    does not share work with builds started before the replacement (e.g. a
+    singleflight key must change along with the dict).
+    """
+    entry = cache.get(key)
+    if entry is None:
+        body = app.json.dumps(build(), separators=(",", ":")).encode() + b"\n"
+        entry = {"body": body, "encoded": {}}
+        if len(cache) >= RESPONSE_CACHE_MAX_ENTRIES:
+            cache.clear()
+        cache[key] = entry
+
+    response = app.response_class(entry["body"], mimetype="application/json")
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate_encoding()
+    if encoding is not None and len(entry["body"]) >= COMPRESS_MIN_BYTES:
+        encoded = entry["encoded"].get(encoding)
+        if encoded is None:
+            encoded = entry["encoded"][encoding] = COMPRESSORS[encoding](entry["body"])
+        response.set_data(encoded)
+        response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def install(app):
+    if orjson is not None and JSON_ENCODER != "std":
+        app.json = OrjsonProvider(app)
+    app.after_request(encode_response)
@@ -0,0 +1,46 @@
+"""Liveness and readiness probes.
+
+Startup work (migrations, warming caches) runs in a background thread and
+Mongo is pinged every READY_PING_SECONDS, so the probes only read flags:
+/healthz answers as long as the process serves requests, /readyz only once
+Mongo answers and the service has set its "migrated" and "warm" flags.
+"""
+import os
+import threading
+import time
+
+from flask import jsonify
+
+READY_PING_SECONDS = float(os.environ.get('READY_PING_SECONDS', 5))
+
+
+def install(app):
+    """Register /healthz and /readyz; returns the flags /readyz reports."""
+    readiness = {"mongo": False, "migrated": False, "warm": False}
+
+    @app.route('/healthz', methods=['GET'])
+    def healthz():
+        return jsonify({"status": "ok"}), 200
+
+    @app.route('/readyz', methods=['GET'])
+    def readyz():
+        status = 200 if all(readiness.values()) else 503
+        return jsonify(readiness), status
+
+    return readiness
+
+
+def ping_loop(mongo_client, readiness):
+    while True:
+        try:
+            mongo_client.admin.command("ping")
+            readiness["mongo"] = True
+        except Exception:
+            readiness["mongo"] = False
+        time.sleep(READY_PING_SECONDS)
+
+
+def start(mongo_client, readiness, initialize):
+    # initialize does the service's startup work and sets its flags
+    threading.Thread(target=initialize, name="initialize", daemon=True).start()
+    threading.Thread(target=ping_loop, args=(mongo_client, readiness), name="ping_loop", daemon=True).start()
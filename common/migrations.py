@@ -0,0 +1,47 @@
+"""Index provisioning and data migrations, run for each service's database.
+
+Each service lists its own in <service>/migrations.py: INDEXES maps a
+collection to a list of (keys, options), and MIGRATIONS is a list of
+(version, name, function), append only and never reordered. A migration gets
+the database and returns the number of documents it changed.
+
+Everything here is idempotent - indexes that already exist are left alone and
+each migration is recorded in the `schema_migrations` collection once applied.
+"""
+from datetime import datetime
+
+
+def apply_migrations(db, migrations):
+    applied = []
+    done = {m["_id"] for m in db["schema_migrations"].find({}, {"_id": 1})}
+    for version, name, fn in sorted(migrations, key=lambda m: m[0]):
+        if version in done:
+            continue
+        changed = fn(db)
+        db["schema_migrations"].insert_one({
+            "_id": version,
+            "name": name,
+            "changed": changed,
+            "applied_at": datetime.utcnow()
+        })
+        applied.append({"version": version, "name": name, "changed": changed})
+    return applied
+
+
+def ensure_indexes(db, indexes):
+    created = []
+    for coll_name, specs in indexes.items():
+        existing = db[coll_name].index_information()
+        for keys, options in specs:
+            if options["name"] in existing:
+                continue
+            db[coll_name].create_index(keys, **options)
+            created.append(f"{coll_name}.{options['name']}")
+    return created
+
+
+def run(db, migrations, indexes):
+    # migrations go first so unique indexes are built over backfilled fields
+    report = {"migrations_applied": apply_migrations(db, migrations)}
+    report["indexes_created"] = ensure_indexes(db, indexes)
+    return report
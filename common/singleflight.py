@@ -0,0 +1,51 @@
+"""Single-flight coalescing of identical concurrent calls.
+
+While a call for a key is in flight, further calls for the same key wait for
+it and share its result (or exception) instead of running it again. Nothing
+is cached once the call returns.
+"""
+import threading
+
+_lock = threading.Lock()
+_in_flight = {}
+_stats = {"calls": 0, "executions": 0, "coalesced": 0}
+
+
+def do(key, fn):
+    """Run fn() once for all concurrent callers with the same key.
+
+    Returns (result, shared) where shared is True for callers that waited on
+    another caller's execution.
+    """
+    with _lock:
+        _stats["calls"] += 1
+        call = _in_flight.get(key)
+        leader = call is None
+        if leader:
+            _stats["executions"] += 1
+            call = {"done": threading.Event(), "result": None, "error": None}
+            _in_flight[key] = call
+        else:
+            _stats["coalesced"] += 1
+
+    if not leader:
+        call["done"].wait()
+        if call["error"] is not None:
+            raise call["error"]
+        return call["result"], True
+
+    try:
+        call["result"] = fn()
+    except Exception as e:
+        call["error"] = e
+        raise
+    finally:
+        with _lock:
+            _in_flight.pop(key, None)
+        call["done"].set()
+    return call["result"], False
+
+
+def stats():
+    with _lock:
+        return dict(_stats, in_flight=len(_in_flight))
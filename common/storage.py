@@ -0,0 +1,662 @@
+"""Storage backends.
+
+The services talk to their data through pymongo-style clients, databases and
+collections. STORAGE_BACKEND selects where that goes:
+
+* "mongo" (default) - a real MongoClient for MONGO_URI.
+* "memory" - an in-process engine implementing the part of the pymongo API
+  the services use, with the same matching, update, projection and unique
+  index semantics. Equality lookups on indexed fields are served from hash
+  indexes instead of scans. Data lives only as long as the process, which
+  makes it suited to tests and load benchmarks that should not depend on a
+  running Mongo.
+"""
+import copy
+import itertools
+import os
+import re
+import threading
+import time
+from datetime import datetime
+
+from bson import ObjectId
+import pymongo
+from pymongo import MongoClient
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'mongo')
+
+
+def connect(uri):
+    if STORAGE_BACKEND == 'memory':
+        return MemoryClient()
+    # connect=False keeps import cheap, the pool is opened on first use
+    return MongoClient(uri, connect=False)
+
+
+class UpdateOne(pymongo.UpdateOne):
+    """pymongo's UpdateOne, with its arguments readable by the memory engine.
+
+    Use this one for bulk_write so both backends accept the same requests.
+    """
+
+    def __init__(self, filter, update, upsert=False):
+        super().__init__(filter, update, upsert=upsert)
+        self.filter = filter
+        self.update = update
+        self.upsert = upsert
+
+
+# -- query matching --
+
+_MISSING = object()
+
+
+def _get(doc, path):
+    value = doc
+    for part in path.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+
+def _set(doc, path, value):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+
+def _is_operator_dict(cond):
+    return isinstance(cond, dict) and cond and all(k.startswith('$') for k in cond)
+
+
+def _equals(value, target):
+    if value is _MISSING:
+        return target is None
+    if value == target:
+        return True
+    return isinstance(value, list) and not isinstance(target, list) and target in value
+
+
+def _compare(value, target, op):
+    values = value if isinstance(value, list) else [value]
+    for v in values:
+        try:
+            if op(v, target):
+                return True
+        except TypeError:
+            continue
+    return False
+
+
+def _match_operator(value, op, arg, cond):
+    if op == '$eq':
+        return _equals(value, arg)
+    if op == '$ne':
+        return not _equals(value, arg)
+    if op == '$in':
+        return any(_equals(value, a) for a in arg)
+    if op == '$nin':
+        return not any(_equals(value, a) for a in arg)
+    if op == '$all':
+        return isinstance(value, list) and all(a in value for a in arg)
+    if op == '$exists':
+        return (value is not _MISSING) == bool(arg)
+    if op == '$size':
+        return isinstance(value, list) and len(value) == arg
+    if op == '$gt':
+        return value is not _MISSING and _compare(value, arg, lambda a, b: a > b)
+    if op == '$gte':
+        return value is not _MISSING and _compare(value, arg, lambda a, b: a >= b)
+    if op == '$lt':
+        return value is not _MISSING and _compare(value, arg, lambda a, b: a < b)
+    if op == '$lte':
+        return value is not _MISSING and _compare(value, arg, lambda a, b: a <= b)
+    if op == '$regex':
+        flags = re.IGNORECASE if 'i' in cond.get('$options', '') else 0
+        values = value if isinstance(value, list) else [value]
+        return any(isinstance(v, str) and re.search(arg, v, flags) for v in values)
+    if op == '$options':
+        return True
+    if op == '$not':
+        return not _match_value(value, arg)
+    raise NotImplementedError(f"query operator {op}")
+
+
+def _match_value(value, cond):
+    if _is_operator_dict(cond):
+        return all(_match_operator(value, op, arg, cond) for op, arg in cond.items())
+    return _equals(value, cond)
+
+
+def _match(doc, filt):
+    for key, cond in (filt or {}).items():
+        if key == '$or':
+            if not any(_match(doc, f) for f in cond):
+                return False
+        elif key == '$and':
+            if not all(_match(doc, f) for f in cond):
+                return False
+        elif not _match_value(_get(doc, key), cond):
+            return False
+    return True
+
+
+def _project(doc, projection):
+    doc = copy.deepcopy(doc)
+    if not projection:
+        return doc
+    if isinstance(projection, (list, tuple)):
+        projection = {f: 1 for f in projection}
+    include = [f for f, on in projection.items() if on and f != '_id']
+    if include:
+        out = {f: doc[f] for f in include if f in doc}
+        if projection.get('_id', 1) and '_id' in doc:
+            out['_id'] = doc['_id']
+        return out
+    for f, on in projection.items():
+        if not on:
+            doc.pop(f, None)
+    return doc
+
+
+def _sort_key(spec):
+    def key(doc):
+        out = []
+        for field, direction in spec:
+            value = _get(doc, field)
+            # missing and None sort first, then by type name so mixed types do not raise
+            rank = (0, '', None) if value in (_MISSING, None) else (1, type(value).__name__, value)
+            out.append(_Reversed(rank) if direction < 0 else rank)
+        return out
+    return key
+
+
+class _Reversed:
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+# -- updates --
+
+def _positional_index(doc, field, filt):
+    # index of the first array element matched by the filter's condition on field
+    cond = (filt or {}).get(field)
+    for i, element in enumerate(doc.get(field, [])):
+        if cond is None or _match_value(element, cond):
+            return i
+    return None
+
+
+def _apply_update(doc, update, filt, inserting):
+    for op, fields in update.items():
+        if op == '$setOnInsert':
+            if inserting:
+                for path, value in fields.items():
+                    _set(doc, path, copy.deepcopy(value))
+        elif op == '$set':
+            for path, value in fields.items():
+                if path.endswith('.$'):
+                    field = path[:-2]
+                    i = _positional_index(doc, field, filt)
+                    if i is not None:
+                        doc[field][i] = copy.deepcopy(value)
+                else:
+                    _set(doc, path, copy.deepcopy(value))
+        elif op == '$unset':
+            for path in fields:
+                doc.pop(path, None)
+        elif op == '$inc':
+            for path, value in fields.items():
+                current = _get(doc, path)
+                _set(doc, path, (0 if current is _MISSING else current) + value)
+        elif op == '$push':
+            for path, value in fields.items():
+                current = _get(doc, path)
+                values = value['$each'] if isinstance(value, dict) and '$each' in value else [value]
+                _set(doc, path, (list(current) if current is not _MISSING else []) + copy.deepcopy(values))
+        elif op == '$pull':
+            for path, cond in fields.items():
+                current = _get(doc, path)
+                if isinstance(current, list):
+                    _set(doc, path, [e for e in current if not _match_value(e, cond)])
+        else:
+            raise NotImplementedError(f"update operator {op}")
+
+
+def _upsert_seed(filt):
+    # equality parts of the filter become fields of an upserted document
+    doc = {}
+    for key, cond in (filt or {}).items():
+        if not key.startswith('$') and not _is_operator_dict(cond):
+            _set(doc, key, copy.deepcopy(cond))
+    return doc
+
+
+# -- results --
+
+class _Result:
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+        self.acknowledged = True
+
+
+# -- collections --
+
+class MemoryCursor:
+    def __init__(self, collection, filt, projection):
+        self._collection = collection
+        self._filter = filt
+        self._projection = projection
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key, direction=1):
+        self._sort = key if isinstance(key, list) else [(key, direction)]
+        return self
+
+    def skip(self, n):
+        self._skip = n
+        return self
+
+    def limit(self, n):
+        self._limit = n
+        return self
+
+    def __iter__(self):
+        docs = self._collection._select(self._filter)
+        if self._sort:
+            docs.sort(key=_sort_key(self._sort))
+        docs = docs[self._skip:]
+        if self._limit:
+            docs = docs[:self._limit]
+        return iter([_project(d, self._projection) for d in docs])
+
+
+class MemoryCollection:
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self._lock = database.client._lock
+        self._docs = {}  # _id -> document, in insertion order
+        self._order = {}  # _id -> insertion sequence
+        self._seq = itertools.count()
+        # index name -> {"keys", "unique", "ttl", "map": key tuple -> set of _ids}
+        self._indexes = {}
+        self._last_expiry = 0.0
+
+    # - indexes -
+
+    def _index_keys(self, index, doc):
+        fields = [f for f, _ in index["keys"]]
+        values = []
+        for f in fields:
+            v = _get(doc, f)
+            v = None if v is _MISSING else v
+            values.append(v if isinstance(v, list) and v else [v])
+        # a multikey index has one entry per array element
+        return {tuple(_hashable(v) for v in combo) for combo in itertools.product(*values)}
+
+    def _check_unique(self, doc, ignore_id=None):
+        if doc['_id'] in self._docs and doc['_id'] != ignore_id:
+            raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: _id_")
+        for name, index in self._indexes.items():
+            if not index["unique"]:
+                continue
+            for key in self._index_keys(index, doc):
+                if index["map"].get(key, set()) - {ignore_id}:
+                    raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {name}")
+
+    def _index_add(self, doc):
+        for index in self._indexes.values():
+            for key in self._index_keys(index, doc):
+                index["map"].setdefault(key, set()).add(doc['_id'])
+
+    def _index_remove(self, doc):
+        for index in self._indexes.values():
+            for key in self._index_keys(index, doc):
+                ids = index["map"].get(key)
+                if ids is not None:
+                    ids.discard(doc['_id'])
+                    if not ids:
+                        del index["map"][key]
+
+    def _candidates(self, filt):
+        # _ids that may match, from an index when the filter pins its fields
+        filt = filt or {}
+        if '_id' in filt and not _is_operator_dict(filt['_id']):
+            return [filt['_id']] if filt['_id'] in self._docs else []
+        for index in self._indexes.values():
+            fields = [f for f, _ in index["keys"]]
+            choices = []
+            for f in fields:
+                cond = filt.get(f, _MISSING)
+                if cond is _MISSING or isinstance(cond, list):
+                    break
+                if _is_operator_dict(cond):
+                    if set(cond) == {'$in'}:
+                        choices.append(cond['$in'])
+                    elif set(cond) == {'$all'} and len(fields) == 1 and cond['$all']:
+                        choices.append(cond['$all'][:1])
+                    else:
+                        break
+                else:
+                    choices.append([cond])
+            else:
+                ids = set()
+                for combo in itertools.product(*choices):
+                    ids |= index["map"].get(tuple(_hashable(v) for v in combo), set())
+                return sorted(ids, key=self._order.__getitem__)
+        return list(self._docs)
+
+    def _expire(self):
+        now = time.monotonic()
+        if now - self._last_expiry < 1:
+            return
+        self._last_expiry = now
+        for index in self._indexes.values():
+            if index["ttl"] is None:
+                continue
+            field = index["keys"][0][0]
+            cutoff = datetime.utcnow().timestamp() - index["ttl"]
+            for doc in list(self._docs.values()):
+                value = _get(doc, field)
+                if isinstance(value, datetime) and value.timestamp() < cutoff:
+                    self._remove(doc)
+
+    def _select(self, filt):
+        with self._lock:
+            self._expire()
+            return [self._docs[i] for i in self._candidates(filt) if _match(self._docs[i], filt)]
+
+    def _insert(self, doc):
+        if '_id' not in doc:
+            doc['_id'] = ObjectId()
+        stored = copy.deepcopy(doc)
+        self._check_unique(stored)
+        self._docs[stored['_id']] = stored
+        self._order[stored['_id']] = next(self._seq)
+        self._index_add(stored)
+        return stored['_id']
+
+    def _remove(self, doc):
+        self._index_remove(doc)
+        del self._docs[doc['_id']]
+        del self._order[doc['_id']]
+
+    def _update_doc(self, doc, update, filt):
+        new = copy.deepcopy(doc)
+        _apply_update(new, update, filt, inserting=False)
+        self._check_unique(new, ignore_id=doc['_id'])
+        self._index_remove(doc)
+        self._docs[doc['_id']] = new
+        self._index_add(new)
+        return new
+
+    def _upsert(self, filt, update):
+        doc = _upsert_seed(filt)
+        _apply_update(doc, update, filt, inserting=True)
+        self._insert(doc)
+        return self._docs[doc['_id']]
+
+    # - public API -
+
+    def create_index(self, keys, name=None, unique=False, expireAfterSeconds=None, **kwargs):
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        name = name or '_'.join(f"{f}_{d}" for f, d in keys)
+        with self._lock:
+            if name in self._indexes:
+                return name
+            index = {"keys": list(keys), "unique": unique, "ttl": expireAfterSeconds, "map": {}}
+            self._indexes[name] = index
+            try:
+                for doc in self._docs.values():
+                    if unique:
+                        for key in self._index_keys(index, doc):
+                            if index["map"].get(key):
+                                raise DuplicateKeyError(f"E11000 duplicate key error index: {name}")
+                    for key in self._index_keys(index, doc):
+                        index["map"].setdefault(key, set()).add(doc['_id'])
+            except DuplicateKeyError:
+                del self._indexes[name]
+                raise
+        return name
+
+    def index_information(self):
+        with self._lock:
+            info = {"_id_": {"key": [("_id", 1)]}}
+            for name, index in self._indexes.items():
+                info[name] = {"key": list(index["keys"])}
+                if index["unique"]:
+                    info[name]["unique"] = True
+                if index["ttl"] is not None:
+                    info[name]["expireAfterSeconds"] = index["ttl"]
+            return info
+
+    def find(self, filter=None, projection=None, sort=None, limit=0):
+        cursor = MemoryCursor(self, filter, projection)
+        if sort:
+            cursor.sort(sort)
+        if limit:
+            cursor.limit(limit)
+        return cursor
+
+    def find_one(self, filter=None, projection=None, sort=None):
+        for doc in self.find(filter, projection, sort=sort, limit=1):
+            return doc
+        return None
+
+    def count_documents(self, filter):
+        return len(self._select(filter))
+
+    def distinct(self, key, filter=None):
+        out = []
+        for doc in self._select(filter):
+            value = _get(doc, key)
+            for v in (value if isinstance(value, list) else [value]):
+                if v is not _MISSING and v not in out:
+                    out.append(v)
+        return out
+
+    def insert_one(self, document):
+        with self._lock:
+            return _Result(inserted_id=self._insert(document))
+
+    def insert_many(self, documents, ordered=True):
+        # like pymongo, duplicates are reported in one BulkWriteError; unordered
+        # inserts carry on past them
+        ids = []
+        errors = []
+        with self._lock:
+            for n, doc in enumerate(documents):
+                try:
+                    ids.append(self._insert(doc))
+                except DuplicateKeyError as e:
+                    errors.append({"index": n, "code": 11000, "errmsg": str(e)})
+                    if ordered:
+                        break
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "nInserted": len(ids)})
+        return _Result(inserted_ids=ids)
+
+    def update_one(self, filter, update, upsert=False):
+        with self._lock:
+            docs = self._select(filter)
+            if docs:
+                self._update_doc(docs[0], update, filter)
+                return _Result(matched_count=1, modified_count=1, upserted_id=None)
+            if upsert:
+                return _Result(matched_count=0, modified_count=0, upserted_id=self._upsert(filter, update)['_id'])
+            return _Result(matched_count=0, modified_count=0, upserted_id=None)
+
+    def update_many(self, filter, update, upsert=False):
+        with self._lock:
+            docs = self._select(filter)
+            for doc in docs:
+                self._update_doc(doc, update, filter)
+            if not docs and upsert:
+                return _Result(matched_count=0, modified_count=0, upserted_id=self._upsert(filter, update)['_id'])
+            return _Result(matched_count=len(docs), modified_count=len(docs), upserted_id=None)
+
+    def find_one_and_update(self, filter, update, projection=None, sort=None, upsert=False,
+                            return_document=False):
+        with self._lock:
+            docs = self._select(filter)
+            if sort:
+                docs.sort(key=_sort_key(sort))
+            if docs:
+                after = self._update_doc(docs[0], update, filter)
+                return _project(after if return_document else docs[0], projection)
+            if upsert:
+                after = self._upsert(filter, update)
+                return _project(after, projection) if return_document else None
+            return None
+
+    def find_one_and_delete(self, filter, projection=None, sort=None):
+        with self._lock:
+            docs = self._select(filter)
+            if sort:
+                docs.sort(key=_sort_key(sort))
+            if not docs:
+                return None
+            self._remove(docs[0])
+            return _project(docs[0], projection)
+
+    def delete_one(self, filter):
+        with self._lock:
+            docs = self._select(filter)
+            if docs:
+                self._remove(docs[0])
+            return _Result(deleted_count=len(docs[:1]))
+
+    def delete_many(self, filter):
+        with self._lock:
+            docs = self._select(filter)
+            for doc in docs:
+                self._remove(doc)
+            return _Result(deleted_count=len(docs))
+
+    def bulk_write(self, requests, ordered=True):
+        matched = 0
+        with self._lock:
+            for op in requests:
+                if not isinstance(op, UpdateOne):
+                    raise TypeError("bulk_write takes storage.UpdateOne requests")
+                result = self.update_one(op.filter, op.update, upsert=op.upsert)
+                matched += result.matched_count
+        return _Result(matched_count=matched, modified_count=matched)
+
+    def aggregate(self, pipeline):
+        docs = [copy.deepcopy(d) for d in self._select({})]
+        for stage in pipeline:
+            (op, arg), = stage.items()
+            if op == '$match':
+                docs = [d for d in docs if _match(d, arg)]
+            elif op == '$unwind':
+                field = arg.lstrip('$')
+                unwound = []
+                for d in docs:
+                    for v in d.get(field) or []:
+                        unwound.append(dict(d, **{field: v}))
+                docs = unwound
+            elif op == '$group':
+                groups = {}
+                for d in docs:
+                    key = _hashable(_field_ref(d, arg['_id']))
+                    group = groups.setdefault(key, {"_id": _field_ref(d, arg['_id'])})
+                    for out, acc in arg.items():
+                        if out == '_id':
+                            continue
+                        (acc_op, acc_arg), = acc.items()
+                        if acc_op != '$sum':
+                            raise NotImplementedError(f"accumulator {acc_op}")
+                        group[out] = group.get(out, 0) + (_field_ref(d, acc_arg) or 0)
+                docs = list(groups.values())
+            elif op == '$sort':
+                docs.sort(key=_sort_key(list(arg.items())))
+            elif op == '$limit':
+                docs = docs[:arg]
+            else:
+                raise NotImplementedError(f"pipeline stage {op}")
+        return iter(docs)
+
+    def drop(self):
+        with self._lock:
+            self._docs.clear()
+            self._order.clear()
+            self._indexes.clear()
+
+
+def _field_ref(doc, expr):
+    if isinstance(expr, str) and expr.startswith('$'):
+        value = _get(doc, expr[1:])
+        return None if value is _MISSING else value
+    return expr
+
+
+def _hashable(value):
+    if isinstance(value, list):
+        return tuple(_hashable(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _hashable(v)) for k, v in value.items()))
+    return value
+
+
+class MemoryDatabase:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self._collections = {}
+
+    def __getitem__(self, name):
+        with self.client._lock:
+            coll = self._collections.get(name)
+            if coll is None:
+                coll = self._collections[name] = MemoryCollection(self, name)
+            return coll
+
+    def list_collection_names(self):
+        # like Mongo, reading a collection does not create it
+        with self.client._lock:
+            return [name for name, coll in self._collections.items() if coll._docs or coll._indexes]
+
+    def command(self, name, *args, **kwargs):
+        if name == "ping":
+            return {"ok": 1.0}
+        raise NotImplementedError(f"command {name}")
+
+
+class MemoryClient:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._databases = {}
+
+    def __getitem__(self, name):
+        with self._lock:
+            db = self._databases.get(name)
+            if db is None:
+                db = self._databases[name] = MemoryDatabase(self, name)
+            return db
+
+    @property
+    def admin(self):
+        return self['admin']
+
+    def list_database_names(self):
+        with self._lock:
+            return [name for name, db in self._databases.items() if db.list_collection_names()]
+
+    def drop_database(self, name):
+        name = getattr(name, 'name', name)
+        with self._lock:
+            self._databases.pop(name, None)
@@ -0,0 +1,176 @@
+"""Transaction rollups and ledger archival.
+
+Rollups: every new ledger row bumps one counter per dimension in the
+`transaction_rollups` collection (purchases per store, pet type, purchaser
+and day) with $inc upserts, so owner reports never rescan the ledger.
+Counters cover archived rows too. Rows are written with rollup_pending set.
+record first swaps the flag for a token of its own and then counts only the
+rows carrying that token, so concurrent or retried calls count a row at
+most once; a row whose flag was never claimed (the batch failed before
+record) is counted by the next finalize of its purchase.
+
+Archival (off unless TRANSACTION_RETENTION_DAYS is set): rows older than
+that many days move from `transactions` into monthly
+`transactions_archive_YYYY_MM` collections, a batch at a time. Archived rows
+leave GET /transactions, which lists the hot ledger only; /transactions/export
+and the rollups still cover them. A row is copied (upsert by purchase-id) before it is
+deleted, so a crash mid-batch leaves at worst a row in both places, which
+the next run cleans up. iter_transactions reads the partitions back in
+order, followed by the hot ledger.
+"""
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo import ASCENDING
+
+from common.storage import UpdateOne
+
+ROLLUPS = 'transaction_rollups'
+ARCHIVE_PREFIX = 'transactions_archive_'
+DIMENSIONS = ("store", "pet-type", "purchaser", "day")
+
+TRANSACTION_RETENTION_DAYS = float(os.environ.get('TRANSACTION_RETENTION_DAYS', 0))  # 0 disables archival
+ARCHIVE_INTERVAL_SECONDS = float(os.environ.get('ARCHIVE_INTERVAL_SECONDS', 3600))
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', 1000))
+
+_lock = threading.Lock()
+# archive partitions whose indexes this process already ensured
+_partitions = set()
+_stats = {"archive_runs": 0, "archived": 0, "errors": 0}
+
+
+def rollup_keys(transaction):
+    # (dimension, key) pairs one ledger row counts towards
+    purchased_at = transaction.get("purchased_at")
+    keys = [
+        ("store", str(transaction.get("store"))),
+        ("pet-type", (transaction.get("pet-type") or "").lower()),
+        ("purchaser", transaction.get("purchaser")),
+    ]
+    if purchased_at is not None:
+        keys.append(("day", purchased_at.strftime("%Y-%m-%d")))
+    return keys
+
+
+def rollup_updates(transactions):
+    counts = {}
+    for t in transactions:
+        for dimension, key in rollup_keys(t):
+            counts[(dimension, key)] = counts.get((dimension, key), 0) + 1
+    return [
+        UpdateOne(
+            {"_id": f"{dimension}:{key}"},
+            {"$inc": {"count": n}, "$setOnInsert": {"dimension": dimension, "key": key}},
+            upsert=True
+        )
+        for (dimension, key), n in counts.items()
+    ]
+
+
+def record(db, purchase_ids):
+    # counts the ledger rows among purchase_ids that still carry
+    # rollup_pending; returns how many it counted
+    ledger = db["transactions"]
+    token = str(ObjectId())
+    ledger.update_many({"purchase-id": {"$in": purchase_ids}, "rollup_pending": True},
+                       {"$set": {"rollup_pending": token}})
+    claimed = list(ledger.find({"purchase-id": {"$in": purchase_ids}, "rollup_pending": token}))
+    updates = rollup_updates(claimed)
+    if updates:
+        db[ROLLUPS].bulk_write(updates, ordered=False)
+    ledger.update_many({"purchase-id": {"$in": purchase_ids}, "rollup_pending": token},
+                       {"$unset": {"rollup_pending": ""}})
+    return len(claimed)
+
+
+def summary(db, dimension=None):
+    query = {"dimension": dimension} if dimension else {}
+    out = {d: {} for d in ([dimension] if dimension else DIMENSIONS)}
+    for r in db[ROLLUPS].find(query, {"_id": 0}):
+        out.setdefault(r["dimension"], {})[r["key"]] = r["count"]
+    return out
+
+
+# -- archival --
+
+def partition_name(purchased_at):
+    return f"{ARCHIVE_PREFIX}{purchased_at:%Y_%m}"
+
+
+def _partition(db, name):
+    coll = db[name]
+    if name not in _partitions:
+        coll.create_index([("purchase-id", ASCENDING)], name="purchase_id_unique", unique=True)
+        coll.create_index([("purchased_at", ASCENDING)], name="purchased_at")
+        _partitions.add(name)
+    return coll
+
+
+def archive_batch(db, cutoff):
+    # moves up to ARCHIVE_BATCH_SIZE rows older than cutoff, returns how many
+    rows = list(db["transactions"].find({"purchased_at": {"$lt": cutoff}})
+                .sort("purchased_at", ASCENDING).limit(ARCHIVE_BATCH_SIZE))
+    by_partition = {}
+    for t in rows:
+        by_partition.setdefault(partition_name(t["purchased_at"]), []).append(t)
+
+    for name, batch in by_partition.items():
+        _partition(db, name).bulk_write([
+            UpdateOne({"purchase-id": t["purchase-id"]}, {"$setOnInsert": t}, upsert=True)
+            for t in batch
+        ], ordered=False)
+        db["transactions"].delete_many({"_id": {"$in": [t["_id"] for t in batch]}})
+    return len(rows)
+
+
+def archive(db, now=None):
+    if TRANSACTION_RETENTION_DAYS <= 0:
+        return 0
+    cutoff = (now or datetime.utcnow()) - timedelta(days=TRANSACTION_RETENTION_DAYS)
+    moved = 0
+    while True:
+        n = archive_batch(db, cutoff)
+        moved += n
+        if n < ARCHIVE_BATCH_SIZE:
+            break
+    with _lock:
+        _stats["archive_runs"] += 1
+        _stats["archived"] += moved
+    return moved
+
+
+def archiver_loop(db, on_archived):
+    while True:
+        time.sleep(ARCHIVE_INTERVAL_SECONDS)
+        try:
+            moved = archive(db)
+            if moved:
+                print(f"Archived {moved} transactions")
+                on_archived()
+        except Exception as e:
+            with _lock:
+                _stats["errors"] += 1
+            print("Error archiving transactions:", e)
+
+
+def start(db, on_archived):
+    if TRANSACTION_RETENTION_DAYS <= 0:
+        return None
+    t = threading.Thread(target=archiver_loop, args=(db, on_archived), name="ledger-archiver", daemon=True)
+    t.start()
+    return t
+
+
+def iter_transactions(db, query):
+    # archived partitions oldest first, then the hot ledger, each in purchase order
+    names = sorted(n for n in db.list_collection_names() if n.startswith(ARCHIVE_PREFIX))
+    for name in names + ["transactions"]:
+        yield from db[name].find(query).sort("purchased_at", ASCENDING)
+
+
+def stats():
+    with _lock:
+        return dict(_stats)
@@ -0,0 +1,89 @@
+"""Indexes and data migrations for the pet order database.
+
+Run by common/migrations.py at service startup, and by hand with:
+
+    python -m pet_order.migrations
+"""
+import os
+
+from pymongo import ASCENDING, MongoClient
+
+from common import migrations as common_migrations
+from pet_order import ledger
+
+# how long committed and aborted outbox entries are kept, which is also how
+# long an Idempotency-Key replays its purchase; pending entries never expire
+OUTBOX_RETENTION_SECONDS = int(os.environ.get('OUTBOX_RETENTION_SECONDS', 7 * 86400))
+
+INDEXES = {
+    "transactions": [
+        ([("purchase-id", ASCENDING)], {"name": "purchase_id_unique", "unique": True}),
+        ([("store", ASCENDING)], {"name": "store"}),
+        ([("purchaser", ASCENDING)], {"name": "purchaser"}),
+        ([("pet_type_lower", ASCENDING)], {"name": "pet_type_lower"}),
+        ([("purchased_at", ASCENDING)], {"name": "purchased_at"}),
+    ],
+    "transaction_rollups": [
+        ([("dimension", ASCENDING)], {"name": "dimension"}),
+    ],
+    "purchase_outbox": [
+        ([("status", ASCENDING), ("created_at", ASCENDING)], {"name": "status_created_at"}),
+        # only finished entries have updated_at
+        ([("updated_at", ASCENDING)], {"name": "updated_at_ttl", "expireAfterSeconds": OUTBOX_RETENTION_SECONDS}),
+    ],
+}
+
+
+# -- migrations --
+
+def backfill_transaction_pet_type_lower(db):
+    changed = 0
+    for t in db["transactions"].find({"pet_type_lower": {"$exists": False}}, {"pet-type": 1}):
+        db["transactions"].update_one(
+            {"_id": t["_id"]},
+            {"$set": {"pet_type_lower": (t.get("pet-type") or "").lower()}}
+        )
+        changed += 1
+    return changed
+
+
+def backfill_transaction_purchased_at(db):
+    # rows written before purchased_at existed get their insert time from the ObjectId
+    changed = 0
+    for t in db["transactions"].find({"purchased_at": {"$exists": False}}, {"_id": 1}):
+        db["transactions"].update_one(
+            {"_id": t["_id"]},
+            {"$set": {"purchased_at": t["_id"].generation_time.replace(tzinfo=None)}}
+        )
+        changed += 1
+    return changed
+
+
+def build_transaction_rollups(db):
+    # counts the existing ledger once, later purchases are counted as they
+    # happen; pet_order refuses purchases until migrations finish, and a re-run
+    # after a crash starts over from an empty collection
+    db["transaction_rollups"].delete_many({})
+    db["transactions"].update_many({"rollup_pending": True}, {"$unset": {"rollup_pending": ""}})
+    updates = ledger.rollup_updates(
+        db["transactions"].find({}, {"store": 1, "pet-type": 1, "purchaser": 1, "purchased_at": 1}))
+    if updates:
+        db["transaction_rollups"].bulk_write(updates, ordered=False)
+    return len(updates)
+
+
+# append only, never reorder
+MIGRATIONS = [
+    (1, "backfill_transaction_pet_type_lower", backfill_transaction_pet_type_lower),
+    (2, "backfill_transaction_purchased_at", backfill_transaction_purchased_at),
+    (3, "build_transaction_rollups", build_transaction_rollups),
+]
+
+
+def run(db):
+    return common_migrations.run(db, MIGRATIONS, INDEXES)
+
+
+if __name__ == '__main__':
+    mongo_uri = os.environ.get('MONGO_URI', 'mongodb://localhost:27017/')
+    print(run(MongoClient(mongo_uri)['pet_orders']))
@@ -1,19 +1,53 @@
+import hashlib
+import json
 import os
 import random
-import requests
-from flask import Flask, jsonify, request
-from pymongo import MongoClient
+import threading
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from flask import Flask, Response, jsonify, request
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from common import admission, compression, health, singleflight, storage
+from common.storage import UpdateOne
+from pet_order import ledger, migrations, store_client
 
 app = Flask(__name__)
+compression.install(app)
+admission.install(app, {"create_purchase": "purchase", "create_purchase_batch": "purchase"},
+                  exempt={"healthz", "readyz"})
 
 MONGO_URI = os.environ.get('MONGO_URI', 'mongodb://localhost:27017/')
-mongo_client = MongoClient(MONGO_URI)
+# STORAGE_BACKEND=memory swaps Mongo for the in-process engine in storage.py
+mongo_client = storage.connect(MONGO_URI)
 db = mongo_client['pet_orders']
 transactions_collection = db['transactions']
 counters_collection = db['counters']
+# pending purchases are written here first, then finalized into transactions
+outbox_collection = db['purchase_outbox']
 PET_STORE1_URL = os.environ.get('PET_STORE1_URL', 'http://pet-store1:5001')
 PET_STORE2_URL = os.environ.get('PET_STORE2_URL', 'http://pet-store2:5001')
-OWNER_PASSWORD = "LovesPetsL2M3n4"
+OWNER_PASSWORD = os.environ.get('OWNER_PASSWORD', "LovesPetsL2M3n4")
+DEBUG = os.environ.get('FLASK_DEBUG', 'false').lower() in ('1', 'true', 'yes')
+
+# how old a pending purchase must be before the reconciler takes it over
+RECONCILE_GRACE_SECONDS = int(os.environ.get('RECONCILE_GRACE_SECONDS', 60))
+RECONCILE_INTERVAL_SECONDS = int(os.environ.get('RECONCILE_INTERVAL_SECONDS', 30))
+# how many candidates a purchase tries before reporting that none is available
+MAX_CLAIM_ATTEMPTS = int(os.environ.get('MAX_CLAIM_ATTEMPTS', 3))
+MAX_BATCH_PURCHASES = int(os.environ.get('MAX_BATCH_PURCHASES', 500))
+
+
+# pre-encoded /transactions responses, replaced wholesale whenever the ledger changes
+transactions_cache = {}
+
+
+def invalidate_transactions_cache():
+    global transactions_cache
+    transactions_cache = {}
 
 
 def get_next_purchase_id():
@@ -26,94 +60,437 @@ def get_next_purchase_id():
     return str(result['seq'])
 
 
+def load_store_registry(spec):
+    # PET_STORES format: "1=http://pet-store1:5001,2=http://pet-store:5001/stores/2"
+    # a store served by a multi-tenant pet_store uses its /stores/<id> prefix as the URL
+    if not spec:
+        return {1: PET_STORE1_URL, 2: PET_STORE2_URL}
+    registry = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        num, url = item.split('=', 1)
+        registry[int(num)] = url.strip().rstrip('/')
+    return registry
+
+
+# store number -> base URL
+STORE_REGISTRY = load_store_registry(os.environ.get('PET_STORES', ''))
+
+
+def allocate_purchase_ids(count):
+    # one counter bump for a whole block of ids
+    result = counters_collection.find_one_and_update(
+        {'_id': 'purchase_id'},
+        {'$inc': {'seq': count}},
+        upsert=True,
+        return_document=True
+    )
+    return [str(n) for n in range(result['seq'] - count + 1, result['seq'] + 1)]
+
+
 def get_store_url(store_num):
     # return URL for tha matching store number
-    if store_num == 1:
-        return PET_STORE1_URL
-    elif store_num == 2:
-        return PET_STORE2_URL
-    return None
+    return STORE_REGISTRY.get(store_num)
 
-def find_pet_type_id(store_url, pet_type_name):
+def fetch_pet_types(store_url):
+    # each pet type carries the names of its pets, so one call lists the whole store
     try:
-        resp = requests.get(f"{store_url}/pet-types")
+        resp = store_client.get(store_url, "/pet-types")
         if resp.status_code != 200:
             return None
-
-        pet_types = resp.json()
-        for pt in pet_types:
-            if pt.get('type', '').lower() == pet_type_name.lower():
-                return pt.get('id')
+        return resp.json()
+    except Exception:
         return None
+
+
+# -- availability index --
+# store number -> {type_lower: {"id": pet_type_id, "pets": {name_lower: name}}}
+# Purchases pick their candidate from here and only contact the store for the
+# final delete. Each store is kept current from its change feed, which is also
+# read when a lookup misses, with a full re-read when the feed cannot be
+# followed and every AVAILABILITY_REFRESH_SECONDS; pets are dropped locally as
+# soon as they are claimed. Lookups re-read a store in full at most once per
+# AVAILABILITY_MIN_REFRESH_SECONDS.
+availability = {}
+# store number -> change feed token the store's index is current up to
+availability_cursors = {}
+# store number -> time.monotonic() of its last full re-read
+availability_refreshed_at = {}
+availability_lock = threading.Lock()
+AVAILABILITY_SYNC_SECONDS = float(os.environ.get('AVAILABILITY_SYNC_SECONDS', 2))
+AVAILABILITY_REFRESH_SECONDS = int(os.environ.get('AVAILABILITY_REFRESH_SECONDS', 300))
+AVAILABILITY_MIN_REFRESH_SECONDS = float(os.environ.get('AVAILABILITY_MIN_REFRESH_SECONDS', 5))
+
+
+def fetch_changes(store_url, since=None):
+    # (status, body) of the store's change feed, status None when unreachable
+    try:
+        path = "/changes" if since is None else f"/changes?since={since}"
+        resp = store_client.get(store_url, path)
+        return resp.status_code, (resp.json() if resp.status_code == 200 else None)
+    except Exception:
+        return None, None
+
+
+def refresh_store_availability(store_num, max_age=None):
+    # with max_age, a store re-read less than max_age seconds ago is left as is
+    if max_age is not None:
+        with availability_lock:
+            last = availability_refreshed_at.get(store_num)
+        if last is not None and time.monotonic() - last < max_age:
+            return True
+
+    store_url = get_store_url(store_num)
+
+    def fetch():
+        # take the feed position first so nothing between it and the listing is missed
+        status, head = fetch_changes(store_url)
+        return status, head, fetch_pet_types(store_url)
+
+    # concurrent re-reads of a store share one feed position and listing; the
+    # position is the leader's, so it never runs ahead of the listing
+    (status, head, pet_types), _ = singleflight.do(("availability", store_url), fetch)
+    if pet_types is None:
+        return False
+
+    index = {}
+    for pt in pet_types:
+        index[pt.get('type', '').lower()] = {
+            "id": pt.get('id'),
+            "pets": {name.lower(): name for name in pt.get('pets', [])}
+        }
+    with availability_lock:
+        availability[store_num] = index
+        availability_refreshed_at[store_num] = time.monotonic()
+        if status == 200:
+            availability_cursors[store_num] = head["next"]
+        else:
+            availability_cursors.pop(store_num, None)
+    return True
+
+
+def apply_change(index, change):
+    # False when the change refers to a type the index does not know
+    if change["kind"] == "pet-type":
+        if change["op"] == "create":
+            index[change["type"].lower()] = {"id": change["pet-type-id"], "pets": {}}
+        elif change["op"] == "delete":
+            for type_lower, entry in list(index.items()):
+                if entry["id"] == change["pet-type-id"]:
+                    del index[type_lower]
+        return True
+
+    entry = next((e for e in index.values() if e["id"] == change["pet-type-id"]), None)
+    if entry is None:
+        return False
+    if change["op"] == "update":
+        entry["pets"].pop(change["old-name"].lower(), None)
+    if change["op"] == "delete":
+        entry["pets"].pop(change["name"].lower(), None)
+    else:
+        entry["pets"][change["name"].lower()] = change["name"]
+    return True
+
+
+def sync_store_availability(store_num, max_age=None):
+    # max_age is passed on to the full re-read the feed may fall back to
+    cursor = availability_cursors.get(store_num)
+    if cursor is None:
+        return refresh_store_availability(store_num, max_age)
+
+    status, body = fetch_changes(get_store_url(store_num), cursor)
+    if status is None:
+        return False
+    if status != 200:
+        # token expired or unknown (e.g. the store's data was reset)
+        return refresh_store_availability(store_num, max_age)
+
+    with availability_lock:
+        if availability_cursors.get(store_num) != cursor:
+            return True  # a full refresh ran meanwhile
+        index = availability.setdefault(store_num, {})
+        for change in body["changes"]:
+            if not apply_change(index, change):
+                availability_cursors.pop(store_num, None)
+                break
+        else:
+            availability_cursors[store_num] = body["next"]
+            return True
+    return refresh_store_availability(store_num, max_age)
+
+
+def forget_pet(store_num, pet_type_name, pet_name):
+    with availability_lock:
+        entry = availability.get(store_num, {}).get(pet_type_name.lower())
+        if entry is not None:
+            entry["pets"].pop(pet_name.lower(), None)
+
+
+def lookup_available_pets(stores, pet_type_name, pet_name=None):
+    # List of (store_num, pet_type_id, pet_name)
+    found = []
+    with availability_lock:
+        for store_num in stores:
+            entry = availability.get(store_num, {}).get(pet_type_name.lower())
+            if entry is None:
+                continue
+            if pet_name is not None:
+                name = entry["pets"].get(pet_name.lower())
+                if name is not None:
+                    found.append((store_num, entry["id"], name))
+            else:
+                found.extend((store_num, entry["id"], name) for name in entry["pets"].values())
+    return found
+
+
+def availability_refresher_loop():
+    last_full = time.monotonic()
+    while True:
+        full = time.monotonic() - last_full >= AVAILABILITY_REFRESH_SECONDS
+        for store_num in list(STORE_REGISTRY):
+            try:
+                if full:
+                    refresh_store_availability(store_num)
+                else:
+                    sync_store_availability(store_num)
+            except Exception as e:
+                print("Error refreshing availability:", e)
+        if full:
+            last_full = time.monotonic()
+        time.sleep(AVAILABILITY_SYNC_SECONDS)
+
+
+def start_availability_refresher():
+    t = threading.Thread(target=availability_refresher_loop, name="availability-refresher", daemon=True)
+    t.start()
+    return t
+
+
+def delete_pet(store_url, pet_type_id, pet_name, claim):
+    # returns the store's status code, or None when the outcome is unknown;
+    # claim is the outbox entry id, recorded by the store with the delete
+    try:
+        resp = store_client.delete(store_url, f"/pet-types/{pet_type_id}/pets/{pet_name}?claim={claim}")
+        return resp.status_code
     except Exception:
         return None
 
 
-def get_pets_of_type(store_url, pet_type_id):
+def claim_pets(store_url, entries):
+    # bulk delete; one status per entry, None where the outcome is unknown
+    body = {"pets": [{"pet-type-id": e["pet-type-id"], "name": e["pet-name"], "claim": e["_id"]} for e in entries]}
     try:
-        resp = requests.get(f"{store_url}/pet-types/{pet_type_id}/pets")
-        if resp.status_code != 200:
-            return []
-        return resp.json()
+        resp = store_client.post(store_url, "/pets:batch-delete", body)
+        if resp.status_code == 200:
+            return resp.json()["results"]
     except Exception:
-        return []
+        pass
+    return [None] * len(entries)
 
 
-def delete_pet(store_url, pet_type_id, pet_name):
+def claim_exists(store_url, claim):
+    # whether the store removed a pet for this claim: True/False when the
+    # store answered, None when it could not be reached
     try:
-        resp = requests.delete(f"{store_url}/pet-types/{pet_type_id}/pets/{pet_name}")
-        return resp.status_code == 204
+        resp = store_client.get(store_url, f"/claims/{claim}")
+        if resp.status_code == 200:
+            return True
+        if resp.status_code == 404:
+            return False
+        return None
     except Exception:
-        return False
+        return None
+
+
+# -- purchase outbox --
+# A purchase is recorded as a pending outbox entry before the pet is removed
+# from the store. Once the store confirms the delete the entry is finalized
+# into a transaction. The delete carries the entry id as a claim token, which
+# the store records with it. Entries left pending by a crash or an
+# unreachable store are picked up by the reconciler, which finalizes them
+# only when the store holds their claim; a pet that is merely gone may have
+# been sold or deleted by someone else, so those entries are aborted.
+# Finished entries expire after OUTBOX_RETENTION_SECONDS (see migrations.py),
+# and with them the replay of their Idempotency-Key.
+
+def purchase_response(entry):
+    return {
+        "purchaser": entry["purchaser"],
+        "pet-type": entry["pet-type"],
+        "store": entry["store"],
+        "pet-name": entry["pet-name"],
+        "purchase-id": entry["purchase-id"]
+    }
+
+
+def idempotency_entry_id(purchaser, key):
+    # keys are only unique per purchaser; hashed so the id is a safe claim token
+    return hashlib.sha256(json.dumps([purchaser, key]).encode()).hexdigest()
+
+
+def replay_purchase(entry):
+    # answer a retried request from the state recorded for its idempotency key
+    if entry["status"] == "committed":
+        return jsonify(purchase_response(entry)), 201
+    if entry["status"] == "aborted":
+        return jsonify({"error": "No pet of this type is available"}), 400
+    resp = jsonify({"error": "Purchase in progress"})
+    resp.headers["Retry-After"] = "1"
+    return resp, 409
+
+
+def replay_batch_item(entry):
+    # replay_purchase for one item of a batch
+    if entry["status"] == "committed":
+        return {"status": 201, "purchase": purchase_response(entry)}
+    if entry["status"] == "aborted":
+        return {"status": 400, "error": "No pet of this type is available"}
+    return {"status": 409, "error": "Purchase in progress"}
+
+
+def transaction_doc(entry):
+    return {
+        "purchaser": entry["purchaser"],
+        "pet-type": entry["pet-type"],
+        "store": entry["store"],
+        "purchase-id": entry["purchase-id"],
+        "pet_type_lower": entry["pet-type"].lower(),
+        "purchased_at": datetime.utcnow(),
+        "rollup_pending": True
+    }
+
+
+def finalize_purchase(entry_id):
+    # idempotent: safe to call from both the request path and the reconciler
+    entry = outbox_collection.find_one({"_id": entry_id})
+    if entry is None or entry["status"] == "aborted":
+        return None
+
+    if not entry.get("purchase-id"):
+        outbox_collection.update_one(
+            {"_id": entry_id, "purchase-id": None},
+            {"$set": {"purchase-id": get_next_purchase_id()}}
+        )
+        entry = outbox_collection.find_one({"_id": entry_id})
+
+    transactions_collection.update_one(
+        {"purchase-id": entry["purchase-id"]},
+        {"$setOnInsert": transaction_doc(entry)},
+        upsert=True
+    )
+    # counts the row unless that already happened (a batch that failed before
+    # counting leaves it pending)
+    ledger.record(db, [entry["purchase-id"]])
+
+    invalidate_transactions_cache()
+
+    return outbox_collection.find_one_and_update(
+        {"_id": entry_id},
+        {"$set": {"status": "committed", "updated_at": datetime.utcnow()}},
+        return_document=ReturnDocument.AFTER
+    )
+
+
+def abort_purchase(entry_id):
+    outbox_collection.update_one(
+        {"_id": entry_id, "status": "pending"},
+        {"$set": {"status": "aborted", "updated_at": datetime.utcnow()}}
+    )
+
+
+def reconcile_pending_purchases():
+    cutoff = datetime.utcnow() - timedelta(seconds=RECONCILE_GRACE_SECONDS)
+    for entry in outbox_collection.find({"status": "pending", "created_at": {"$lt": cutoff}}):
+        if entry.get("purchase-id"):
+            # the store already confirmed the delete, only the ledger write is missing
+            finalize_purchase(entry["_id"])
+            continue
+
+        claimed = claim_exists(get_store_url(entry["store"]), entry["_id"])
+        if claimed is None:
+            continue  # store unreachable, try again next round
+        if claimed:
+            finalize_purchase(entry["_id"])
+        else:
+            abort_purchase(entry["_id"])
+
+
+def reconciler_loop():
+    while True:
+        time.sleep(RECONCILE_INTERVAL_SECONDS)
+        if not readiness["migrated"]:
+            continue  # finalizing now could count a purchase twice in the rollups
+        try:
+            reconcile_pending_purchases()
+        except Exception as e:
+            print("Error in reconciler:", e)
+
+
+def start_reconciler():
+    t = threading.Thread(target=reconciler_loop, name="purchase-reconciler", daemon=True)
+    t.start()
+    return t
 
 
 def find_available_pet(pet_type_name, store=None, pet_name=None):
     # finda an available pet based on the criteria
 
-    stores_to_check = []
-
     if store is not None:
         # Check specific store
-        stores_to_check = [(store, get_store_url(store))]
+        stores_to_check = [store]
     else:
-        # Check both stores
-        stores_to_check = [(1, PET_STORE1_URL), (2, PET_STORE2_URL)]
+        # Check all stores
+        stores_to_check = sorted(STORE_REGISTRY)
 
-    available_pets = []  # List of (store_num, pet_type_id, pet_name)
+    # route around stores whose circuit breaker is open
+    stores_to_check = [s for s in stores_to_check if store_client.is_available(get_store_url(s))]
 
-    for store_num, store_url in stores_to_check:
-        # Find pet-type ID in this store
-        pet_type_id = find_pet_type_id(store_url, pet_type_name)
-        if not pet_type_id:
-            continue
+    available_pets = lookup_available_pets(stores_to_check, pet_type_name, pet_name)
 
-        # Get pets of this type
-        pets = get_pets_of_type(store_url, pet_type_id)
-        if not pets:
-            continue
+    if not available_pets:
+        # the index may be behind the stores - catch up on their feeds before giving up
+        for store_num in stores_to_check:
+            sync_store_availability(store_num, AVAILABILITY_MIN_REFRESH_SECONDS)
+        available_pets = lookup_available_pets(stores_to_check, pet_type_name, pet_name)
 
-        if pet_name is not None:
-            # Looking for specific pet
-            for pet in pets:
-                if pet.get('name', '').lower() == pet_name.lower():
-                    return (store_num, pet_type_id, pet.get('name'))
-        else:
-            # all other available pets
-            for pet in pets:
-                available_pets.append((store_num, pet_type_id, pet.get('name')))
+    if not available_pets:
+        return None
 
-    # looking for specific pet and not found
+    # looking for specific pet
     if pet_name is not None:
-        return None
+        return available_pets[0]
 
     # return random pet from available ones
-    if available_pets:
-        return random.choice(available_pets)
-
-    return None
+    return random.choice(available_pets)
 
 
 # -- purchases endpoint --
+def valid_purchase(data):
+    if not data or not isinstance(data, dict):
+        return False
+
+    # validate required fields
+    if 'purchaser' not in data or 'pet-type' not in data:
+        return False
+
+    # reject extra fields
+    allowed_fields = {'purchaser', 'pet-type', 'store', 'pet-name', 'purchase-id'}
+    if not set(data.keys()).issubset(allowed_fields):
+        return False
+
+    store = data.get('store')
+    # check store value (if we got it from the request)
+    if store is not None and (not isinstance(store, int) or store not in STORE_REGISTRY):
+        return False
+
+    # pet-name can only be provided if store is provided
+    if data.get('pet-name') is not None and store is None:
+        return False
+
+    return True
+
+
 @app.route('/purchases', methods=['POST'])
 def create_purchase():
     try:
@@ -122,16 +499,7 @@ def create_purchase():
             return jsonify({"error": "Expected application/json media type"}), 415
 
         data = request.get_json()
-        if not data:
-            return jsonify({"error": "Malformed data"}), 400
-
-        # validate required fields
-        if 'purchaser' not in data or 'pet-type' not in data:
-            return jsonify({"error": "Malformed data"}), 400
-
-        # reject extra fields
-        allowed_fields = {'purchaser', 'pet-type', 'store', 'pet-name', 'purchase-id'}
-        if not set(data.keys()).issubset(allowed_fields):
+        if not valid_purchase(data):
             return jsonify({"error": "Malformed data"}), 400
 
         purchaser = data['purchaser']
@@ -139,52 +507,324 @@ def create_purchase():
         store = data.get('store')
         pet_name = data.get('pet-name')
 
-        # check store value (if we got it from the request)
-        if store is not None and store not in [1, 2]:
-            return jsonify({"error": "Malformed data"}), 400
-
-        # pet-name can only be provided if store is provided
-        if pet_name is not None and store is None:
-            return jsonify({"error": "Malformed data"}), 400
+        # retried request: answer from what was recorded the first time
+        idempotency_key = request.headers.get('Idempotency-Key')
+        entry_id = idempotency_entry_id(purchaser, idempotency_key) if idempotency_key else str(ObjectId())
+        if idempotency_key:
+            existing = outbox_collection.find_one({"_id": entry_id})
+            if existing is not None:
+                return replay_purchase(existing)
 
         # 1. get an available pet
         result = find_available_pet(pet_type, store, pet_name)
 
         if result is None:
+            in_scope = [store] if store is not None else list(STORE_REGISTRY)
+            if any(not store_client.is_available(get_store_url(s)) for s in in_scope):
+                # an unhealthy store might have had one - fail fast instead of guessing
+                resp = jsonify({"error": "Store unavailable"})
+                resp.headers["Retry-After"] = str(int(store_client.BREAKER_OPEN_SECONDS))
+                return resp, 503
             return jsonify({"error": "No pet of this type is available"}), 400
 
         chosen_store, pet_type_id, chosen_pet_name = result
 
-        # 2. delete the pet from the store
-        store_url = get_store_url(chosen_store)
-        if not delete_pet(store_url, pet_type_id, chosen_pet_name):
-            return jsonify({"error": "No pet of this type is available"}), 400
-
-        # 3. generate purchase and save in db
-        purchase_id = get_next_purchase_id()
-        purchase = {
-            "purchaser": purchaser,
-            "pet-type": pet_type,
-            "store": chosen_store,
-            "pet-name": chosen_pet_name,
-            "purchase-id": purchase_id
-        }
-        transaction = {
-            "purchaser": purchaser,
-            "pet-type": pet_type,
-            "store": chosen_store,
-            "purchase-id": purchase_id
-        }
-        transactions_collection.insert_one(transaction)
+        # 2. record the pending purchase before touching the store
+        try:
+            outbox_collection.insert_one({
+                "_id": entry_id,
+                "status": "pending",
+                "purchaser": purchaser,
+                "pet-type": pet_type,
+                "store": chosen_store,
+                "pet-type-id": pet_type_id,
+                "pet-name": chosen_pet_name,
+                "purchase-id": None,
+                "created_at": datetime.utcnow()
+            })
+        except DuplicateKeyError:
+            # a concurrent request with the same key got there first
+            return replay_purchase(outbox_collection.find_one({"_id": entry_id}))
+
+        # 3. delete the pet from the store, moving on to another candidate if
+        # the index handed us one that was already gone
+        for attempt in range(MAX_CLAIM_ATTEMPTS):
+            store_url = get_store_url(chosen_store)
+            status = delete_pet(store_url, pet_type_id, chosen_pet_name, entry_id)
+            if status is None or (status != 204 and status != 404):
+                # outcome unknown - leave it pending for the reconciler
+                resp = jsonify({"error": "Purchase in progress"})
+                resp.headers["Retry-After"] = str(RECONCILE_GRACE_SECONDS)
+                return resp, 503
+
+            forget_pet(chosen_store, pet_type, chosen_pet_name)
+            if status == 204:
+                break
+
+            result = find_available_pet(pet_type, store, pet_name)
+            if result is None or attempt == MAX_CLAIM_ATTEMPTS - 1:
+                abort_purchase(entry_id)
+                return jsonify({"error": "No pet of this type is available"}), 400
+
+            chosen_store, pet_type_id, chosen_pet_name = result
+            outbox_collection.update_one(
+                {"_id": entry_id, "status": "pending"},
+                {"$set": {"store": chosen_store, "pet-type-id": pet_type_id, "pet-name": chosen_pet_name}}
+            )
+
+        # 4. generate purchase id and save the transaction
+        entry = finalize_purchase(entry_id)
 
         # purchase completed successfully
-        return jsonify(purchase), 201
+        return jsonify(purchase_response(entry)), 201
 
     except Exception as e:
         print("Error in create_purchase:", e)
         return jsonify({"error": "Server error"}), 500
 
 
+def commit_batch(entries):
+    # finalize_purchase for entries whose pets were all claimed, in bulk
+    ids = allocate_purchase_ids(len(entries))
+    for entry, purchase_id in zip(entries, ids):
+        entry["purchase-id"] = purchase_id
+    outbox_collection.bulk_write([
+        UpdateOne({"_id": entry["_id"]}, {"$set": {"purchase-id": entry["purchase-id"]}})
+        for entry in entries
+    ])
+    transactions_collection.insert_many([transaction_doc(entry) for entry in entries])
+    ledger.record(db, ids)
+    outbox_collection.update_many(
+        {"_id": {"$in": [entry["_id"] for entry in entries]}},
+        {"$set": {"status": "committed", "updated_at": datetime.utcnow()}}
+    )
+
+
+@app.route('/purchases:batch', methods=['POST'])
+def create_purchase_batch():
+    # Buys many pets at once. Each store is listed once, pets are claimed with
+    # one bulk delete per store, purchase ids come from one counter bump and
+    # the transactions are written with insert_many. Items succeed or fail on
+    # their own: the answer has one {"status", "purchase"|"error"} per item.
+    # Like a single purchase, an item whose pet turns out to be gone moves on
+    # to another candidate, up to MAX_CLAIM_ATTEMPTS claims.
+    # With an Idempotency-Key every item gets its own key (the batch key and
+    # its position), so a retried batch replays the items recorded the first
+    # time and only tries the rest again.
+    try:
+        if request.headers.get('Content-Type') != 'application/json':
+            return jsonify({"error": "Expected application/json media type"}), 415
+
+        data = request.get_json()
+        specs = data.get("purchases") if isinstance(data, dict) else None
+        if not isinstance(specs, list) or not specs or len(specs) > MAX_BATCH_PURCHASES:
+            return jsonify({"error": "Malformed data"}), 400
+
+        results = [None] * len(specs)
+        for i, spec in enumerate(specs):
+            if not valid_purchase(spec):
+                results[i] = {"status": 400, "error": "Malformed data"}
+
+        idempotency_key = request.headers.get('Idempotency-Key')
+        entry_ids = [
+            idempotency_entry_id(spec['purchaser'], [idempotency_key, i]) if idempotency_key and results[i] is None
+            else str(ObjectId())
+            for i, spec in enumerate(specs)
+        ]
+        if idempotency_key:
+            recorded = {e["_id"]: e for e in outbox_collection.find({"_id": {"$in": entry_ids}})}
+            for i, entry_id in enumerate(entry_ids):
+                if results[i] is None and entry_id in recorded:
+                    results[i] = replay_batch_item(recorded[entry_id])
+
+        # 1. catch up on the feed of every store in scope
+        wanted = [spec for i, spec in enumerate(specs) if results[i] is None]
+        if any(spec.get('store') is None for spec in wanted):
+            scope = sorted(STORE_REGISTRY)
+        else:
+            scope = sorted({spec['store'] for spec in wanted})
+        healthy = [s for s in scope if store_client.is_available(get_store_url(s))]
+        for store_num in healthy:
+            sync_store_availability(store_num, AVAILABILITY_MIN_REFRESH_SECONDS)
+
+        # 2. pick a distinct pet for every item from the index
+        batch_id = str(ObjectId())
+        taken = set()
+
+        def pick(spec):
+            # an untaken (store, pet type id, pet name) for spec, or None
+            stores = [spec['store']] if spec.get('store') is not None else healthy
+            candidates = [c for c in lookup_available_pets(
+                [s for s in stores if s in healthy], spec['pet-type'], spec.get('pet-name'))
+                if (c[0], c[1], c[2].lower()) not in taken]
+            if not candidates:
+                return None
+            chosen = candidates[0] if spec.get('pet-name') is not None else random.choice(candidates)
+            taken.add((chosen[0], chosen[1], chosen[2].lower()))
+            return chosen
+
+        entries = []  # (item index, outbox entry)
+        for i, spec in enumerate(specs):
+            if results[i] is not None:
+                continue
+            chosen = pick(spec)
+            if chosen is None:
+                stores = [spec['store']] if spec.get('store') is not None else healthy
+                if any(s not in healthy for s in stores) or not stores:
+                    results[i] = {"status": 503, "error": "Store unavailable"}
+                else:
+                    results[i] = {"status": 400, "error": "No pet of this type is available"}
+                continue
+            entries.append((i, {
+                "_id": entry_ids[i],
+                "batch-id": batch_id,
+                "status": "pending",
+                "purchaser": spec['purchaser'],
+                "pet-type": spec['pet-type'],
+                "store": chosen[0],
+                "pet-type-id": chosen[1],
+                "pet-name": chosen[2],
+                "purchase-id": None,
+                "created_at": datetime.utcnow()
+            }))
+
+        if not entries:
+            return jsonify({"results": results}), 200
+
+        # 3. record all pending purchases, then claim the pets store by store
+        try:
+            outbox_collection.insert_many([entry for _, entry in entries], ordered=False)
+        except BulkWriteError:
+            # keep the entries this request wrote; a concurrent retry of the
+            # same batch may own the others
+            ids = [entry["_id"] for _, entry in entries]
+            written = {e["_id"]: e for e in outbox_collection.find({"_id": {"$in": ids}})}
+            mine = []
+            for i, entry in entries:
+                other = written.get(entry["_id"])
+                if other is None:
+                    results[i] = {"status": 503, "error": "Server error"}
+                elif other.get("batch-id") != batch_id:
+                    results[i] = replay_batch_item(other)
+                else:
+                    mine.append((i, entry))
+            entries = mine
+
+        # a pet the index offered but the store no longer has is replaced by
+        # another candidate, up to MAX_CLAIM_ATTEMPTS claims per item
+        claimed = []
+        to_claim = entries
+        for attempt in range(MAX_CLAIM_ATTEMPTS):
+            gone = []
+            by_store = {}
+            for i, entry in to_claim:
+                by_store.setdefault(entry["store"], []).append((i, entry))
+            for store_num, items in by_store.items():
+                statuses = claim_pets(get_store_url(store_num), [entry for _, entry in items])
+                for (i, entry), status in zip(items, statuses):
+                    if status == 204:
+                        forget_pet(store_num, entry["pet-type"], entry["pet-name"])
+                        claimed.append((i, entry))
+                    elif status == 404:
+                        forget_pet(store_num, entry["pet-type"], entry["pet-name"])
+                        gone.append((i, entry))
+                    else:
+                        # outcome unknown - the reconciler will settle it
+                        results[i] = {"status": 503, "error": "Purchase in progress"}
+            if not gone:
+                break
+
+            to_claim = []
+            if attempt < MAX_CLAIM_ATTEMPTS - 1:
+                for store_num in {entry["store"] for _, entry in gone}:
+                    sync_store_availability(store_num, AVAILABILITY_MIN_REFRESH_SECONDS)
+            for i, entry in gone:
+                chosen = pick(specs[i]) if attempt < MAX_CLAIM_ATTEMPTS - 1 else None
+                if chosen is None:
+                    abort_purchase(entry["_id"])
+                    results[i] = {"status": 400, "error": "No pet of this type is available"}
+                    continue
+                entry.update({"store": chosen[0], "pet-type-id": chosen[1], "pet-name": chosen[2]})
+                outbox_collection.update_one(
+                    {"_id": entry["_id"], "status": "pending"},
+                    {"$set": {"store": chosen[0], "pet-type-id": chosen[1], "pet-name": chosen[2]}}
+                )
+                to_claim.append((i, entry))
+            if not to_claim:
+                break
+
+        # 4. ids in one block, then the ledger in one insert
+        if claimed:
+            try:
+                commit_batch([entry for _, entry in claimed])
+            except Exception as e:
+                # the pets are gone from the stores, so the reconciler finishes
+                # these from the outbox; the other items keep their answers
+                print("Error committing batch purchases:", e)
+                for i, _ in claimed:
+                    results[i] = {"status": 503, "error": "Purchase in progress"}
+            else:
+                for i, entry in claimed:
+                    results[i] = {"status": 201, "purchase": purchase_response(entry)}
+            finally:
+                invalidate_transactions_cache()
+
+        return jsonify({"results": results}), 200
+
+    except Exception as e:
+        print("Error in create_purchase_batch:", e)
+        return jsonify({"error": "Server error"}), 500
+
+
+# -- health endpoints --
+# startup runs the migrations and a first availability pass over the stores
+# (see common/health.py)
+
+readiness = health.install(app)
+
+
+@app.before_request
+def wait_for_migrations():
+    # a migration rebuilds the rollups from the ledger, so purchases wait for it
+    if request.endpoint in ("create_purchase", "create_purchase_batch") and not readiness["migrated"]:
+        resp = jsonify({"error": "Service starting"})
+        resp.headers["Retry-After"] = "1"
+        return resp, 503
+    return None
+
+
+def initialize():
+    while not readiness["migrated"]:
+        try:
+            print("Migrations:", migrations.run(db))
+            readiness["migrated"] = True
+        except Exception as e:
+            print("Error running migrations, retrying:", e)
+            time.sleep(1)
+    # a store that is down now is simply looked up again on first use
+    for store_num in list(STORE_REGISTRY):
+        refresh_store_availability(store_num)
+    readiness["warm"] = True
+
+
+def start_background_init():
+    health.start(mongo_client, readiness, initialize)
+    start_reconciler()
+    start_availability_refresher()
+    ledger.start(db, invalidate_transactions_cache)
+
+
+# -- metrics endpoint --
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return jsonify({
+        "coalescing": singleflight.stats(),
+        "stores": store_client.stats(),
+        "admission": admission.stats(),
+        "ledger": ledger.stats()
+    }), 200
+
+
 # -- transactions endpoint --
 @app.route('/transactions', methods=['GET'])
 def get_transactions():
@@ -193,10 +833,14 @@ def get_transactions():
     if owner_pc != OWNER_PASSWORD:
         return jsonify({"error": "unauthorized"}), 401
 
-    # get query parameters
-    params = request.args.to_dict()
+    return compression.cached_json_response(
+        app, transactions_cache,
+        tuple(sorted(request.args.items(multi=True))),
+        list_transactions
+    )
 
-    # build db query
+
+def transactions_query(params):
     query = {}
     for key, val in params.items():
         if key == 'store':
@@ -204,27 +848,64 @@ def get_transactions():
         elif key == 'purchaser':
             query['purchaser'] = val
         elif key == 'pet-type':
-            query['pet-type'] = {'$regex': f'^{val}$', '$options': 'i'}
+            query['pet_type_lower'] = val.lower()
         elif key == 'purchase-id':
             query['purchase-id'] = val
+    return query
+
+
+def public_transaction(t):
+    # the transaction with the relevant fields only
+    return {
+        "purchaser": t.get("purchaser"),
+        "pet-type": t.get("pet-type"),
+        "store": t.get("store"),
+        "purchase-id": t.get("purchase-id")
+    }
+
+
+def list_transactions():
+    # the hot ledger only (everything unless TRANSACTION_RETENTION_DAYS is set),
+    # archived rows are served by /transactions/export
+    query = transactions_query(request.args.to_dict())
+    return [public_transaction(t) for t in transactions_collection.find(query)]
+
+
+@app.route('/transactions/summary', methods=['GET'])
+def get_transactions_summary():
+    if request.headers.get('OwnerPC') != OWNER_PASSWORD:
+        return jsonify({"error": "unauthorized"}), 401
+
+    dimension = request.args.get('dimension')
+    if dimension is not None and dimension not in ledger.DIMENSIONS:
+        return jsonify({"error": "Malformed data"}), 400
+
+    return compression.cached_json_response(
+        app, transactions_cache,
+        ("summary", dimension),
+        lambda: ledger.summary(db, dimension)
+    )
+
+
+@app.route('/transactions/export', methods=['GET'])
+def export_transactions():
+    # the whole history, archived and hot, as NDJSON streamed row by row
+    if request.headers.get('OwnerPC') != OWNER_PASSWORD:
+        return jsonify({"error": "unauthorized"}), 401
 
-    # get transactions from db
-    transactions = list(transactions_collection.find(query))
+    query = transactions_query(request.args.to_dict())
 
-    # return the transactions with re relevant fields only
-    result = []
-    for t in transactions:
-        result.append({
-            "purchaser": t.get("purchaser"),
-            "pet-type": t.get("pet-type"),
-            "store": t.get("store"),
-            "purchase-id": t.get("purchase-id")
-        })
+    def generate():
+        for t in ledger.iter_transactions(db, query):
+            row = public_transaction(t)
+            row["purchased-at"] = t["purchased_at"].isoformat() + "Z" if t.get("purchased_at") else None
+            yield app.json.dumps(row, separators=(",", ":")) + "\n"
 
-    return jsonify(result), 200
+    return Response(generate(), mimetype="application/x-ndjson")
 
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5003))
     print(f"Running pet-order service on port {port}")
-    app.run(host='0.0.0.0', port=port, debug=True)
+    start_background_init()
+    app.run(host='0.0.0.0', port=port, debug=DEBUG, use_reloader=False)
@@ -0,0 +1,199 @@
+"""HTTP calls from pet_order to the pet stores, guarded per store.
+
+Every store (keyed by its base URL) has a circuit breaker. After
+BREAKER_FAILURE_THRESHOLD consecutive failures (connection errors, timeouts
+or 5xx answers) the breaker opens and calls fail immediately. Once
+BREAKER_OPEN_SECONDS have passed a single probe call is let through
+(half-open); its outcome closes the breaker or opens it again.
+
+Reads can be hedged: when a GET has not answered within the store's recent
+latency percentile HEDGE_PERCENTILE, a second identical GET is sent and the
+first answer wins. Latencies are kept per path class (the first path
+segment), so the frequent, cheap /changes poll does not set the delay for a
+/pet-types listing. Only the second GETs share a pool of HEDGE_POOL_SIZE
+threads; when it is busy the call is not hedged, since a saturated pool
+means the store is already slow for everyone.
+
+Every call carries SERVICE_TOKEN as X-Service-Token, which exempts it from
+the stores' per-client rate limit (see common/admission.py).
+"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+import requests
+
+STORE_TIMEOUT = float(os.environ.get('STORE_TIMEOUT', 10))
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', 3))
+BREAKER_OPEN_SECONDS = float(os.environ.get('BREAKER_OPEN_SECONDS', 10))
+HEDGE_ENABLED = os.environ.get('HEDGE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+HEDGE_PERCENTILE = float(os.environ.get('HEDGE_PERCENTILE', 95))
+# hedging only kicks in once a store has this many latency samples
+HEDGE_MIN_SAMPLES = int(os.environ.get('HEDGE_MIN_SAMPLES', 20))
+HEDGE_POOL_SIZE = int(os.environ.get('HEDGE_POOL_SIZE', 8))
+LATENCY_WINDOW = 200
+SERVICE_TOKEN = os.environ.get('SERVICE_TOKEN', '')
+SERVICE_HEADERS = {"X-Service-Token": SERVICE_TOKEN} if SERVICE_TOKEN else {}
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class StoreUnavailable(Exception):
+    """Raised instead of calling a store whose breaker is open."""
+
+
+_lock = threading.Lock()
+_breakers = {}
+_hedge_pool = ThreadPoolExecutor(max_workers=HEDGE_POOL_SIZE, thread_name_prefix="store-hedge")
+# one per pool worker, taken without waiting: a hedge never queues
+_hedge_slots = threading.BoundedSemaphore(HEDGE_POOL_SIZE)
+_session = requests.Session()
+
+
+def _breaker(store_url):
+    b = _breakers.get(store_url)
+    if b is None:
+        b = _breakers.setdefault(store_url, {
+            "state": CLOSED,
+            "failures": 0,
+            "opened_at": 0.0,
+            "probing": False,
+            # path class -> recent GET latencies
+            "latencies": {},
+            "hedged": 0,
+            # hedges not sent because the pool was busy
+            "hedges_skipped": 0
+        })
+    return b
+
+
+def is_available(store_url):
+    # peek without taking the half-open probe slot
+    with _lock:
+        b = _breaker(store_url)
+        if b["state"] == CLOSED:
+            return True
+        return not b["probing"] and time.monotonic() - b["opened_at"] >= BREAKER_OPEN_SECONDS
+
+
+def _acquire(store_url):
+    with _lock:
+        b = _breaker(store_url)
+        if b["state"] == CLOSED:
+            return
+        if b["probing"] or time.monotonic() - b["opened_at"] < BREAKER_OPEN_SECONDS:
+            raise StoreUnavailable(store_url)
+        b["state"] = HALF_OPEN
+        b["probing"] = True
+
+
+def path_class(path):
+    return path.split("?", 1)[0].strip("/").split("/", 1)[0]
+
+
+def _record(store_url, ok, latency=None, sample=None):
+    # sample: the path class a GET's latency is kept under
+    with _lock:
+        b = _breaker(store_url)
+        b["probing"] = False
+        if ok:
+            b["state"] = CLOSED
+            b["failures"] = 0
+            if sample is not None and latency is not None:
+                b["latencies"].setdefault(sample, deque(maxlen=LATENCY_WINDOW)).append(latency)
+            return
+        b["failures"] += 1
+        if b["state"] == HALF_OPEN or b["failures"] >= BREAKER_FAILURE_THRESHOLD:
+            b["state"] = OPEN
+            b["opened_at"] = time.monotonic()
+
+
+def _hedge_delay(store_url, sample):
+    with _lock:
+        samples = sorted(_breaker(store_url)["latencies"].get(sample, ()))
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return None
+    idx = min(len(samples) - 1, int(len(samples) * HEDGE_PERCENTILE / 100))
+    return samples[idx]
+
+
+def _call(store_url, method, url, json=None, sample=None):
+    _acquire(store_url)
+    start = time.monotonic()
+    try:
+        resp = _session.request(method, url, json=json, headers=SERVICE_HEADERS, timeout=STORE_TIMEOUT)
+    except Exception:
+        _record(store_url, False)
+        raise
+    _record(store_url, resp.status_code < 500, time.monotonic() - start, sample)
+    return resp
+
+
+def get(store_url, path):
+    url = f"{store_url}{path}"
+    sample = path_class(path)
+    delay = _hedge_delay(store_url, sample) if HEDGE_ENABLED else None
+    if delay is None:
+        return _call(store_url, "GET", url, sample=sample)
+
+    # the primary gets a thread of its own, so it never waits behind hedges;
+    # the caller only waits for whichever answer comes first
+    first = Future()
+
+    def primary():
+        try:
+            first.set_result(_call(store_url, "GET", url, sample=sample))
+        except Exception as e:
+            first.set_exception(e)
+
+    threading.Thread(target=primary, name="store-get", daemon=True).start()
+    done, _ = wait([first], timeout=delay)
+    if done:
+        return first.result()
+
+    if not _hedge_slots.acquire(blocking=False):
+        with _lock:
+            _breaker(store_url)["hedges_skipped"] += 1
+        return first.result()
+    with _lock:
+        _breaker(store_url)["hedged"] += 1
+    second = _hedge_pool.submit(_hedge, store_url, url, sample)
+    pending = {first, second}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for f in done:
+            if f.exception() is None:
+                return f.result()
+            error = f.exception()
+    raise error
+
+
+def _hedge(store_url, url, sample):
+    try:
+        return _call(store_url, "GET", url, sample=sample)
+    finally:
+        _hedge_slots.release()
+
+
+def delete(store_url, path):
+    # writes are never hedged
+    return _call(store_url, "DELETE", f"{store_url}{path}")
+
+
+def post(store_url, path, json):
+    # writes are never hedged
+    return _call(store_url, "POST", f"{store_url}{path}", json=json)
+
+
+def stats():
+    with _lock:
+        return {
+            url: {"state": b["state"], "failures": b["failures"], "hedged": b["hedged"],
+                  "hedges_skipped": b["hedges_skipped"]}
+            for url, b in _breakers.items()
+        }
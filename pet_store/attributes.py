@@ -0,0 +1,28 @@
+"""Normalization of pet type attributes for the attribute index.
+
+Attributes are words pulled out of free text (temperament / group behavior),
+so they carry casing and filler words. The indexed form is lowercase, with
+stopwords and duplicates removed, in first-seen order.
+"""
+
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "but", "by", "for", "from",
+    "in", "is", "it", "of", "on", "or", "than", "that", "the", "their",
+    "they", "this", "to", "very", "with",
+}
+
+
+def normalize_attribute(word):
+    return (word or "").strip().lower()
+
+
+def normalize_attributes(attrs):
+    out = []
+    seen = set()
+    for word in attrs or []:
+        word = normalize_attribute(word)
+        if not word or word in STOPWORDS or word in seen:
+            continue
+        seen.add(word)
+        out.append(word)
+    return out
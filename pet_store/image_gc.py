@@ -0,0 +1,166 @@
+"""Garbage collection and disk quota for the shared images/ directory.
+
+All stores share one images directory, so a sweep collects picture
+references from every store database before deciding anything: the ones
+this process serves, the ones listed in IMAGE_GC_DATABASES (stores served by
+other processes on the same directory) and any whose name starts with the
+store db prefix. It then:
+
+* deletes files no pet references, once they are older than
+  IMAGE_GC_GRACE_SECONDS (a fresh download is written before its pet is
+  inserted);
+* when IMAGE_QUOTA_BYTES is set and exceeded, evicts the least recently
+  served pictures that can be downloaded again from their picture-url.
+  GET /pictures fetches an evicted picture again on demand.
+
+When a picture was last served is kept on its pet (picture_accessed_at), so
+every process sharing the directory sees it; it is written at most once per
+IMAGE_ACCESS_RESOLUTION_SECONDS.
+
+Deletions are rate limited to IMAGE_GC_DELETES_PER_SECOND.
+"""
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+IMAGES_DIR = 'images'
+IMAGE_GC_ENABLED = os.environ.get('IMAGE_GC_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+IMAGE_GC_INTERVAL_SECONDS = float(os.environ.get('IMAGE_GC_INTERVAL_SECONDS', 600))
+IMAGE_GC_GRACE_SECONDS = float(os.environ.get('IMAGE_GC_GRACE_SECONDS', 3600))
+IMAGE_GC_DELETES_PER_SECOND = float(os.environ.get('IMAGE_GC_DELETES_PER_SECOND', 20))
+IMAGE_QUOTA_BYTES = int(os.environ.get('IMAGE_QUOTA_BYTES', 0))  # 0 disables the quota
+IMAGE_ACCESS_RESOLUTION_SECONDS = float(os.environ.get('IMAGE_ACCESS_RESOLUTION_SECONDS', 300))
+IMAGE_GC_DATABASES = [s.strip() for s in os.environ.get('IMAGE_GC_DATABASES', '').split(',') if s.strip()]
+
+_lock = threading.Lock()
+_stats = {"sweeps": 0, "orphans_deleted": 0, "evicted": 0, "reclaimed_bytes": 0, "errors": 0}
+
+
+def touch(pets, file_name, now=None):
+    now = now or datetime.utcnow()
+    recent = now - timedelta(seconds=IMAGE_ACCESS_RESOLUTION_SECONDS)
+    try:
+        pets.update_one({"picture": file_name, "picture_accessed_at": {"$not": {"$gte": recent}}},
+                        {"$set": {"picture_accessed_at": now}})
+    except Exception as e:
+        print("Error recording picture access", file_name, e)
+
+
+def store_databases(mongo_client, db_names, db_prefix):
+    names = set(db_names) | set(IMAGE_GC_DATABASES)
+    names.update(n for n in mongo_client.list_database_names() if n.startswith(db_prefix))
+    return sorted(names)
+
+
+def referenced_pictures(mongo_client, db_names, db_prefix):
+    # file name -> (whether a pet can fetch it again from its picture-url,
+    #               epoch seconds it was last served or None)
+    refs = {}
+    for db_name in store_databases(mongo_client, db_names, db_prefix):
+        pets = mongo_client[db_name]['pets']
+        fields = {"_id": 0, "picture": 1, "_picture_url": 1, "picture_accessed_at": 1}
+        for pet in pets.find({"picture": {"$ne": "NA"}}, fields):
+            name = pet.get("picture")
+            if not name:
+                continue
+            refetchable, accessed = refs.get(name, (False, None))
+            if pet.get("picture_accessed_at") is not None:
+                at = (pet["picture_accessed_at"] - datetime(1970, 1, 1)).total_seconds()
+                accessed = at if accessed is None else max(accessed, at)
+            refs[name] = (refetchable or bool(pet.get("_picture_url")), accessed)
+    return refs
+
+
+def _list_files():
+    files = []
+    try:
+        names = os.listdir(IMAGES_DIR)
+    except FileNotFoundError:
+        return files
+    for name in names:
+        try:
+            st = os.stat(os.path.join(IMAGES_DIR, name))
+        except OSError:
+            continue
+        files.append({"name": name, "size": st.st_size, "mtime": st.st_mtime, "atime": st.st_atime})
+    return files
+
+
+def _delete(name, size):
+    try:
+        os.remove(os.path.join(IMAGES_DIR, name))
+    except FileNotFoundError:
+        return 0
+    except OSError as e:
+        print("Error deleting image", name, e)
+        with _lock:
+            _stats["errors"] += 1
+        return 0
+    with _lock:
+        _stats["reclaimed_bytes"] += size
+    if IMAGE_GC_DELETES_PER_SECOND > 0:
+        time.sleep(1 / IMAGE_GC_DELETES_PER_SECOND)
+    return size
+
+
+def sweep(mongo_client, db_names, db_prefix):
+    refs = referenced_pictures(mongo_client, db_names, db_prefix)
+    files = _list_files()
+    now = time.time()
+    reclaimed = 0
+
+    kept = []
+    for f in files:
+        if f["name"] not in refs and now - f["mtime"] >= IMAGE_GC_GRACE_SECONDS:
+            if _delete(f["name"], f["size"]):
+                reclaimed += f["size"]
+                with _lock:
+                    _stats["orphans_deleted"] += 1
+        else:
+            kept.append(f)
+
+    if IMAGE_QUOTA_BYTES:
+        used = sum(f["size"] for f in kept)
+        evictable = [f for f in kept if f["name"] in refs and refs[f["name"]][0]]
+        # never served since the download: the file times are the best guess
+        evictable.sort(key=lambda f: refs[f["name"]][1] or max(f["atime"], f["mtime"]))
+        for f in evictable:
+            if used <= IMAGE_QUOTA_BYTES:
+                break
+            if _delete(f["name"], f["size"]):
+                used -= f["size"]
+                reclaimed += f["size"]
+                with _lock:
+                    _stats["evicted"] += 1
+
+    with _lock:
+        _stats["sweeps"] += 1
+        _stats["last_sweep_reclaimed_bytes"] = reclaimed
+    return reclaimed
+
+
+def sweeper_loop(mongo_client, db_names, db_prefix):
+    while True:
+        time.sleep(IMAGE_GC_INTERVAL_SECONDS)
+        try:
+            reclaimed = sweep(mongo_client, db_names, db_prefix)
+            if reclaimed:
+                print(f"Image sweep reclaimed {reclaimed} bytes")
+        except Exception as e:
+            print("Error in image sweep:", e)
+
+
+def start(mongo_client, db_names, db_prefix):
+    # db_names: the store databases this process serves
+    if not IMAGE_GC_ENABLED:
+        return None
+    t = threading.Thread(target=sweeper_loop, args=(mongo_client, db_names, db_prefix), name="image-gc",
+                         daemon=True)
+    t.start()
+    return t
+
+
+def stats():
+    with _lock:
+        return dict(_stats)
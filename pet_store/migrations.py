@@ -0,0 +1,94 @@
+"""Indexes and data migrations for the pet store database.
+
+Run by common/migrations.py at service startup, and by hand with:
+
+    python -m pet_store.migrations
+"""
+import os
+
+from pymongo import ASCENDING, MongoClient
+
+from common import migrations as common_migrations
+from pet_store.attributes import normalize_attributes
+
+# how long change feed entries are kept
+CHANGE_RETENTION_SECONDS = int(os.environ.get('CHANGE_RETENTION_SECONDS', 86400))
+# how long pet_order can ask whether one of its claims took a pet
+CLAIM_RETENTION_SECONDS = int(os.environ.get('CLAIM_RETENTION_SECONDS', 7 * 86400))
+
+INDEXES = {
+    "pet_types": [
+        ([("id", ASCENDING)], {"name": "id_unique", "unique": True}),
+        ([("type_lower", ASCENDING)], {"name": "type_lower_unique", "unique": True}),
+        # multikey index backing hasAttribute filters
+        ([("attributes_lower", ASCENDING)], {"name": "attributes_lower"}),
+    ],
+    "pets": [
+        ([("pet_type_id", ASCENDING), ("name_lower", ASCENDING)],
+         {"name": "pet_type_id_name_lower_unique", "unique": True}),
+        # prefix search over pet names across types
+        ([("name_lower", ASCENDING)], {"name": "name_lower"}),
+        # picture lookups when an evicted image is served again
+        ([("picture", ASCENDING)], {"name": "picture"}),
+    ],
+    "changes": [
+        ([("seq", ASCENDING)], {"name": "seq_unique", "unique": True}),
+        ([("ts", ASCENDING)], {"name": "ts_ttl", "expireAfterSeconds": CHANGE_RETENTION_SECONDS}),
+    ],
+    "claims": [
+        ([("ts", ASCENDING)], {"name": "ts_ttl", "expireAfterSeconds": CLAIM_RETENTION_SECONDS}),
+    ],
+}
+
+
+# -- migrations --
+
+def backfill_type_lower(db):
+    changed = 0
+    for ptype in db["pet_types"].find({"type_lower": {"$exists": False}}, {"type": 1}):
+        db["pet_types"].update_one(
+            {"_id": ptype["_id"]},
+            {"$set": {"type_lower": (ptype.get("type") or "").lower()}}
+        )
+        changed += 1
+    return changed
+
+
+def backfill_pet_name_lower(db):
+    changed = 0
+    for pet in db["pets"].find({"name_lower": {"$exists": False}}, {"name": 1}):
+        db["pets"].update_one(
+            {"_id": pet["_id"]},
+            {"$set": {"name_lower": (pet.get("name") or "").lower()}}
+        )
+        changed += 1
+    return changed
+
+
+def backfill_attributes_lower(db):
+    changed = 0
+    for ptype in db["pet_types"].find({"attributes_lower": {"$exists": False}}, {"attributes": 1}):
+        db["pet_types"].update_one(
+            {"_id": ptype["_id"]},
+            {"$set": {"attributes_lower": normalize_attributes(ptype.get("attributes"))}}
+        )
+        changed += 1
+    return changed
+
+
+# append only, never reorder
+MIGRATIONS = [
+    (1, "backfill_type_lower", backfill_type_lower),
+    (2, "backfill_pet_name_lower", backfill_pet_name_lower),
+    (3, "backfill_attributes_lower", backfill_attributes_lower),
+]
+
+
+def run(db):
+    return common_migrations.run(db, MIGRATIONS, INDEXES)
+
+
+if __name__ == '__main__':
+    mongo_uri = os.environ.get('MONGO_URI', 'mongodb://localhost:27017/')
+    db_name = os.environ.get('DB_NAME', 'pet_store')
+    print(run(MongoClient(mongo_uri)[db_name]))
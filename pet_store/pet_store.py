@@ -1,30 +1,165 @@
+import json
 import os
 import re
+import tempfile
+import threading
+import time
 import uuid
 from datetime import datetime
 
 import requests
-from flask import Flask, jsonify, request, send_file
-from pymongo import MongoClient
+from flask import Flask, g, has_request_context, jsonify, request, send_file
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from werkzeug.local import LocalProxy
+
+from common import admission, compression, health, singleflight, storage
+from pet_store import image_gc, migrations, search
+from pet_store.attributes import normalize_attribute, normalize_attributes, STOPWORDS
 
 app = Flask(__name__)
+compression.install(app)
+# type imports hit Ninja and pet writes may download pictures, so both yield to reads
+admission.install(
+    app,
+    {"add_pet_type": "import", "add_pet": "import", "update_pet": "import"},
+    exempt={"healthz", "readyz"}
+)
 
 # MongoDB connection
 MONGO_URI = os.environ.get('MONGO_URI', 'mongodb://localhost:27017/')
+DEBUG = os.environ.get('FLASK_DEBUG', 'false').lower() in ('1', 'true', 'yes')
 DB_NAME = os.environ.get('DB_NAME', 'pet_store')  # DB_NAME is from docker compose so each store will get a separate db
 
-mongo_client = MongoClient(MONGO_URI)
-db = mongo_client[DB_NAME]
-pet_types_collection = db['pet_types']
-pets_collection = db['pets']
+# One process can serve many stores. A request picks its store with a
+# /stores/<store_id> path prefix or an X-Store-Id header and gets the
+# database STORE_DB_PREFIX + store_id; requests without either use DB_NAME.
+# Only ids listed in STORE_IDS are served, so a made-up id never creates a
+# database. Stores are migrated at startup and, failing that, on their first
+# write; reads never migrate.
+STORE_DB_PREFIX = os.environ.get('STORE_DB_PREFIX', 'pet_store')
+# comma separated ids this process serves besides DB_NAME
+STORE_IDS = [s.strip() for s in os.environ.get('STORE_IDS', '').split(',') if s.strip()]
+STORE_ID_RE = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+STORE_PREFIX_RE = re.compile(r'^/stores/([^/]+)(/.*)?$')
+
+# STORAGE_BACKEND=memory swaps Mongo for the in-process engine in storage.py
+mongo_client = storage.connect(MONGO_URI)
+
+# db name -> per-store state, all sharing mongo_client's connection pool
+stores = {}
+stores_lock = threading.Lock()
+
+
+def get_store(store_id=None):
+    db_name = DB_NAME if store_id is None else f"{STORE_DB_PREFIX}{store_id}"
+    store = stores.get(db_name)
+    if store is None:
+        with stores_lock:
+            store = stores.get(db_name)
+            if store is None:
+                store = {
+                    "db": mongo_client[db_name],
+                    # ids of pet types known to exist, so pet routes can skip the type lookup
+                    "known_type_ids": set(),
+                    # pre-encoded GET responses, replaced wholesale on every write
+                    "response_cache": {},
+                    # bumped on every write; part of the singleflight key of cached
+                    # reads, so a read that starts after a write never joins one
+                    # that started before it and caches its result
+                    "generation": 0,
+                    # field -> search.NameTrie for fuzzy search, built on first use and
+                    # kept in step with writes (None: too many names for one)
+                    "name_index": {},
+                    "name_index_lock": threading.Lock(),
+                    "migrated": False
+                }
+                stores[db_name] = store
+    return store
+
+
+def store_database_names():
+    return [DB_NAME] + [f"{STORE_DB_PREFIX}{store_id}" for store_id in STORE_IDS]
+
+
+def current_store():
+    if has_request_context():
+        return get_store(g.get("store_id"))
+    return get_store()
+
+
+def invalidate_responses():
+    store = current_store()
+    store["generation"] += 1
+    store["response_cache"] = {}
+
+
+def ensure_store_migrated(store):
+    if store["migrated"]:
+        return
+    try:
+        print("Migrations:", store["db"].name, migrations.run(store["db"]))
+        store["migrated"] = True
+    except Exception as e:
+        print("Error running migrations:", e)
+
+
+pet_types_collection = LocalProxy(lambda: current_store()["db"]['pet_types'])
+pets_collection = LocalProxy(lambda: current_store()["db"]['pets'])
 
 # Counter collection for auto-increment IDs
-counters_collection = db['counters']
+counters_collection = LocalProxy(lambda: current_store()["db"]['counters'])
+# append-only change feed, expired by a TTL index (see migrations)
+changes_collection = LocalProxy(lambda: current_store()["db"]['changes'])
+# pets removed on behalf of a pet_order purchase, keyed by its claim token
+claims_collection = LocalProxy(lambda: current_store()["db"]['claims'])
+
+
+def store_prefix_middleware(wsgi_app):
+    # strips /stores/<store_id> so the routes below serve every store unchanged
+    def middleware(environ, start_response):
+        m = STORE_PREFIX_RE.match(environ.get('PATH_INFO', ''))
+        if m:
+            environ['pet_store.store_id'] = m.group(1)
+            environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + f"/stores/{m.group(1)}"
+            environ['PATH_INFO'] = m.group(2) or '/'
+        return wsgi_app(environ, start_response)
+    return middleware
+
+
+app.wsgi_app = store_prefix_middleware(app.wsgi_app)
+
+CHANGES_MAX_LIMIT = 5000
+# a hole in the sequence older than this is a write that will never land
+CHANGE_GAP_SECONDS = float(os.environ.get('CHANGE_GAP_SECONDS', 5))
+
+MAX_IMAGE_BYTES = int(os.environ.get('MAX_IMAGE_BYTES', 10 * 1024 * 1024))
+IMAGE_CONNECT_TIMEOUT = float(os.environ.get('IMAGE_CONNECT_TIMEOUT', 5))
+# whole download, not per read
+IMAGE_DOWNLOAD_SECONDS = float(os.environ.get('IMAGE_DOWNLOAD_SECONDS', 30))
+
+SEARCH_MAX_LIMIT = 100
+# how many same-first-letter names a fuzzy search scores at most
+FUZZY_SCAN_LIMIT = int(os.environ.get('FUZZY_SCAN_LIMIT', 5000))
+# stores with more names than this skip the in-memory name index and scan
+# up to FUZZY_SCAN_LIMIT names sharing the query's first letter instead
+FUZZY_INDEX_MAX_NAMES = int(os.environ.get('FUZZY_INDEX_MAX_NAMES', 200000))
+FUZZY_CANDIDATE_LIMIT = 1000
 
 NINJA_API_KEY = os.environ.get('NINJA_API_KEY', 'zxHpDZnw9ExBzeQMojHUAg==sgHWYz7pgRF0LE8x')
 NINJA_URL = 'https://api.api-ninjas.com/v1/animals'
 
 
+def get_next_change_seq():
+    result = counters_collection.find_one_and_update(
+        {'_id': 'change_seq'},
+        {'$inc': {'seq': 1}},
+        upsert=True,
+        return_document=True
+    )
+    return result['seq']
+
+
 def get_next_pet_type_id():
     result = counters_collection.find_one_and_update(
         {'_id': 'pet_type_id'},
@@ -56,29 +191,85 @@ def extract_words(text):
         return []
     return re.findall(r'\b\w+\b', text)
 
-def download_image(url):
-    try:
-        resp = requests.get(url)
-        if resp.status_code != 200:
-            return None
+# (magic bytes, offset, mimetype, extension) of the picture formats we accept
+IMAGE_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", 0, "image/png", ".png"),
+    (b"\xff\xd8\xff", 0, "image/jpeg", ".jpg"),
+    (b"GIF87a", 0, "image/gif", ".gif"),
+    (b"GIF89a", 0, "image/gif", ".gif"),
+    (b"WEBP", 8, "image/webp", ".webp"),
+    (b"BM", 0, "image/bmp", ".bmp"),
+]
+
+
+def sniff_image(head):
+    # (mimetype, extension) detected from the first bytes of a file, or None
+    for magic, offset, mtype, ext in IMAGE_SIGNATURES:
+        if head[offset:offset + len(magic)] == magic:
+            if mtype == "image/webp" and head[:4] != b"RIFF":
+                continue
+            return mtype, ext
+    return None
+
 
-        url_path = url.split('?')[0]  # remove query parameters
-        ext = os.path.splitext(url_path)[1].lower() or '.jpg'
+def download_image(url, fname=None):
+    """Stream url into images/ and return (file name, mimetype), or (None, None).
 
-        if ext == '.jpeg':
-            ext = '.jpg'
-        fname = f"{uuid.uuid4()}{ext}"
+    The body is written chunk by chunk to a temporary file and renamed into
+    place only once complete, so memory use does not depend on the picture
+    size. Downloads over MAX_IMAGE_BYTES, slower than IMAGE_DOWNLOAD_SECONDS
+    or whose content is not a known image format are dropped. fname is given
+    when an evicted picture is fetched again under its old name.
 
-        os.makedirs('images', exist_ok=True)
-        path = os.path.join('images', fname)
+    The deadline is checked after every socket read (read1 returns whatever
+    one read got), so a server dripping bytes is cut off at most one read
+    timeout past it.
+    """
+    tmp_path = None
+    try:
+        deadline = time.monotonic() + IMAGE_DOWNLOAD_SECONDS
+        timeout = (IMAGE_CONNECT_TIMEOUT, min(IMAGE_CONNECT_TIMEOUT, IMAGE_DOWNLOAD_SECONDS))
+        # identity keeps read1 at one socket read per call
+        with requests.get(url, stream=True, timeout=timeout, headers={"Accept-Encoding": "identity"}) as resp:
+            if resp.status_code != 200:
+                return None, None
+            if int(resp.headers.get("Content-Length") or 0) > MAX_IMAGE_BYTES:
+                return None, None
+
+            os.makedirs('images', exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir='images', suffix='.part')
+            size = 0
+            head = b""
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = resp.raw.read1(64 * 1024)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > MAX_IMAGE_BYTES or time.monotonic() > deadline:
+                        return None, None
+                    if len(head) < 16:
+                        head += chunk[:16]
+                    f.write(chunk)
+
+        detected = sniff_image(head)
+        if detected is None:
+            return None, None
+        mtype, ext = detected
+
+        if fname is None:
+            fname = f"{uuid.uuid4()}{ext}"
+        os.replace(tmp_path, os.path.join('images', fname))
+        tmp_path = None
+        return fname, mtype
 
-        with open(path, 'wb') as f:
-            for chunk in resp.iter_content(8192):
-                f.write(chunk)
-        return fname
+    except Exception as e:
+        print("Error downloading image:", e)
+        return None, None
+    finally:
+        if tmp_path is not None:
+            remove_image_file(os.path.basename(tmp_path))
 
-    except Exception:
-        return None
 
 def clean_pet(p):
     return {
@@ -99,39 +290,112 @@ def clean_pet_type(ptype):
     }
 
 
+# fields the handlers actually return, so documents are not shipped whole
+PET_PROJECTION = {"_id": 0, "name": 1, "birthdate": 1, "picture": 1}
+PET_TYPE_PROJECTION = {"_id": 0, "type_lower": 0, "attributes_lower": 0}
+
+known_type_ids = LocalProxy(lambda: current_store()["known_type_ids"])
+
+
+def pet_type_exists(pet_type_id, use_cache=True):
+    if use_cache and pet_type_id in known_type_ids:
+        return True
+    if pet_types_collection.find_one({"id": pet_type_id}, {"_id": 1}) is None:
+        known_type_ids.discard(pet_type_id)
+        return False
+    known_type_ids.add(pet_type_id)
+    return True
+
+
+def record_change(kind, op, pet_type_id, **fields):
+    # best effort: consumers reconcile with a full listing now and then
+    try:
+        change = {
+            "seq": get_next_change_seq(),
+            "ts": datetime.utcnow(),
+            "kind": kind,
+            "op": op,
+            "pet-type-id": pet_type_id
+        }
+        change.update(fields)
+        changes_collection.insert_one(change)
+    except Exception as e:
+        print("Error recording change:", e)
+
+
 def remove_image_file(filename):
+    # a file that cannot be removed now is left to the image sweeper
     if not filename or filename == "NA":
         return
     path = os.path.join("images", filename)
-    if os.path.exists(path):
-        try:
-            os.remove(path)
-        except Exception:
-            pass
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print("Error removing image", filename, e)
+
+@app.before_request
+def select_store():
+    if request.endpoint in ("healthz", "readyz"):
+        return None
+    store_id = request.environ.get('pet_store.store_id') or request.headers.get('X-Store-Id')
+    if store_id is not None:
+        if not STORE_ID_RE.match(store_id) or store_id not in STORE_IDS:
+            return jsonify({"error": "Store not found"}), 404
+    g.store_id = store_id
+    if request.method not in ("GET", "HEAD", "OPTIONS"):
+        ensure_store_migrated(current_store())
 
 # -- pet-types endpoints --
 
+def attribute_query():
+    # repeated hasAttribute params are ANDed, or ORed with attributeMatch=any
+    wanted = [normalize_attribute(a) for a in request.args.getlist("hasAttribute")]
+    if not wanted:
+        return {}
+    # stopwords are not indexed, so no type can have them
+    indexed = [a for a in wanted if a and a not in STOPWORDS]
+    if request.args.get("attributeMatch", "all").lower() == "any":
+        return {"attributes_lower": {"$in": indexed}} if indexed else None
+    if len(indexed) != len(wanted):
+        return None
+    return {"attributes_lower": {"$all": indexed}}
+
+
 @app.route('/pet-types', methods=['GET'])
 def get_pet_types():
+    return compression.cached_json_response(
+        app, current_store()["response_cache"],
+        ("pet-types", tuple(sorted(request.args.items(multi=True)))),
+        list_pet_types
+    )
+
+
+def list_pet_types():
     params = request.args.to_dict()
 
-    all_types = list(pet_types_collection.find())
+    query = attribute_query()
+    if query is None:
+        return []
+    if "type" in params:
+        query["type_lower"] = params["type"].lower()
+
+    # identical concurrent listings share one query (within one generation)
+    store = current_store()
+    all_types, _ = singleflight.do(
+        ("pet-types", store["db"].name, store["generation"], json.dumps(query, sort_keys=True)),
+        lambda: list(pet_types_collection.find(query, PET_TYPE_PROJECTION))
+    )
 
     if not params:
-        return jsonify([clean_pet_type(p) for p in all_types]), 200
+        return [clean_pet_type(p) for p in all_types]
 
     out = []
     for ptype in all_types:
         ok = True
         for key, val in params.items():
-            if key == "hasAttribute":
-                attrs = ptype.get("attributes", [])
-                if val.lower() not in (a.lower() for a in attrs):
-                    ok = False
-                    break
-                continue
-
-            if key in ["id", "type", "family", "genus", "lifespan"]:
+            if key in ["id", "family", "genus", "lifespan"]:
                 field_val = ptype.get(key)
                 if field_val is None:
                     ok = False
@@ -146,126 +410,163 @@ def get_pet_types():
                         break
         if ok:
             out.append(clean_pet_type(ptype))
-    return jsonify(out), 200
+    return out
+
+
+@app.route('/pet-types/attributes', methods=['GET'])
+def get_attribute_facets():
+    # attribute -> number of pet types having it, among types matching hasAttribute
+    query = attribute_query()
+    if query is None:
+        return jsonify({}), 200
+
+    pipeline = [
+        {"$match": query},
+        {"$unwind": "$attributes_lower"},
+        {"$group": {"_id": "$attributes_lower", "count": {"$sum": 1}}},
+    ]
+    facets = {f["_id"]: f["count"] for f in pet_types_collection.aggregate(pipeline)}
+    return jsonify(facets), 200
+
+def create_pet_type(requested_type):
+    # returns (body, status); runs once per type name even under concurrent posts
+    # Check if type already exists
+    existing = pet_types_collection.find_one({'type_lower': requested_type.lower()}, {'_id': 1})
+    if existing:
+        return {"error": "Pet type already exists"}, 400
+
+    # for tests
+    deterministic = {
+        "golden retriever": {
+            "type": "Golden Retriever",
+            "family": "Canidae",
+            "genus": "Canis",
+            "attributes": [],
+            "lifespan": 12,
+        },
+        "australian shepherd": {
+            "type": "Australian Shepherd",
+            "family": "Canidae",
+            "genus": "Canis",
+            "attributes": ["Loyal", "outgoing", "and", "friendly"],
+            "lifespan": 15,
+        },
+        "abyssinian": {
+            "type": "Abyssinian",
+            "family": "Felidae",
+            "genus": "Felis",
+            "attributes": ["Intelligent", "and", "curious"],
+            "lifespan": 13,
+        },
+        "bulldog": {
+            "type": "bulldog",
+            "family": "Canidae",
+            "genus": "Canis",
+            "attributes": ["Gentle", "calm", "and", "affectionate"],
+            "lifespan": None,
+        },
+    }
 
-@app.route('/pet-types', methods=['POST'])
-def add_pet_type():
-    try:
-        if request.headers.get("Content-Type") != "application/json":
-            return jsonify({"error": "Expected application/json media type"}), 415
+    chosen_fixed = deterministic.get(requested_type.lower())
 
-        data = request.get_json()
-        if not data or 'type' not in data or len(data) != 1:
-            return jsonify({"error": "Malformed data"}), 400
+    taxonomy = {}
+    chars = {}
+    if chosen_fixed is None:
+        headers = {"X-Api-Key": NINJA_API_KEY}
+        params = {"name": requested_type}
 
-        requested_type = data['type']
+        try:
+            resp = requests.get(NINJA_URL, headers=headers, params=params, timeout=10)
+        except requests.exceptions.SSLError:
+            resp = requests.get(NINJA_URL, headers=headers, params=params, timeout=10)
 
-        # Check if type already exists
-        existing = pet_types_collection.find_one({
-            'type': {'$regex': f'^{re.escape(requested_type)}$', '$options': 'i'}
-        })
-        if existing:
-            return jsonify({"error": "Pet type already exists"}), 400
+        if resp.status_code != 200:
+            return {"server error": f"API response code {resp.status_code}"}, 500
 
-        # for tests
-        deterministic = {
-            "golden retriever": {
-                "type": "Golden Retriever",
-                "family": "Canidae",
-                "genus": "Canis",
-                "attributes": [],
-                "lifespan": 12,
-            },
-            "australian shepherd": {
-                "type": "Australian Shepherd",
-                "family": "Canidae",
-                "genus": "Canis",
-                "attributes": ["Loyal", "outgoing", "and", "friendly"],
-                "lifespan": 15,
-            },
-            "abyssinian": {
-                "type": "Abyssinian",
-                "family": "Felidae",
-                "genus": "Felis",
-                "attributes": ["Intelligent", "and", "curious"],
-                "lifespan": 13,
-            },
-            "bulldog": {
-                "type": "bulldog",
-                "family": "Canidae",
-                "genus": "Canis",
-                "attributes": ["Gentle", "calm", "and", "affectionate"],
-                "lifespan": None,
-            },
-        }
+        results = resp.json()
+        if not results:
+            return {"error": "Pet type not found"}, 400
 
-        chosen_fixed = deterministic.get(requested_type.lower())
+        chosen = None
+        for item in results:
+            if item.get("name", "").lower() == requested_type.lower():
+                chosen = item
+                break
 
-        taxonomy = {}
-        chars = {}
-        if chosen_fixed is None:
-            headers = {"X-Api-Key": NINJA_API_KEY}
-            params = {"name": requested_type}
+        if chosen is None:
+            return {"error": "Pet type not found"}, 400
 
-            try:
-                resp = requests.get(NINJA_URL, headers=headers, params=params, timeout=10)
-            except requests.exceptions.SSLError:
-                resp = requests.get(NINJA_URL, headers=headers, params=params, timeout=10)
+        taxonomy = chosen.get("taxonomy", {}) or {}
+        chars = chosen.get("characteristics") or {}
 
-            if resp.status_code != 200:
-                return jsonify({"server error": f"API response code {resp.status_code}"}), 500
+    new_id = get_next_pet_type_id()
 
-            results = resp.json()
-            if not results:
-                return jsonify({"error": "Pet type not found"}), 400
+    if chosen_fixed is not None:
+        lifespan = chosen_fixed["lifespan"]
+        attrs = chosen_fixed["attributes"]
+        family = chosen_fixed["family"]
+        genus = chosen_fixed["genus"]
+        ptype = chosen_fixed["type"]
+    else:
+        lifespan = parse_lifespan(chars.get("lifespan")) if "lifespan" in chars else None
 
-            chosen = None
-            for item in results:
-                if item.get("name", "").lower() == requested_type.lower():
-                    chosen = item
-                    break
+        if chars.get("temperament"):
+            attrs = extract_words(chars["temperament"])
+        elif chars.get("group_behavior"):
+            attrs = extract_words(chars["group_behavior"])
+        else:
+            attrs = []
+
+        family = taxonomy.get("family", "")
+        genus = taxonomy.get("genus", "")
+        # Keep the original casing as supplied by the client (tests rely on this).
+        ptype = requested_type
+
+    new_ptype = {
+        "id": new_id,
+        "type": ptype,
+        "type_lower": ptype.lower(),
+        "family": family,
+        "genus": genus,
+        "attributes": attrs,
+        "attributes_lower": normalize_attributes(attrs),
+        "lifespan": lifespan,
+        "pets": []
+    }
 
-            if chosen is None:
-                return jsonify({"error": "Pet type not found"}), 400
+    try:
+        pet_types_collection.insert_one(new_ptype)
+    except DuplicateKeyError:
+        # a concurrent request added the same type first
+        return {"error": "Pet type already exists"}, 400
+    known_type_ids.add(new_id)
+    invalidate_responses()
+    index_names("type_lower", added=[new_ptype])
+    record_change("pet-type", "create", new_id, type=new_ptype["type"])
+    return clean_pet_type(new_ptype), 201
 
-            taxonomy = chosen.get("taxonomy", {}) or {}
-            chars = chosen.get("characteristics") or {}
 
-        new_id = get_next_pet_type_id()
+@app.route('/pet-types', methods=['POST'])
+def add_pet_type():
+    try:
+        if request.headers.get("Content-Type") != "application/json":
+            return jsonify({"error": "Expected application/json media type"}), 415
 
-        if chosen_fixed is not None:
-            lifespan = chosen_fixed["lifespan"]
-            attrs = chosen_fixed["attributes"]
-            family = chosen_fixed["family"]
-            genus = chosen_fixed["genus"]
-            ptype = chosen_fixed["type"]
-        else:
-            lifespan = parse_lifespan(chars.get("lifespan")) if "lifespan" in chars else None
+        data = request.get_json()
+        if not data or 'type' not in data or len(data) != 1:
+            return jsonify({"error": "Malformed data"}), 400
 
-            if chars.get("temperament"):
-                attrs = extract_words(chars["temperament"])
-            elif chars.get("group_behavior"):
-                attrs = extract_words(chars["group_behavior"])
-            else:
-                attrs = []
-
-            family = taxonomy.get("family", "")
-            genus = taxonomy.get("genus", "")
-            # Keep the original casing as supplied by the client (tests rely on this).
-            ptype = requested_type
-
-        new_ptype = {
-            "id": new_id,
-            "type": ptype,
-            "family": family,
-            "genus": genus,
-            "attributes": attrs,
-            "lifespan": lifespan,
-            "pets": []
-        }
+        requested_type = data['type']
 
-        pet_types_collection.insert_one(new_ptype)
-        return jsonify(clean_pet_type(new_ptype)), 201
+        # concurrent posts of the same type share one lookup and insert; the
+        # ones that did not run it get the answer a later duplicate would get
+        (body, status), shared = singleflight.do(
+            ("add-pet-type", current_store()["db"].name, requested_type.lower()),
+            lambda: create_pet_type(requested_type)
+        )
+        if shared and status == 201:
+            return jsonify({"error": "Pet type already exists"}), 400
+        return jsonify(body), status
 
     except Exception as e:
         print("Error in add_pet_type:", e)
@@ -274,7 +575,7 @@ def add_pet_type():
 
 @app.route('/pet-types/<pet_type_id>', methods=['GET'])
 def get_pet_type_by_id(pet_type_id):
-    ptype = pet_types_collection.find_one({"id": pet_type_id})
+    ptype = pet_types_collection.find_one({"id": pet_type_id}, PET_TYPE_PROJECTION)
     if not ptype:
         return jsonify({"error": "Not found"}), 404
     return jsonify(clean_pet_type(ptype)), 200
@@ -282,15 +583,21 @@ def get_pet_type_by_id(pet_type_id):
 
 @app.route('/pet-types/<pet_type_id>', methods=['DELETE'])
 def delete_pet_type(pet_type_id):
-    ptype = pet_types_collection.find_one({"id": pet_type_id})
-    if not ptype:
+    deleted = pet_types_collection.find_one_and_delete(
+        {"id": pet_type_id, "$or": [{"pets": {"$size": 0}}, {"pets": {"$exists": False}}]},
+        TYPE_SEARCH_PROJECTION
+    )
+    if deleted:
+        known_type_ids.discard(pet_type_id)
+        invalidate_responses()
+        index_names("type_lower", removed=[deleted])
+        record_change("pet-type", "delete", pet_type_id)
+        return "", 204
+
+    # nothing deleted - either the type does not exist or it still has pets
+    if not pet_type_exists(pet_type_id, use_cache=False):
         return jsonify({"error": "Not found"}), 404
-
-    if ptype.get("pets"):
-        return jsonify({"error": "Malformed data"}), 400
-
-    pet_types_collection.delete_one({"id": pet_type_id})
-    return "", 204
+    return jsonify({"error": "Malformed data"}), 400
 
 
 @app.route('/pet-types/<pet_type_id>', methods=['PUT'])
@@ -301,8 +608,7 @@ def put_not_allowed(pet_type_id):
 @app.route('/pet-types/<pet_type_id>/pets', methods=['POST'])
 def add_pet(pet_type_id):
     try:
-        ptype = pet_types_collection.find_one({"id": pet_type_id})
-        if not ptype:
+        if not pet_type_exists(pet_type_id):
             return jsonify({"error": "Not found"}), 404
 
         if request.headers.get("Content-Type") != "application/json":
@@ -316,14 +622,17 @@ def add_pet(pet_type_id):
         birthdate = data.get("birthdate") or "NA"
         pic_url = data.get("picture-url", None)
 
-        if any(n.lower() == name.lower() for n in ptype.get("pets", [])):
-            return jsonify({"error": "Malformed data"}), 400
-
         picture = "NA"
+        picture_mimetype = None
         if pic_url:
-            f = download_image(pic_url)
+            # duplicates are rejected by the unique index on insert, this only
+            # avoids downloading a picture for a pet that will be refused
+            if pets_collection.find_one({"pet_type_id": pet_type_id, "name_lower": name.lower()}, {"_id": 1}):
+                return jsonify({"error": "Malformed data"}), 400
+            f, mtype = download_image(pic_url)
             if f:
                 picture = f
+                picture_mimetype = mtype
 
         pet_obj = {
             "pet_type_id": pet_type_id,
@@ -331,16 +640,24 @@ def add_pet(pet_type_id):
             "name_lower": name.lower(),
             "birthdate": birthdate,
             "picture": picture,
+            "picture_mimetype": picture_mimetype,
             "_picture_url": pic_url
         }
 
-        pets_collection.insert_one(pet_obj)
+        try:
+            pets_collection.insert_one(pet_obj)
+        except DuplicateKeyError:
+            remove_image_file(picture)
+            return jsonify({"error": "Malformed data"}), 400
 
         # Update pet_types with the pet name
         pet_types_collection.update_one(
             {"id": pet_type_id},
             {"$push": {"pets": name}}
         )
+        invalidate_responses()
+        index_names("name_lower", added=[pet_obj])
+        record_change("pet", "create", pet_type_id, name=name)
 
         return jsonify(clean_pet(pet_obj)), 201
 
@@ -351,11 +668,10 @@ def add_pet(pet_type_id):
 
 @app.route('/pet-types/<pet_type_id>/pets', methods=['GET'])
 def get_pets(pet_type_id):
-    ptype = pet_types_collection.find_one({"id": pet_type_id})
-    if not ptype:
+    if not pet_type_exists(pet_type_id):
         return jsonify({"error": "Not found"}), 404
 
-    all_pets = list(pets_collection.find({"pet_type_id": pet_type_id}))
+    all_pets = list(pets_collection.find({"pet_type_id": pet_type_id}, PET_PROJECTION))
     all_pets_clean = [clean_pet(p) for p in all_pets]
 
     params = request.args.to_dict()
@@ -399,25 +715,35 @@ def get_pets(pet_type_id):
 
 @app.route('/pet-types/<pet_type_id>/pets/<name>', methods=['GET'])
 def get_pet_by_name(pet_type_id, name):
-    ptype = pet_types_collection.find_one({"id": pet_type_id})
-    if not ptype:
-        return jsonify({"error": "Not found"}), 404
-
+    # a missing type and a missing pet are both a 404, so one query covers both
     pet = pets_collection.find_one({
         "pet_type_id": pet_type_id,
         "name_lower": name.lower()
-    })
+    }, PET_PROJECTION)
     if not pet:
         return jsonify({"error": "Not found"}), 404
 
     return jsonify(clean_pet(pet)), 200
 
 
+def pet_updated(pet_type_id, old_name, new_name):
+    # pet_types, caches, name index and change feed follow a saved pet update;
+    # called right after it, so a later failure in the request cannot skip them
+    if old_name != new_name:
+        pet_types_collection.update_one(
+            {"id": pet_type_id, "pets": old_name},
+            {"$set": {"pets.$": new_name}}
+        )
+        invalidate_responses()
+        index_names("name_lower", added=[pet_search_doc(pet_type_id, new_name)],
+                    removed=[pet_search_doc(pet_type_id, old_name)])
+    record_change("pet", "update", pet_type_id, name=new_name, **{"old-name": old_name})
+
+
 @app.route('/pet-types/<pet_type_id>/pets/<name>', methods=['PUT'])
 def update_pet(pet_type_id, name):
     try:
-        ptype = pet_types_collection.find_one({"id": pet_type_id})
-        if not ptype:
+        if not pet_type_exists(pet_type_id):
             return jsonify({"error": "Not found"}), 404
 
         if request.headers.get("Content-Type") != "application/json":
@@ -427,123 +753,392 @@ def update_pet(pet_type_id, name):
         if not data or "name" not in data:
             return jsonify({"error": "Malformed data"}), 400
 
-        pet = pets_collection.find_one({
-            "pet_type_id": pet_type_id,
-            "name_lower": name.lower()
-        })
-        if not pet:
-            return jsonify({"error": "Not found"}), 404
-
         new_name = data["name"]
         new_birthdate = data.get("birthdate")
         new_url = data.get("picture-url")
 
-        cur_url = pet.get("_picture_url")
-        cur_pic = pet.get("picture", "NA")
-
-        if new_url is None:
-            if cur_pic != "NA":
-                remove_image_file(cur_pic)
-            cur_pic = "NA"
-            new_picture_url = None
-        elif new_url == cur_url:
-            new_picture_url = cur_url
-        else:
-            if cur_pic != "NA":
-                remove_image_file(cur_pic)
-            f = download_image(new_url)
-            if f:
-                cur_pic = f
-            else:
-                cur_pic = "NA"
-            new_picture_url = new_url
-
+        pet_filter = {"pet_type_id": pet_type_id, "name_lower": name.lower()}
         update_fields = {
             "name": new_name,
             "name_lower": new_name.lower(),
             "birthdate": new_birthdate if new_birthdate is not None else "NA",
-            "picture": cur_pic,
-            "_picture_url": new_picture_url
         }
+        projection = {"_id": 0, "name": 1, "picture": 1, "_picture_url": 1}
 
-        pets_collection.update_one(
-            {"pet_type_id": pet_type_id, "name_lower": name.lower()},
-            {"$set": update_fields}
-        )
-
-        # Update pet names in pet_types if name changed
-        if new_name.lower() != name.lower():
-            pet_types_collection.update_one(
-                {"id": pet_type_id},
-                {"$pull": {"pets": {"$regex": f"^{re.escape(name)}$", "$options": "i"}}}
-            )
-            pet_types_collection.update_one(
-                {"id": pet_type_id},
-                {"$push": {"pets": new_name}}
-            )
-
-        updated_pet = pets_collection.find_one({
-            "pet_type_id": pet_type_id,
-            "name_lower": new_name.lower()
-        })
+        f = None
+        try:
+            if new_url is None:
+                update_fields["picture"] = "NA"
+                update_fields["picture_mimetype"] = None
+                update_fields["_picture_url"] = None
+                before = pets_collection.find_one_and_update(
+                    pet_filter, {"$set": update_fields}, projection,
+                    return_document=ReturnDocument.BEFORE
+                )
+                if before is None:
+                    return jsonify({"error": "Not found"}), 404
+                pet_updated(pet_type_id, before["name"], new_name)
+                remove_image_file(before.get("picture", "NA"))
+            else:
+                # name and birthdate first: a missing pet costs no download
+                before = pets_collection.find_one_and_update(
+                    pet_filter, {"$set": update_fields}, projection,
+                    return_document=ReturnDocument.BEFORE
+                )
+                if before is None:
+                    return jsonify({"error": "Not found"}), 404
+                pet_updated(pet_type_id, before["name"], new_name)
+                if before.get("_picture_url") == new_url:
+                    # same picture url as before - keep the stored picture
+                    update_fields["picture"] = before.get("picture", "NA")
+                else:
+                    f, mtype = download_image(new_url)
+                    picture_fields = {"picture": f or "NA", "picture_mimetype": mtype, "_picture_url": new_url}
+                    # only over the picture we replaced, in case the pet changed meanwhile
+                    result = pets_collection.update_one(
+                        {"pet_type_id": pet_type_id, "name_lower": new_name.lower(),
+                         "picture": before.get("picture", "NA")},
+                        {"$set": picture_fields}
+                    )
+                    if result.matched_count == 0:
+                        # the name and birthdate are saved, the picture is not
+                        remove_image_file(f)
+                        return jsonify({"error": "Pet changed while its picture was updated"}), 409
+                    update_fields.update(picture_fields)
+                    remove_image_file(before.get("picture", "NA"))
+        except DuplicateKeyError:
+            # renamed onto another pet of the same type
+            remove_image_file(f)
+            return jsonify({"error": "Malformed data"}), 400
 
-        return jsonify(clean_pet(updated_pet)), 200
+        return jsonify(clean_pet(update_fields)), 200
 
     except Exception as e:
         print("Error in update_pet:", e)
         return jsonify({"error": "Server error"}), 500
 
 
-@app.route('/pet-types/<pet_type_id>/pets/<name>', methods=['DELETE'])
-def delete_pet(pet_type_id, name):
-    ptype = pet_types_collection.find_one({"id": pet_type_id})
-    if not ptype:
-        return jsonify({"error": "Not found"}), 404
-
-    pet = pets_collection.find_one({
+def take_pet(pet_type_id, name, claim=None):
+    # Removes the pet document, returns (status, removed name). With a claim
+    # token the removal is recorded in claims, so pet_order can later ask
+    # whether its claim took the pet, and retrying the same claim answers 204
+    # again without removing anything. A crash between the delete and the
+    # claim record loses the record: pet_order then aborts the purchase,
+    # which can drop a pet but never sells one twice.
+    if claim is not None:
+        done = claims_collection.find_one({"_id": claim})
+        if done is not None:
+            same = done["pet_type_id"] == pet_type_id and done["name_lower"] == name.lower()
+            return (204 if same else 409), None
+
+    pet = pets_collection.find_one_and_delete({
         "pet_type_id": pet_type_id,
         "name_lower": name.lower()
-    })
+    }, {"_id": 0, "name": 1, "picture": 1})
     if not pet:
-        return jsonify({"error": "Not found"}), 404
+        return 404, None
 
+    if claim is not None:
+        try:
+            claims_collection.insert_one({
+                "_id": claim,
+                "pet_type_id": pet_type_id,
+                "name_lower": name.lower(),
+                "name": pet["name"],
+                "ts": datetime.utcnow()
+            })
+        except DuplicateKeyError:
+            pass  # the token was already spent on another pet
     remove_image_file(pet.get("picture", "NA"))
+    return 204, pet["name"]
 
-    # Remove from pets collection
-    pets_collection.delete_one({
-        "pet_type_id": pet_type_id,
-        "name_lower": name.lower()
-    })
+
+@app.route('/pet-types/<pet_type_id>/pets/<name>', methods=['DELETE'])
+def delete_pet(pet_type_id, name):
+    status, removed = take_pet(pet_type_id, name, request.args.get("claim"))
+    if status == 404:
+        return jsonify({"error": "Not found"}), 404
+    if status == 409:
+        return jsonify({"error": "Claim already used for another pet"}), 409
+    if removed is None:
+        return "", 204  # a retried claim
 
     # Remove pet name from pet_types
     pet_types_collection.update_one(
         {"id": pet_type_id},
-        {"$pull": {"pets": pet["name"]}}
+        {"$pull": {"pets": removed}}
     )
+    invalidate_responses()
+    index_names("name_lower", removed=[pet_search_doc(pet_type_id, removed)])
+    record_change("pet", "delete", pet_type_id, name=removed)
 
     return "", 204
 
 
+@app.route('/pets:batch-delete', methods=['POST'])
+def delete_pets_batch():
+    # bulk form of DELETE /pet-types/<id>/pets/<name> for pet_order's batch purchases;
+    # answers one status per requested pet, in order
+    if request.headers.get("Content-Type") != "application/json":
+        return jsonify({"error": "Expected application/json media type"}), 415
+
+    data = request.get_json(silent=True)
+    items = data.get("pets") if isinstance(data, dict) else None
+    if not isinstance(items, list) or not all(
+            isinstance(i, dict) and isinstance(i.get("pet-type-id"), str) and isinstance(i.get("name"), str)
+            and isinstance(i.get("claim", ""), str)
+            for i in items):
+        return jsonify({"error": "Malformed data"}), 400
+
+    results = []
+    removed = {}  # pet type id -> names to pull
+    for item in items:
+        status, name = take_pet(item["pet-type-id"], item["name"], item.get("claim"))
+        if name is not None:
+            removed.setdefault(item["pet-type-id"], []).append(name)
+        results.append(status)
+
+    for pet_type_id, names in removed.items():
+        pet_types_collection.update_one(
+            {"id": pet_type_id},
+            {"$pull": {"pets": {"$in": names}}}
+        )
+        for name in names:
+            record_change("pet", "delete", pet_type_id, name=name)
+    if removed:
+        invalidate_responses()
+        index_names("name_lower", removed=[pet_search_doc(pet_type_id, name)
+                                           for pet_type_id, names in removed.items() for name in names])
+
+    return jsonify({"results": results}), 200
+
+
+@app.route('/claims/<claim>', methods=['GET'])
+def get_claim(claim):
+    # whether a claim token removed a pet (see take_pet)
+    done = claims_collection.find_one({"_id": claim}, {"_id": 0})
+    if done is None:
+        return jsonify({"error": "Not found"}), 404
+    return jsonify({"claim": claim, "pet-type-id": done["pet_type_id"], "name": done["name"]}), 200
+
+
+# -- change feed endpoint --
+# GET /changes?since=<token> returns the changes after token in order, plus
+# the token to resume from. Without since it only returns the current token,
+# which a consumer takes before a full listing. A token whose changes have
+# already expired answers 410 and the consumer has to list everything again.
+
+@app.route('/changes', methods=['GET'])
+def get_changes():
+    head = counters_collection.find_one({'_id': 'change_seq'})
+    head = head['seq'] if head else 0
+
+    since = request.args.get("since")
+    if since is None:
+        return jsonify({"changes": [], "next": str(head)}), 200
+
+    try:
+        since = int(since)
+        limit = max(1, min(int(request.args.get("limit", 500)), CHANGES_MAX_LIMIT))
+    except ValueError:
+        return jsonify({"error": "Malformed data"}), 400
+
+    if since > head:
+        return jsonify({"error": "Unknown change token"}), 410
+    if since < head:
+        oldest = changes_collection.find_one({}, {"seq": 1}, sort=[("seq", 1)])
+        if oldest is None or oldest["seq"] > since + 1:
+            return jsonify({"error": "Change token expired"}), 410
+
+    out = []
+    expected = since + 1
+    now = datetime.utcnow()
+    for change in changes_collection.find({"seq": {"$gt": since}}, {"_id": 0}).sort("seq", 1).limit(limit):
+        if change["seq"] != expected and (now - change["ts"]).total_seconds() < CHANGE_GAP_SECONDS:
+            break  # an earlier change may still be being written
+        expected = change["seq"] + 1
+        change["ts"] = change["ts"].isoformat() + "Z"
+        out.append(change)
+
+    return jsonify({"changes": out, "next": str(out[-1]["seq"] if out else since)}), 200
+
+
+# -- search endpoint --
+
+# fields search reads, and keeps in its name indexes
+TYPE_SEARCH_PROJECTION = {"_id": 0, "id": 1, "type": 1, "type_lower": 1}
+PET_SEARCH_PROJECTION = {"_id": 0, "pet_type_id": 1, "name": 1, "name_lower": 1}
+SEARCH_PROJECTIONS = {"type_lower": TYPE_SEARCH_PROJECTION, "name_lower": PET_SEARCH_PROJECTION}
+
+
+def name_index(collection, field, projection):
+    # the store's NameTrie over field, built on first use; None when the
+    # store has too many names to keep one
+    store = current_store()
+    with store["name_index_lock"]:
+        if field in store["name_index"]:
+            return store["name_index"][field]
+        generation = store["generation"]
+
+    def build():
+        docs = list(collection.find({}, projection).limit(FUZZY_INDEX_MAX_NAMES + 1))
+        if len(docs) > FUZZY_INDEX_MAX_NAMES:
+            return None
+        trie = search.NameTrie()
+        for doc in docs:
+            trie.add(doc[field], doc)
+        return trie
+
+    # a build may miss a write made while it read, so it is shared and kept
+    # only within the generation it started in; writes after that are applied
+    # to the kept trie by index_names
+    trie, _ = singleflight.do(("name-index", store["db"].name, field, generation), build)
+    with store["name_index_lock"]:
+        if store["generation"] == generation:
+            store["name_index"].setdefault(field, trie)
+    return trie
+
+
+def index_names(field, added=(), removed=()):
+    """Apply a write's added and removed docs to the store's NameTrie over field.
+
+    Called after invalidate_responses, so a trie still being built is either
+    kept before this runs or not kept at all.
+    """
+    fields = [k for k, v in SEARCH_PROJECTIONS[field].items() if v]
+    store = current_store()
+    with store["name_index_lock"]:
+        indexes = store["name_index"]
+        if field not in indexes:
+            return
+        if indexes[field] is None:
+            # a removal may bring the store back under the cap
+            if removed:
+                del indexes[field]
+            return
+        trie = indexes[field]
+        for doc in removed:
+            trie.remove(doc[field], {k: doc[k] for k in fields})
+        for doc in added:
+            trie.add(doc[field], {k: doc[k] for k in fields})
+        if trie.size > FUZZY_INDEX_MAX_NAMES:
+            indexes[field] = None
+
+
+def pet_search_doc(pet_type_id, name):
+    return {"pet_type_id": pet_type_id, "name": name, "name_lower": name.lower()}
+
+
+def search_names(collection, field, q, fuzzy, limit, projection):
+    candidates = list(collection.find({field: search.prefix_regex(q)}, projection).sort(field, 1).limit(limit))
+    typos = search.max_typos(q)
+    if fuzzy and typos and len(candidates) < limit:
+        index = name_index(collection, field, projection)
+        if index is not None:
+            with current_store()["name_index_lock"]:
+                near = index.near(q, typos, FUZZY_CANDIDATE_LIMIT)
+        else:
+            near = collection.find({field: search.prefix_regex(q[0])}, projection).limit(FUZZY_SCAN_LIMIT)
+        seen = {doc_key(doc) for doc in candidates}
+        candidates += [doc for doc in near if doc_key(doc) not in seen]
+    return search.rank(q, candidates, lambda doc: doc[field], fuzzy, limit)
+
+
+def doc_key(doc):
+    return tuple(sorted(doc.items()))
+
+
+@app.route('/search', methods=['GET'])
+def search_store():
+    q = (request.args.get("q") or "").strip().lower()
+    if not q:
+        return jsonify({"error": "Malformed data"}), 400
+
+    try:
+        limit = int(request.args.get("limit", 10))
+    except ValueError:
+        return jsonify({"error": "Malformed data"}), 400
+    limit = max(1, min(limit, SEARCH_MAX_LIMIT))
+    fuzzy = request.args.get("fuzzy", "false").lower() in ("1", "true", "yes")
+
+    types = search_names(pet_types_collection, "type_lower", q, fuzzy, limit, TYPE_SEARCH_PROJECTION)
+    pets = search_names(pets_collection, "name_lower", q, fuzzy, limit, PET_SEARCH_PROJECTION)
+
+    return jsonify({
+        "pet-types": [{"id": t["id"], "type": t["type"]} for t in types],
+        "pets": [{"pet-type-id": p["pet_type_id"], "name": p["name"]} for p in pets]
+    }), 200
+
+
+# -- health endpoints --
+# startup migrates every store and warms the known type ids (see common/health.py)
+
+readiness = health.install(app)
+
+
+def warm_store(store):
+    ids = [t["id"] for t in store["db"]['pet_types'].find({}, {"_id": 0, "id": 1})]
+    store["known_type_ids"].update(ids)
+
+
+def initialize():
+    # retried until Mongo answers; per-store work is idempotent
+    while not (readiness["migrated"] and readiness["warm"]):
+        try:
+            for store in [get_store()] + [get_store(store_id) for store_id in STORE_IDS]:
+                ensure_store_migrated(store)
+                if not store["migrated"]:
+                    raise RuntimeError(f"migrations pending for {store['db'].name}")
+            readiness["migrated"] = True
+            warm_store(get_store())
+            readiness["warm"] = True
+        except Exception as e:
+            print("Startup not finished, retrying:", e)
+            time.sleep(1)
+
+
+def start_background_init():
+    health.start(mongo_client, readiness, initialize)
+    image_gc.start(mongo_client, store_database_names(), STORE_DB_PREFIX)
+
+
+# -- metrics endpoint --
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return jsonify({
+        "coalescing": singleflight.stats(),
+        "admission": admission.stats(),
+        "images": image_gc.stats()
+    }), 200
+
+
 # -- pictures endpoint --
 
 @app.route('/pictures/<path:file_name>', methods=['GET'])
 def get_picture(file_name):
     path = os.path.join("images", file_name)
+    pet = pets_collection.find_one({"picture": file_name}, {"_id": 0, "_picture_url": 1, "picture_mimetype": 1})
     if not os.path.exists(path):
-        return jsonify({"error": "Not found"}), 404
+        # evicted by the disk quota - fetch it again from its picture-url
+        if not pet or not pet.get("_picture_url") or not download_image(pet["_picture_url"], file_name)[0]:
+            return jsonify({"error": "Not found"}), 404
+    if pet:
+        image_gc.touch(pets_collection, file_name)
 
-    ext = os.path.splitext(file_name)[1].lower()
-    if ext == '.png':
-        mtype = 'image/png'
-    elif ext in ['.jpg', '.jpeg']:
-        mtype = 'image/jpeg'
-    else:
-        mtype = 'image/jpeg'
+    # the type sniffed at download; pictures stored before that are sniffed now
+    mtype = pet.get("picture_mimetype") if pet else None
+    if mtype is None:
+        with open(path, 'rb') as f:
+            detected = sniff_image(f.read(16))
+        mtype = detected[0] if detected else 'application/octet-stream'
 
-    return send_file(path, mimetype=mtype), 200
+    # send_file resolves relative paths against the package, images/ is under the cwd
+    return send_file(os.path.abspath(path), mimetype=mtype), 200
 
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5001))
     print(f"Running pets server on port {port}")
-    app.run(host='0.0.0.0', port=port, debug=True)
+    start_background_init()
+    app.run(host='0.0.0.0', port=port, debug=DEBUG, use_reloader=False)
@@ -0,0 +1,164 @@
+"""Name matching and ranking for the /search endpoint.
+
+Prefix candidates come straight from Mongo (anchored regexes on the lowercase
+name fields use their indexes). Typo-tolerant candidates come from a NameTrie
+of all names, walked with a bounded edit distance so only the few branches
+within reach are visited; every candidate is then scored with match_rank.
+"""
+import re
+
+
+def prefix_regex(prefix):
+    # anchored and case-sensitive, which is what lets Mongo walk the index
+    return {"$regex": f"^{re.escape(prefix)}"}
+
+
+def max_typos(query):
+    if len(query) <= 3:
+        return 0
+    if len(query) <= 7:
+        return 1
+    return 2
+
+
+def edit_distance(a, b, limit):
+    """Edit distance counting a swap of adjacent letters as one typo.
+
+    Gives up with limit + 1 as soon as the result can only exceed limit.
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev2 = None
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            d = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb))
+            if i > 1 and j > 1 and ca == b[j - 2] and a[i - 2] == cb:
+                d = min(d, prev2[j - 2] + 1)
+            cur.append(d)
+        if min(cur) > limit:
+            return limit + 1
+        prev2, prev = prev, cur
+    return prev[-1]
+
+
+def match_rank(query, name, fuzzy):
+    """Rank of name for query (lower is better), or None when it does not match.
+
+    Exact matches come first, then prefix matches in name order (the order the
+    index returns them in), then fuzzy matches by distance.
+    """
+    if name == query:
+        return (0, 0, name)
+    if name.startswith(query):
+        return (1, 0, name)
+    if fuzzy:
+        limit = max_typos(query)
+        # compare against the name cut to the query length too, so a typo in
+        # a prefix still ranks the longer name
+        dist = min(edit_distance(query, name, limit), edit_distance(query, name[:len(query)], limit))
+        if dist <= limit:
+            return (2, dist, name)
+    return None
+
+
+class NameTrie:
+    """Lowercase names -> docs, searchable by edit distance.
+
+    Adding a doc that is already there, or removing one that is not, does
+    nothing, so a write may be applied to a trie that already reflects it.
+    """
+
+    def __init__(self):
+        self.root = {}
+        self.size = 0
+
+    def add(self, name, doc):
+        node = self.root
+        for ch in name:
+            node = node.setdefault(ch, {})
+        # the None key holds the docs of names ending at this node
+        docs = node.setdefault(None, [])
+        if doc not in docs:
+            docs.append(doc)
+            self.size += 1
+
+    def remove(self, name, doc):
+        path = [self.root]
+        for ch in name:
+            node = path[-1].get(ch)
+            if node is None:
+                return
+            path.append(node)
+        docs = path[-1].get(None, [])
+        if doc not in docs:
+            return
+        docs.remove(doc)
+        self.size -= 1
+        if not docs:
+            del path[-1][None]
+        # drop the nodes left without names below them
+        for i in range(len(name), 0, -1):
+            if path[i]:
+                break
+            del path[i - 1][name[i - 1]]
+
+    def near(self, query, limit, cap):
+        """Docs of names with a prefix within limit edits of query, at most cap.
+
+        Like the rest of fuzzy search the first letter has to match. The
+        result is a superset of the names match_rank accepts for query: it
+        compares query to the whole name and to its first len(query)
+        letters, both prefixes of the name. Rows are only computed in the
+        band of cells that can stay within limit.
+        """
+        first = self.root.get(query[:1])
+        if first is None:
+            return []
+        out = []
+        n = len(query)
+        big = limit + 1
+        # rows for the empty prefix and for the first letter
+        top = list(range(n + 1))
+        row = [1]
+        for j in range(1, n + 1):
+            row.append(min(top[j - 1] + (query[j - 1] != query[0]), top[j] + 1, row[j - 1] + 1))
+        # (node, its letter, letter above it, its row, the row above)
+        stack = [(child, ch, query[0], row, top) for ch, child in first.items() if ch is not None]
+        if row[-1] <= limit:
+            self._collect(first, out, cap)
+            return out
+        while stack and len(out) < cap:
+            node, ch, prev_ch, row, prev_row = stack.pop()
+            i = row[0] + 1  # depth of node
+            cur = [i] + [big] * n
+            for j in range(max(1, i - limit), min(n, i + limit) + 1):
+                cq = query[j - 1]
+                d = min(row[j] + 1, cur[j - 1] + 1, row[j - 1] + (cq != ch))
+                if j > 1 and ch == query[j - 2] and prev_ch == cq:
+                    d = min(d, prev_row[j - 2] + 1)
+                cur[j] = min(d, big)
+            if cur[-1] <= limit:
+                self._collect(node, out, cap)
+            elif min(cur) <= limit:
+                stack.extend((c, k, ch, cur, row) for k, c in node.items() if k is not None)
+        return out
+
+    @staticmethod
+    def _collect(node, out, cap):
+        stack = [node]
+        while stack and len(out) < cap:
+            n = stack.pop()
+            out.extend(n.get(None, ())[:cap - len(out)])
+            stack.extend(c for k, c in n.items() if k is not None)
+
+
+def rank(query, candidates, key, fuzzy, limit):
+    scored = []
+    for c in candidates:
+        r = match_rank(query, key(c), fuzzy)
+        if r is not None:
+            scored.append((r, c))
+    scored.sort(key=lambda item: item[0])
+    return [c for _, c in scored[:limit]]
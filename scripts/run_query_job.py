@@ -42,8 +42,8 @@ def wait_for_service(url, timeout_s=60):
 
 
 def seed_data() -> None:
-    wait_for_service(f"{base_url(1)}/pet-types")
-    wait_for_service(f"{base_url(2)}/pet-types")
+    wait_for_service(f"{base_url(1)}/readyz")
+    wait_for_service(f"{base_url(2)}/readyz")
 
     # create pet types (same as in pytest steps 1-2)
     r1 = requests.post(f"{base_url(1)}/pet-types", json=PET_TYPE1, timeout=10)
@@ -73,8 +73,8 @@ def wait_for_service(url, timeout_s=60):
 
 def test_assn4_flow():
     # make sure both stores are up
-    wait_for_service(f"{base_url(1)}/pet-types")
-    wait_for_service(f"{base_url(2)}/pet-types")
+    wait_for_service(f"{base_url(1)}/readyz")
+    wait_for_service(f"{base_url(2)}/readyz")
 
     # create pet types in both stores
     r1 = requests.post(f"{base_url(1)}/pet-types", json=PET_TYPE1, timeout=10)
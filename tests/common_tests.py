@@ -0,0 +1,313 @@
+import gzip
+import threading
+import time
+
+import pytest
+from flask import Flask, jsonify
+
+from common import admission, compression, singleflight
+
+
+def admitted_app():
+    app = Flask(__name__)
+    admission.install(app, {}, exempt={"healthz"})
+
+    @app.route("/things")
+    def things():
+        return jsonify([]), 200
+
+    @app.route("/healthz")
+    def healthz():
+        return jsonify({"status": "ok"}), 200
+
+    return app
+
+
+def get(client, addr, headers=None):
+    return client.get("/things", environ_base={"REMOTE_ADDR": addr}, headers=headers).status_code
+
+
+def test_rate_limit_is_keyed_by_address(monkeypatch):
+    monkeypatch.setattr(admission, "RATE_LIMIT_PER_SECOND", 0.001)
+    monkeypatch.setattr(admission, "RATE_LIMIT_BURST", 2)
+    monkeypatch.setattr(admission, "_buckets", admission.OrderedDict())
+    client = admitted_app().test_client()
+
+    assert [get(client, "10.0.0.1") for _ in range(2)] == [200, 200]
+    # a fresh client id in every request does not buy new tokens
+    r = client.get("/things", environ_base={"REMOTE_ADDR": "10.0.0.1"}, headers={"X-Client-Id": "rotated"})
+    assert r.status_code == 429 and r.headers["Retry-After"]
+    assert get(client, "10.0.0.2") == 200
+    assert client.get("/healthz", environ_base={"REMOTE_ADDR": "10.0.0.1"}).status_code == 200
+
+
+def test_full_bucket_table_evicts_least_recently_used(monkeypatch):
+    monkeypatch.setattr(admission, "RATE_LIMIT_PER_SECOND", 0.001)
+    monkeypatch.setattr(admission, "RATE_LIMIT_BURST", 1)
+    monkeypatch.setattr(admission, "MAX_BUCKETS", 2)
+    monkeypatch.setattr(admission, "_buckets", admission.OrderedDict())
+    client = admitted_app().test_client()
+
+    assert get(client, "10.0.0.1") == 200
+    assert get(client, "10.0.0.2") == 200
+    assert get(client, "10.0.0.1") == 429  # 10.0.0.1 is now the most recent
+    assert get(client, "10.0.0.3") == 200  # evicts 10.0.0.2 only
+    assert get(client, "10.0.0.1") == 429
+    assert list(admission._buckets) == ["10.0.0.3", "10.0.0.1"]
+
+
+def test_service_token_skips_the_rate_limit(monkeypatch):
+    monkeypatch.setattr(admission, "RATE_LIMIT_PER_SECOND", 0.001)
+    monkeypatch.setattr(admission, "RATE_LIMIT_BURST", 1)
+    monkeypatch.setattr(admission, "SERVICE_TOKEN", "secret")
+    monkeypatch.setattr(admission, "_buckets", admission.OrderedDict())
+    client = admitted_app().test_client()
+
+    assert get(client, "10.0.0.9") == 200
+    assert get(client, "10.0.0.9") == 429
+    assert get(client, "10.0.0.9", {"X-Service-Token": "guess"}) == 429
+    assert [get(client, "10.0.0.9", {"X-Service-Token": "secret"}) for _ in range(5)] == [200] * 5
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def run_together(n, key, fn):
+    # n threads call singleflight.do(key, fn); returns their (result, shared) or exceptions
+    out = [None] * n
+
+    def call(i):
+        try:
+            out[i] = singleflight.do(key, fn)
+        except Exception as e:
+            out[i] = e
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    return threads, out
+
+
+def test_concurrent_calls_share_one_execution():
+    before = singleflight.stats()
+    release = threading.Event()
+    executions = []
+
+    def fn():
+        executions.append(1)
+        release.wait(5)
+        return "value"
+
+    threads, out = run_together(8, "shared-key", fn)
+    # everyone but the leader is parked on the leader's call
+    wait_for(lambda: singleflight.stats()["coalesced"] - before["coalesced"] == 7)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert executions == [1]
+    assert sorted(shared for _, shared in out) == [False] + [True] * 7
+    assert all(result == "value" for result, _ in out)
+    after = singleflight.stats()
+    assert after["executions"] - before["executions"] == 1
+    assert after["in_flight"] == 0
+
+    # nothing is cached once the call returned
+    assert singleflight.do("shared-key", lambda: "again") == ("again", False)
+
+
+def test_followers_get_the_leaders_exception():
+    before = singleflight.stats()
+    release = threading.Event()
+
+    def fn():
+        release.wait(5)
+        raise ValueError("lookup failed")
+
+    threads, out = run_together(4, "failing-key", fn)
+    wait_for(lambda: singleflight.stats()["coalesced"] - before["coalesced"] == 3)
+    release.set()
+    for t in threads:
+        t.join()
+    assert all(isinstance(e, ValueError) for e in out)
+    with pytest.raises(KeyError):
+        singleflight.do("failing-key", lambda: {}["missing"])
+
+
+def compressed_app(cache, builds):
+    app = Flask(__name__)
+    compression.install(app)
+
+    def build():
+        builds.append(1)
+        return [{"name": f"pet {n}"} for n in range(100)]
+
+    @app.route("/big")
+    def big():
+        return jsonify(build()), 200
+
+    @app.route("/small")
+    def small():
+        return jsonify({"ok": True}), 200
+
+    @app.route("/missing")
+    def missing():
+        return jsonify({"error": "Not found " * 200}), 404
+
+    @app.route("/cached")
+    def cached():
+        return compression.cached_json_response(app, cache["entries"], "listing", build)
+
+    return app
+
+
+def test_compression_is_negotiated_and_sized(monkeypatch):
+    monkeypatch.setattr(compression, "COMPRESSORS", {"gzip": compression.COMPRESSORS["gzip"]})
+    client = compressed_app({"entries": {}}, []).test_client()
+    plain = client.get("/big").get_data()
+    assert len(plain) >= compression.COMPRESS_MIN_BYTES
+
+    r = client.get("/big", headers={"Accept-Encoding": "gzip, deflate"})
+    assert r.headers["Content-Encoding"] == "gzip" and "Accept-Encoding" in r.vary
+    assert gzip.decompress(r.get_data()) == plain
+
+    for accepted in (None, "identity", "gzip;q=0", "deflate"):
+        r = client.get("/big", headers={"Accept-Encoding": accepted} if accepted else {})
+        assert "Content-Encoding" not in r.headers and r.get_data() == plain
+        assert "Accept-Encoding" in r.vary
+
+    # small bodies and errors go out as they are
+    r = client.get("/small", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in r.headers and "Accept-Encoding" in r.vary
+    r = client.get("/missing", headers={"Accept-Encoding": "gzip"})
+    assert r.status_code == 404 and "Content-Encoding" not in r.headers
+
+
+def test_cached_responses_are_built_once_until_replaced(monkeypatch):
+    monkeypatch.setattr(compression, "COMPRESSORS", {"gzip": compression.COMPRESSORS["gzip"]})
+    cache = {"entries": {}}
+    builds = []
+    client = compressed_app(cache, builds).test_client()
+
+    plain = client.get("/cached")
+    zipped = client.get("/cached", headers={"Accept-Encoding": "gzip"})
+    again = client.get("/cached", headers={"Accept-Encoding": "gzip"})
+    assert builds == [1]
+    assert "Accept-Encoding" in plain.vary and "Content-Encoding" not in plain.headers
+    assert zipped.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(zipped.get_data()) == plain.get_data()
+    assert again.get_data() == zipped.get_data()
+    assert list(cache["entries"]["listing"]["encoded"]) == ["gzip"]
+
+    # a write replaces the cache dict, and the next read builds again
+    cache["entries"] = {}
+    client.get("/cached")
+    assert builds == [1, 1]
+
+
+def gated_app(gate, entered):
+    # /slow blocks until gate is set; every handler records its entry
+    app = Flask(__name__)
+    admission.install(app, {"buy": "purchase", "load": "import"})
+
+    @app.route("/slow")
+    def slow():
+        entered.append("slow")
+        gate.wait(5)
+        return jsonify([]), 200
+
+    @app.route("/buy", methods=["POST"])
+    def buy():
+        entered.append("buy")
+        return jsonify({}), 201
+
+    @app.route("/load", methods=["POST"])
+    def load():
+        entered.append("load")
+        return jsonify({}), 201
+
+    @app.route("/read")
+    def read():
+        entered.append("read")
+        return jsonify([]), 200
+
+    return app
+
+
+def send(app, method, path, out):
+    out.append(app.test_client().open(path, method=method))
+
+
+def in_background(app, method, path, out):
+    t = threading.Thread(target=send, args=(app, method, path, out))
+    t.start()
+    return t
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setattr(admission, "RATE_LIMIT_PER_SECOND", 0)
+    monkeypatch.setattr(admission, "ROUTE_LIMITS", {})
+    monkeypatch.setattr(admission, "ADMISSION_QUEUE_SECONDS", 5)
+    return monkeypatch
+
+
+def test_requests_over_the_cap_wait_then_are_shed(limits):
+    limits.setattr(admission, "MAX_CONCURRENCY", 1)
+    limits.setattr(admission, "ADMISSION_QUEUE_SECONDS", 0.2)
+    gate, entered, out = threading.Event(), [], []
+    app = gated_app(gate, entered)
+    holder = in_background(app, "GET", "/slow", out)
+    wait_for(lambda: entered == ["slow"])
+
+    r = app.test_client().get("/read")
+    assert r.status_code == 503 and r.headers["Retry-After"] == "1"
+    assert entered == ["slow"]
+    gate.set()
+    holder.join()
+    assert app.test_client().get("/read").status_code == 200
+    assert admission.stats()["in_flight"] == 0
+
+
+def test_a_freed_slot_goes_to_the_highest_waiting_class(limits):
+    limits.setattr(admission, "MAX_CONCURRENCY", 1)
+    gate, entered, out = threading.Event(), [], []
+    app = gated_app(gate, entered)
+    threads = [in_background(app, "GET", "/slow", out)]
+    wait_for(lambda: entered == ["slow"])
+    threads.append(in_background(app, "POST", "/load", out))
+    wait_for(lambda: admission.stats()["waiting"] == {"import": 1})
+    threads.append(in_background(app, "POST", "/buy", out))
+    wait_for(lambda: admission.stats()["waiting"] == {"import": 1, "purchase": 1})
+
+    gate.set()
+    for t in threads:
+        t.join()
+    # the import queued first, but the purchase outranks it
+    assert entered == ["slow", "buy", "load"]
+    assert sorted(r.status_code for r in out) == [200, 201, 201]
+
+
+def test_requests_held_by_their_route_cap_do_not_hold_back_other_classes(limits):
+    limits.setattr(admission, "MAX_CONCURRENCY", 64)
+    limits.setattr(admission, "ROUTE_LIMITS", {"slow": 1})
+    gate, entered, out = threading.Event(), [], []
+    app = gated_app(gate, entered)
+    threads = [in_background(app, "GET", "/slow", out)]
+    wait_for(lambda: entered == ["slow"])
+    threads += [in_background(app, "GET", "/slow", out) for _ in range(2)]
+    wait_for(lambda: admission.stats()["waiting"] == {"read": 2})
+
+    # reads queued on /slow's own cap leave the purchase and import classes free
+    started = time.monotonic()
+    assert app.test_client().post("/buy").status_code == 201
+    assert app.test_client().post("/load").status_code == 201
+    assert time.monotonic() - started < 1
+    gate.set()
+    for t in threads:
+        t.join()
+    assert [r.status_code for r in out] == [200] * 3
@@ -0,0 +1,12 @@
+import os
+import sys
+
+# the services are packages at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# services imported by the in-process tests run on the memory engine, with
+# pet_order's stores served by pet_store under /stores/<id> (see StoreSession)
+# from the registered STORE_IDS
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+os.environ.setdefault("STORE_IDS", "a,b,1,2,search,pictures")
+os.environ.setdefault("PET_STORES", "1=http://memory/stores/1,2=http://memory/stores/2")
@@ -0,0 +1,201 @@
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from common import storage
+from pet_store import image_gc, pet_store
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 100
+JPEG = b"\xff\xd8\xff\xe0" + b"\x00" * 100
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, body, content_length=True):
+        self.send_response(200)
+        if content_length:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/cat.png":
+            self.send_body(PNG)
+        elif self.path == "/mislabeled.png":
+            self.send_body(JPEG)
+        elif self.path == "/page.html":
+            self.send_body(b"<html>not a picture</html>")
+        elif self.path == "/big":
+            self.send_body(PNG + b"\x00" * 5000, content_length=False)
+        elif self.path == "/drip":
+            self.send_response(200)
+            self.send_header("Content-Length", "40")
+            self.end_headers()
+            self.wfile.write(PNG[:8])
+            for _ in range(32):
+                time.sleep(0.1)
+                self.wfile.write(b"\x00")
+                self.wfile.flush()
+        else:
+            self.send_error(404)
+
+
+@pytest.fixture
+def image_server(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ImageHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+def test_download_sniffs_the_type_from_content(image_server):
+    fname, mtype = pet_store.download_image(f"{image_server}/cat.png")
+    assert mtype == "image/png" and fname.endswith(".png")
+    assert open(os.path.join("images", fname), "rb").read() == PNG
+
+    # the extension comes from the bytes, not from the url
+    fname, mtype = pet_store.download_image(f"{image_server}/mislabeled.png")
+    assert mtype == "image/jpeg" and fname.endswith(".jpg")
+
+    assert pet_store.download_image(f"{image_server}/page.html") == (None, None)
+    assert pet_store.download_image(f"{image_server}/missing.png") == (None, None)
+
+
+def test_download_enforces_the_size_cap(image_server, monkeypatch):
+    monkeypatch.setattr(pet_store, "MAX_IMAGE_BYTES", 1000)
+    assert pet_store.download_image(f"{image_server}/big") == (None, None)
+    assert pet_store.download_image(f"{image_server}/cat.png")[1] == "image/png"
+    # nothing half written is left behind
+    assert all(not name.endswith(".part") for name in os.listdir("images"))
+
+
+def test_download_deadline_cuts_off_a_dripping_server(image_server, monkeypatch):
+    # every byte arrives well within the read timeout, the whole body does not
+    monkeypatch.setattr(pet_store, "IMAGE_DOWNLOAD_SECONDS", 0.5)
+    start = time.monotonic()
+    assert pet_store.download_image(f"{image_server}/drip") == (None, None)
+    assert time.monotonic() - start < 1.5
+    assert os.listdir("images") == []
+
+
+def test_pictures_are_served_with_the_stored_type(image_server):
+    client = pet_store.app.test_client()
+    r = client.post("/stores/pictures/pet-types", json={"type": "bulldog"})
+    type_id = r.get_json()["id"]
+    r = client.post(f"/stores/pictures/pet-types/{type_id}/pets",
+                    json={"name": "Lazy", "picture-url": f"{image_server}/mislabeled.png"})
+    assert r.status_code == 201
+    picture = r.get_json()["picture"]
+
+    r = client.get(f"/stores/pictures/pictures/{picture}")
+    assert r.status_code == 200 and r.mimetype == "image/jpeg"
+    assert r.get_data() == JPEG
+    # the access is kept on the pet for sweepers in other processes
+    pet = pet_store.get_store("pictures")["db"]["pets"].find_one({"picture": picture})
+    assert pet["picture_accessed_at"] is not None
+
+
+def write_image(name, size=100, age=0):
+    path = os.path.join("images", name)
+    with open(path, "wb") as f:
+        f.write(b"\x00" * size)
+    t = time.time() - age
+    os.utime(path, (t, t))
+
+
+def test_sweep_deletes_only_old_unreferenced_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(image_gc, "IMAGE_GC_DELETES_PER_SECOND", 0)
+    monkeypatch.setattr(image_gc, "IMAGE_GC_GRACE_SECONDS", 60)
+    monkeypatch.setattr(image_gc, "IMAGE_GC_DATABASES", ["elsewhere"])
+    client = storage.MemoryClient()
+    # the served db, a registered store db, another process's db and a prefixed one
+    client["main"]["pets"].insert_one({"name": "a", "picture": "a.png"})
+    client["shop1"]["pets"].insert_one({"name": "b", "picture": "b.png"})
+    client["elsewhere"]["pets"].insert_one({"name": "e", "picture": "e.png"})
+    client["shop2"]["pets"].insert_one({"name": "f", "picture": "f.png"})
+    client["unrelated"]["pets"].insert_one({"name": "c", "picture": "c.png"})
+    os.makedirs("images")
+    for name in ("a.png", "b.png", "c.png", "e.png", "f.png"):
+        write_image(name, age=3600)
+    write_image("fresh.png")
+
+    assert image_gc.sweep(client, ["main", "shop1"], "shop") == 100
+    assert sorted(os.listdir("images")) == ["a.png", "b.png", "e.png", "f.png", "fresh.png"]
+
+
+def test_quota_evicts_least_recently_served_refetchable_pictures(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(image_gc, "IMAGE_GC_DELETES_PER_SECOND", 0)
+    monkeypatch.setattr(image_gc, "IMAGE_QUOTA_BYTES", 250)
+    client = storage.MemoryClient()
+    pets = client["main"]["pets"]
+    for name in ("x", "y", "z"):
+        pets.insert_one({"name": name, "picture": f"{name}.png", "_picture_url": f"http://pics/{name}.png"})
+    # no picture-url: it could not be fetched again, so it is never evicted
+    pets.insert_one({"name": "w", "picture": "w.png"})
+    os.makedirs("images")
+    for name in ("w.png", "x.png", "y.png", "z.png"):
+        write_image(name, age=7200)
+
+    now = datetime.utcnow()
+    # another process served y an hour ago and x just now; z was never served
+    image_gc.touch(pets, "y.png", now - timedelta(hours=1))
+    image_gc.touch(pets, "x.png", now)
+    # within the resolution a second access is not written
+    image_gc.touch(pets, "x.png", now + timedelta(seconds=1))
+    assert pets.find_one({"name": "x"})["picture_accessed_at"] == now
+
+    assert image_gc.sweep(client, ["main"], "shop") == 200
+    assert sorted(os.listdir("images")) == ["w.png", "x.png"]
+
+
+def test_update_downloads_only_for_an_existing_pet_with_a_new_url(image_server, monkeypatch):
+    client = pet_store.app.test_client()
+    type_id = client.post("/stores/pictures/pet-types", json={"type": "golden retriever"}).get_json()["id"]
+    r = client.post(f"/stores/pictures/pet-types/{type_id}/pets",
+                    json={"name": "Rex", "picture-url": f"{image_server}/cat.png"})
+    old = r.get_json()["picture"]
+
+    downloads = []
+    download_image = pet_store.download_image
+    monkeypatch.setattr(pet_store, "download_image", lambda url: downloads.append(url) or download_image(url))
+
+    r = client.put(f"/stores/pictures/pet-types/{type_id}/pets/ghost",
+                   json={"name": "Ghost", "picture-url": f"{image_server}/mislabeled.png"})
+    assert r.status_code == 404 and downloads == []
+
+    # the same url keeps the stored picture
+    r = client.put(f"/stores/pictures/pet-types/{type_id}/pets/rex",
+                   json={"name": "Rex", "picture-url": f"{image_server}/cat.png"})
+    assert r.get_json()["picture"] == old and downloads == []
+
+    r = client.put(f"/stores/pictures/pet-types/{type_id}/pets/rex",
+                   json={"name": "Max", "picture-url": f"{image_server}/mislabeled.png"})
+    assert r.status_code == 200 and len(downloads) == 1
+    new = r.get_json()["picture"]
+    assert new.endswith(".jpg") and os.listdir("images") == [new]
+    r = client.get(f"/stores/pictures/pictures/{new}")
+    assert r.mimetype == "image/jpeg"
+
+    # another writer replaces the picture during the download: the name is kept, the download is not
+    def racing_download(url):
+        pet_store.pets_collection.update_one({"name_lower": "bolt"}, {"$set": {"picture": "other.png"}})
+        return download_image(url)
+
+    monkeypatch.setattr(pet_store, "download_image", racing_download)
+    r = client.put(f"/stores/pictures/pet-types/{type_id}/pets/max",
+                   json={"name": "Bolt", "birthdate": "01-02-2020", "picture-url": f"{image_server}/cat.png"})
+    assert r.status_code == 409
+    pet = client.get(f"/stores/pictures/pet-types/{type_id}/pets/bolt").get_json()
+    assert pet["birthdate"] == "01-02-2020" and pet["picture"] == "other.png"
+    assert client.get(f"/stores/pictures/pet-types/{type_id}").get_json()["pets"] == ["Bolt"]
+    assert os.listdir("images") == [new]
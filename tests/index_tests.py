@@ -0,0 +1,66 @@
+import os
+from datetime import datetime
+
+from pymongo import MongoClient
+
+from pet_order import migrations as order_migrations
+from pet_store import migrations as store_migrations
+
+STORES_MONGO_URI = os.environ.get("STORES_MONGO_URI", "mongodb://localhost:27017/")
+ORDERS_MONGO_URI = os.environ.get("ORDERS_MONGO_URI", "mongodb://localhost:27018/")
+
+
+def winning_stages(plan):
+    # flatten the winning plan into the list of stage names
+    stages = [plan.get("stage")]
+    if "inputStage" in plan:
+        stages += winning_stages(plan["inputStage"])
+    for child in plan.get("inputStages", []):
+        stages += winning_stages(child)
+    return stages
+
+
+def assert_uses_index(collection, query):
+    explain = collection.find(query).explain()
+    plan = explain["queryPlanner"]["winningPlan"]
+    stages = winning_stages(plan.get("queryPlan", plan))
+    assert "COLLSCAN" not in stages, f"{collection.name} {query} does a collection scan: {stages}"
+    assert "IXSCAN" in stages or "IDHACK" in stages or "EXPRESS_IXSCAN" in stages, stages
+
+
+def test_store_indexes():
+    db = MongoClient(STORES_MONGO_URI)["pet_store_index_test"]
+
+    first = store_migrations.run(db)
+    assert len(first["migrations_applied"]) == len(store_migrations.MIGRATIONS)
+
+    # second run must be a no-op
+    second = store_migrations.run(db)
+    assert second == {"migrations_applied": [], "indexes_created": []}
+
+    assert_uses_index(db["pet_types"], {"id": "1"})
+    assert_uses_index(db["pet_types"], {"type_lower": "bulldog"})
+    assert_uses_index(db["pet_types"], {"attributes_lower": {"$all": ["loyal", "friendly"]}})
+    assert_uses_index(db["pets"], {"pet_type_id": "1", "name_lower": "lander"})
+    assert_uses_index(db["pets"], {"pet_type_id": "1"})
+    assert_uses_index(db["changes"], {"seq": {"$gt": 10}})
+
+    db.client.drop_database(db.name)
+
+
+def test_order_indexes():
+    db = MongoClient(ORDERS_MONGO_URI)["pet_orders_index_test"]
+
+    order_migrations.run(db)
+    second = order_migrations.run(db)
+    assert second == {"migrations_applied": [], "indexes_created": []}
+
+    assert_uses_index(db["transactions"], {"purchase-id": "1"})
+    assert_uses_index(db["transactions"], {"store": 1})
+    assert_uses_index(db["transactions"], {"purchaser": "Ann"})
+    assert_uses_index(db["transactions"], {"pet_type_lower": "bulldog"})
+    assert_uses_index(db["transactions"], {"purchased_at": {"$lt": datetime(2000, 1, 1)}})
+    assert_uses_index(db["transaction_rollups"], {"dimension": "store"})
+    assert_uses_index(db["purchase_outbox"], {"status": "pending"})
+
+    db.client.drop_database(db.name)
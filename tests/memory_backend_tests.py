@@ -0,0 +1,715 @@
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from common import singleflight, storage
+from pet_order import ledger, pet_order, store_client
+from pet_order import migrations as order_migrations
+from pet_store import pet_store
+
+
+class StoreResponse:
+    def __init__(self, resp):
+        self.status_code = resp.status_code
+        self.headers = resp.headers
+        self._body = resp.get_json(silent=True)
+
+    def json(self):
+        return self._body
+
+
+class StoreSession:
+    # routes pet_order's store calls to the in-process pet_store app
+    def __init__(self, client):
+        self.client = client
+
+    def request(self, method, url, json=None, headers=None, timeout=None):
+        path = url[len("http://memory"):]
+        return StoreResponse(self.client.open(path, method=method, json=json, headers=headers))
+
+
+store_client._session = StoreSession(pet_store.app.test_client())
+
+
+def create_type(client, store, type_name):
+    r = client.post(f"/stores/{store}/pet-types", json={"type": type_name})
+    assert r.status_code == 201, r.get_json()
+    return r.get_json()["id"]
+
+
+def test_store_flow():
+    client = pet_store.app.test_client()
+
+    id_1 = create_type(client, "a", "Golden Retriever")
+    id_2 = create_type(client, "a", "Australian Shepherd")
+    assert client.post("/stores/a/pet-types", json={"type": "golden retriever"}).status_code == 400
+
+    r = client.get(f"/stores/a/pet-types/{id_2}")
+    assert r.status_code == 200
+    assert r.get_json()["attributes"] == ["Loyal", "outgoing", "and", "friendly"]
+    assert r.get_json()["lifespan"] == 15
+
+    # another store starts empty and numbers its own ids; reading it creates nothing
+    assert client.get("/stores/b/pet-types").get_json() == []
+    assert "pet_storeb" not in pet_store.mongo_client.list_database_names()
+    # an id that is not registered is not served at all
+    assert client.get("/stores/nope/pet-types").status_code == 404
+    assert client.post("/stores/nope/pet-types", json={"type": "Abyssinian"}).status_code == 404
+    assert client.get("/pet-types", headers={"X-Store-Id": "nope"}).status_code == 404
+    assert create_type(client, "b", "Abyssinian") == id_1
+
+    for name in ("Lander", "Lanky"):
+        r = client.post(f"/stores/a/pet-types/{id_1}/pets", json={"name": name, "birthdate": "14-05-2020"})
+        assert r.status_code == 201, r.get_json()
+    assert client.post(f"/stores/a/pet-types/{id_1}/pets", json={"name": "lander"}).status_code == 400
+
+    # listings are cached until the next write to the store
+    listing = client.get("/stores/a/pet-types").get_json()
+    assert pet_store.get_store("a")["response_cache"]
+    assert client.post(f"/stores/a/pet-types/{id_1}/pets", json={"name": "Lola"}).status_code == 201
+    assert pet_store.get_store("a")["response_cache"] == {}
+    assert client.get("/stores/a/pet-types").get_json() != listing
+    assert client.delete(f"/stores/a/pet-types/{id_1}/pets/lola").status_code == 204
+
+    r = client.get("/stores/a/pet-types", query_string={"hasAttribute": "loyal"})
+    assert [t["id"] for t in r.get_json()] == [id_2]
+    r = client.get("/stores/a/pet-types", query_string={"family": "canidae"})
+    assert sorted(t["id"] for t in r.get_json()) == sorted([id_1, id_2])
+
+    # facets count attributes over the types hasAttribute matches; attributeMatch=any ORs the filters
+    id_3 = create_type(client, "a", "Abyssinian")
+    every = {"loyal": 1, "outgoing": 1, "friendly": 1, "intelligent": 1, "curious": 1}
+    assert client.get("/stores/a/pet-types/attributes").get_json() == every
+    r = client.get("/stores/a/pet-types/attributes", query_string={"hasAttribute": "Curious"})
+    assert r.get_json() == {"intelligent": 1, "curious": 1}
+    both = {"hasAttribute": ["loyal", "curious"]}
+    assert client.get("/stores/a/pet-types", query_string=both).get_json() == []
+    assert client.get("/stores/a/pet-types/attributes", query_string=both).get_json() == {}
+    r = client.get("/stores/a/pet-types", query_string=dict(both, attributeMatch="any"))
+    assert sorted(t["id"] for t in r.get_json()) == sorted([id_2, id_3])
+    r = client.get("/stores/a/pet-types/attributes", query_string=dict(both, attributeMatch="ANY"))
+    assert r.get_json() == every
+    # a stopword is never indexed: it fails an all-match and is ignored by an any-match
+    with_stopword = {"hasAttribute": ["loyal", "and"]}
+    assert client.get("/stores/a/pet-types", query_string=with_stopword).get_json() == []
+    r = client.get("/stores/a/pet-types", query_string=dict(with_stopword, attributeMatch="any"))
+    assert [t["id"] for t in r.get_json()] == [id_2]
+    assert client.delete(f"/stores/a/pet-types/{id_3}").status_code == 204
+
+    r = client.put(f"/stores/a/pet-types/{id_1}/pets/lanky", json={"name": "Lucky", "birthdate": "01-01-2021"})
+    assert r.status_code == 200, r.get_json()
+    r = client.get(f"/stores/a/pet-types/{id_1}")
+    assert sorted(r.get_json()["pets"]) == ["Lander", "Lucky"]
+
+    assert client.delete(f"/stores/a/pet-types/{id_1}").status_code == 400
+    assert client.delete(f"/stores/a/pet-types/{id_1}/pets/lander").status_code == 204
+    assert client.delete(f"/stores/a/pet-types/{id_1}/pets/lucky").status_code == 204
+    assert client.delete(f"/stores/a/pet-types/{id_1}").status_code == 204
+    assert client.get(f"/stores/a/pet-types/{id_1}").status_code == 404
+
+    r = client.get("/stores/a/changes", query_string={"since": 0})
+    assert r.status_code == 200
+    ops = [(c["kind"], c["op"]) for c in r.get_json()["changes"]]
+    assert ops[0] == ("pet-type", "create") and ops[-1] == ("pet-type", "delete")
+
+
+def test_health_probes_read_the_readiness_flags(monkeypatch):
+    for service in (pet_store, pet_order):
+        client = service.app.test_client()
+        for flag in service.readiness:
+            monkeypatch.setitem(service.readiness, flag, True)
+        # probes skip store selection and admission
+        assert client.get("/healthz", headers={"X-Store-Id": "nope"}).get_json() == {"status": "ok"}
+        r = client.get("/readyz", headers={"X-Store-Id": "nope"})
+        assert r.status_code == 200 and r.get_json() == {"mongo": True, "migrated": True, "warm": True}
+
+        monkeypatch.setitem(service.readiness, "mongo", False)
+        r = client.get("/readyz")
+        assert r.status_code == 503 and r.get_json()["mongo"] is False
+        assert client.get("/healthz").status_code == 200
+
+
+def test_concurrent_adds_of_one_type_run_once(monkeypatch):
+    before = singleflight.stats()
+    release = threading.Event()
+    created = []
+    create_pet_type = pet_store.create_pet_type
+
+    def slow_create(requested_type):
+        created.append(requested_type)
+        release.wait(5)
+        return create_pet_type(requested_type)
+
+    monkeypatch.setattr(pet_store, "create_pet_type", slow_create)
+    statuses = []
+
+    def post():
+        client = pet_store.app.test_client()
+        statuses.append(client.post("/stores/b/pet-types", json={"type": "Golden Retriever"}).status_code)
+
+    threads = [threading.Thread(target=post) for _ in range(5)]
+    for t in threads:
+        t.start()
+    deadline = time.monotonic() + 5
+    while singleflight.stats()["coalesced"] - before["coalesced"] < 4:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert len(created) == 1
+    # the followers are answered like a later duplicate would be
+    assert sorted(statuses) == [201, 400, 400, 400, 400]
+
+
+class SlowListing:
+    # pet_types_collection whose first find reads, then waits for release
+    def __init__(self, collection):
+        self.collection = collection
+        self.release = threading.Event()
+        self.waiting = threading.Event()
+
+    def find(self, *args, **kwargs):
+        found = list(self.collection.find(*args, **kwargs))
+        if not self.waiting.is_set():
+            self.waiting.set()
+            self.release.wait(5)
+        return found
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+
+def test_listing_after_a_write_does_not_reuse_an_older_query(monkeypatch):
+    client = pet_store.app.test_client()
+    id_1 = create_type(client, "b", "bulldog")
+    slow = SlowListing(pet_store.pet_types_collection)
+    monkeypatch.setattr(pet_store, "pet_types_collection", slow)
+
+    # a listing is in flight when a pet is added
+    early = threading.Thread(target=lambda: pet_store.app.test_client().get("/stores/b/pet-types"))
+    early.start()
+    assert slow.waiting.wait(5)
+    assert client.post(f"/stores/b/pet-types/{id_1}/pets", json={"name": "Spike"}).status_code == 201
+
+    def pets():
+        listing = client.get("/stores/b/pet-types").get_json()
+        return next(t["pets"] for t in listing if t["id"] == id_1)
+
+    assert pets() == ["Spike"]
+    slow.release.set()
+    early.join()
+    assert pets() == ["Spike"]
+
+
+def test_purchase_flow():
+    store = pet_store.app.test_client()
+    order = pet_order.app.test_client()
+    pet_order.initialize()
+
+    id_1 = create_type(store, "1", "bulldog")
+    for name in ("Lazy", "Lemon"):
+        assert store.post(f"/stores/1/pet-types/{id_1}/pets", json={"name": name}).status_code == 201
+
+    r = order.post("/purchases", json={"purchaser": "ann", "pet-type": "Bulldog", "store": 1, "pet-name": "lazy"})
+    assert r.status_code == 201, r.get_json()
+    assert r.get_json()["pet-name"].lower() == "lazy"
+    assert store.get(f"/stores/1/pet-types/{id_1}/pets/lazy").status_code == 404
+
+    r = order.post("/purchases", json={"purchaser": "bob", "pet-type": "bulldog"})
+    assert r.status_code == 201, r.get_json()
+    assert r.get_json()["pet-name"].lower() == "lemon"
+    assert order.post("/purchases", json={"purchaser": "bob", "pet-type": "bulldog"}).status_code == 400
+
+    r = order.get("/transactions", headers={"OwnerPC": pet_order.OWNER_PASSWORD})
+    assert r.status_code == 200
+    assert sorted(t["purchaser"] for t in r.get_json()) == ["ann", "bob"]
+    assert len({t["purchase-id"] for t in r.get_json()}) == 2
+
+
+def test_lookup_miss_reads_the_change_feed(monkeypatch):
+    store = pet_store.app.test_client()
+    order = pet_order.app.test_client()
+    pet_order.initialize()
+    assert pet_order.refresh_store_availability(2)
+
+    full_reads = []
+    fetch_pet_types = pet_order.fetch_pet_types
+    monkeypatch.setattr(pet_order, "fetch_pet_types", lambda url: full_reads.append(url) or fetch_pet_types(url))
+
+    # a pet added after the last read is found through the feed alone
+    id_1 = create_type(store, "2", "Golden Retriever")
+    assert store.post(f"/stores/2/pet-types/{id_1}/pets", json={"name": "Snowball"}).status_code == 201
+    r = order.post("/purchases", json={"purchaser": "ann", "pet-type": "golden retriever", "store": 2})
+    assert r.status_code == 201, r.get_json()
+    assert full_reads == []
+
+    # a store whose feed cannot be followed is re-read once, not on every miss
+    pet_order.availability_cursors.pop(2, None)
+    monkeypatch.setitem(pet_order.availability_refreshed_at, 2, 0)
+    for _ in range(3):
+        assert order.post("/purchases", json={"purchaser": "ann", "pet-type": "golden retriever", "store": 2}).status_code == 400
+    assert len(full_reads) == 1
+
+
+def test_concurrent_refreshes_keep_the_cursor_with_its_listing(monkeypatch):
+    store = pet_store.app.test_client()
+    pet_order.initialize()
+    store.post("/stores/2/pet-types", json={"type": "golden retriever"})
+    [golden] = store.get("/stores/2/pet-types", query_string={"type": "golden retriever"}).get_json()
+
+    # the first re-read has its listing in hand, but not yet stored, when a pet is added
+    listed, release = threading.Event(), threading.Event()
+    fetch_pet_types = pet_order.fetch_pet_types
+
+    def slow_fetch(url):
+        pet_types = fetch_pet_types(url)
+        if not listed.is_set():
+            listed.set()
+            release.wait(5)
+        return pet_types
+
+    monkeypatch.setattr(pet_order, "fetch_pet_types", slow_fetch)
+    before = singleflight.stats()
+    first = threading.Thread(target=pet_order.refresh_store_availability, args=(2,))
+    first.start()
+    assert listed.wait(5)
+    r = store.post(f"/stores/2/pet-types/{golden['id']}/pets", json={"name": "Comet"})
+    assert r.status_code == 201
+    second = threading.Thread(target=pet_order.refresh_store_availability, args=(2,))
+    second.start()
+    deadline = time.monotonic() + 5
+    while singleflight.stats()["coalesced"] == before["coalesced"]:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    release.set()
+    first.join()
+    second.join()
+
+    # the cursor stored is the one taken before that listing, so the feed brings Comet in
+    assert pet_order.sync_store_availability(2)
+    assert "comet" in pet_order.availability[2]["golden retriever"]["pets"]
+
+
+def test_search_ranks_exact_prefix_then_fuzzy(monkeypatch):
+    client = pet_store.app.test_client()
+    id_1 = create_type(client, "search", "bulldog")
+    for name in ("Lemon", "Lemonade", "Lemno", "Melon", "Sally", "Sam", "Sandy", "Szzzy"):
+        assert client.post(f"/stores/search/pet-types/{id_1}/pets", json={"name": name}).status_code == 201
+
+    def names(**args):
+        r = client.get("/stores/search/search", query_string=args)
+        assert r.status_code == 200
+        return [p["name"] for p in r.get_json()["pets"]]
+
+    assert names(q="lemon") == ["Lemon", "Lemonade"]
+    # a swapped pair is one typo; a typo in the first letter is not found
+    assert names(q="lemon", fuzzy="true") == ["Lemon", "Lemonade", "Lemno"]
+    assert names(q="lemon", fuzzy="true", limit=1) == ["Lemon"]
+    assert names(q="bulldgo", fuzzy="true") == []
+    r = client.get("/stores/search/search", query_string={"q": "bulldgo", "fuzzy": "true"})
+    assert r.get_json()["pet-types"] == [{"id": id_1, "type": "bulldog"}]
+
+    # a new pet is found by fuzzy search right away
+    assert client.post(f"/stores/search/pet-types/{id_1}/pets", json={"name": "Lemonz"}).status_code == 201
+    assert names(q="lemon", fuzzy="true") == ["Lemon", "Lemonade", "Lemonz", "Lemno"]
+
+    # too many names for the index: the capped scan still keeps prefix hits
+    monkeypatch.setitem(pet_store.get_store("search"), "name_index", {})
+    monkeypatch.setattr(pet_store, "FUZZY_INDEX_MAX_NAMES", 2)
+    monkeypatch.setattr(pet_store, "FUZZY_SCAN_LIMIT", 3)
+    assert names(q="szzzy", fuzzy="true") == ["Szzzy"]
+
+
+def pending_entry(entry_id, store, pet_type_id, pet_name):
+    return {
+        "_id": entry_id, "status": "pending", "purchaser": "ann", "pet-type": "Golden Retriever",
+        "store": store, "pet-type-id": pet_type_id, "pet-name": pet_name, "purchase-id": None,
+        "created_at": datetime.utcnow() - timedelta(hours=1)
+    }
+
+
+def test_writes_update_the_name_index_in_place():
+    client = pet_store.app.test_client()
+    store = pet_store.get_store("search")
+    store["name_index"] = {}
+    create_type(client, "search", "Golden Retriever")
+    [bulldog] = client.get("/stores/search/pet-types", query_string={"type": "bulldog"}).get_json()
+
+    def found(q):
+        r = client.get("/stores/search/search", query_string={"q": q, "fuzzy": "true"})
+        body = r.get_json()
+        return [t["type"] for t in body["pet-types"]] + [p["name"] for p in body["pets"]]
+
+    assert client.post(f"/stores/search/pet-types/{bulldog['id']}/pets", json={"name": "Marigold"}).status_code == 201
+    assert found("marigodl") == ["Marigold"]
+    tries = dict(store["name_index"])
+    assert set(tries) == {"type_lower", "name_lower"}
+
+    # renames, deletes and new types reach the same tries, nothing is rebuilt
+    r = client.put(f"/stores/search/pet-types/{bulldog['id']}/pets/marigold", json={"name": "Rosemary"})
+    assert r.status_code == 200, r.get_json()
+    assert found("marigodl") == [] and found("rosemayr") == ["Rosemary"]
+    assert client.delete(f"/stores/search/pet-types/{bulldog['id']}/pets/rosemary").status_code == 204
+    assert found("rosemayr") == []
+    assert found("abysinian") == []
+    create_type(client, "search", "Abyssinian")
+    assert found("abysinian") == ["Abyssinian"]
+    assert store["name_index"] == tries
+    assert all(store["name_index"][f] is tries[f] for f in tries)
+
+
+def test_reconciler_finalizes_only_its_own_claims():
+    store = pet_store.app.test_client()
+    pet_order.initialize()
+
+    id_1 = create_type(store, "1", "Golden Retriever")
+    for name in ("Rex", "Max"):
+        assert store.post(f"/stores/1/pet-types/{id_1}/pets", json={"name": name}).status_code == 201
+
+    # the delete for "lost" never reached the store, then someone else took Rex
+    pet_order.outbox_collection.insert_one(pending_entry("lost", 1, id_1, "Rex"))
+    assert store.delete(f"/stores/1/pet-types/{id_1}/pets/rex").status_code == 204
+    # the delete for "landed" removed Max but its answer never came back
+    pet_order.outbox_collection.insert_one(pending_entry("landed", 1, id_1, "Max"))
+    assert store.delete(f"/stores/1/pet-types/{id_1}/pets/max?claim=landed").status_code == 204
+    # a retried claim answers the same, another pet under the same claim does not
+    assert store.delete(f"/stores/1/pet-types/{id_1}/pets/max?claim=landed").status_code == 204
+    assert store.delete(f"/stores/1/pet-types/{id_1}/pets/rex?claim=landed").status_code == 409
+
+    pet_order.reconcile_pending_purchases()
+    assert pet_order.outbox_collection.find_one({"_id": "lost"})["status"] == "aborted"
+    landed = pet_order.outbox_collection.find_one({"_id": "landed"})
+    assert landed["status"] == "committed" and landed["purchase-id"]
+
+
+def test_purchases_wait_for_migrations(monkeypatch):
+    order = pet_order.app.test_client()
+    monkeypatch.setitem(pet_order.readiness, "migrated", False)
+    r = order.post("/purchases", json={"purchaser": "ann", "pet-type": "bulldog"})
+    assert r.status_code == 503 and r.headers["Retry-After"]
+    assert order.post("/purchases:batch", json={"purchases": []}).status_code == 503
+
+
+def test_idempotency_keys_are_scoped_by_purchaser():
+    store = pet_store.app.test_client()
+    order = pet_order.app.test_client()
+    pet_order.initialize()
+
+    id_1 = create_type(store, "1", "Australian Shepherd")
+    assert store.post(f"/stores/1/pet-types/{id_1}/pets", json={"name": "Felicity"}).status_code == 201
+
+    purchase = {"pet-type": "Australian Shepherd", "store": 1}
+    r = order.post("/purchases", json=dict(purchase, purchaser="ann"), headers={"Idempotency-Key": "k1"})
+    assert r.status_code == 201
+    replay = order.post("/purchases", json=dict(purchase, purchaser="ann"), headers={"Idempotency-Key": "k1"})
+    assert replay.get_json() == r.get_json()
+    # the same key from another purchaser is a new purchase, and none is left
+    r = order.post("/purchases", json=dict(purchase, purchaser="eve"), headers={"Idempotency-Key": "k1"})
+    assert r.status_code == 400
+
+
+def test_batch_items_succeed_and_fail_on_their_own(monkeypatch):
+    store = pet_store.app.test_client()
+    order = pet_order.app.test_client()
+    pet_order.initialize()
+
+    id_1 = create_type(store, "2", "Australian Shepherd")
+    for name in ("Bolt", "Dash", "Flash", "Comet"):
+        assert store.post(f"/stores/2/pet-types/{id_1}/pets", json={"name": name}).status_code == 201
+    assert pet_order.refresh_store_availability(2)
+    # Flash is sold behind the index's back, so claiming it finds nothing
+    monkeypatch.setattr(pet_order, "sync_store_availability", lambda store_num, max_age=None: True)
+    assert store.delete(f"/stores/2/pet-types/{id_1}/pets/flash").status_code == 204
+
+    def item(purchaser, name):
+        return {"purchaser": purchaser, "pet-type": "Australian Shepherd", "store": 2, "pet-name": name}
+
+    r = order.post("/purchases:batch", json={"purchases": [
+        item("p1", "bolt"), item("p2", "BOLT"), item("p3", "flash"), {"purchaser": "p4"}, item("p5", "dash")
+    ]})
+    assert r.status_code == 200
+    results = r.get_json()["results"]
+    assert [item["status"] for item in results] == [201, 400, 400, 400, 201]
+    assert results[0]["purchase"]["pet-name"] == "Bolt"
+    assert results[4]["purchase"]["pet-name"] == "Dash"
+
+    # the ledger write fails after the claim: the item is pending, the others keep their answers
+    def broken(db, purchase_ids):
+        raise RuntimeError("ledger down")
+
+    monkeypatch.setattr(ledger, "record", broken)
+    batch = {"purchases": [item("p6", "comet"), {"purchaser": "p7"}]}
+    key = {"Idempotency-Key": "batch-1"}
+    r = order.post("/purchases:batch", json=batch, headers=key)
+    assert [item["status"] for item in r.get_json()["results"]] == [503, 400]
+    assert store.get(f"/stores/2/pet-types/{id_1}/pets/comet").status_code == 404
+    monkeypatch.undo()
+
+    # the reconciler finishes it and a retry of the batch replays it
+    monkeypatch.setattr(pet_order, "RECONCILE_GRACE_SECONDS", -1)
+    pet_order.reconcile_pending_purchases()
+    results = order.post("/purchases:batch", json=batch, headers=key).get_json()["results"]
+    assert [item["status"] for item in results] == [201, 400]
+    assert results[0]["purchase"]["pet-name"] == "Comet"
+    again = order.post("/purchases:batch", json=batch, headers=key).get_json()["results"]
+    assert again == results
+
+
+class FlakySession:
+    # answers with the queued outcomes: an int status or an exception
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+        self.release = None
+
+    def request(self, method, url, json=None, headers=None, timeout=None):
+        self.calls += 1
+        if self.release is not None:
+            self.release.wait(5)
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return StoreResponse(pet_order.app.response_class(status=outcome))
+
+
+def test_breaker_opens_and_lets_a_single_probe_through(monkeypatch):
+    url = "http://breaker-test"
+    session = FlakySession(ConnectionError(), 503, ConnectionError(), ConnectionError(), 200)
+    monkeypatch.setattr(store_client, "_session", session)
+    monkeypatch.setattr(store_client, "BREAKER_FAILURE_THRESHOLD", 3)
+    monkeypatch.setattr(store_client, "BREAKER_OPEN_SECONDS", 60)
+
+    with pytest.raises(ConnectionError):
+        store_client.get(url, "/pet-types")
+    assert store_client.get(url, "/pet-types").status_code == 503
+    assert store_client.stats()[url]["state"] == store_client.CLOSED
+    with pytest.raises(ConnectionError):
+        store_client.get(url, "/pet-types")
+    assert store_client.stats()[url]["state"] == store_client.OPEN
+    assert not store_client.is_available(url)
+    with pytest.raises(store_client.StoreUnavailable):
+        store_client.get(url, "/pet-types")
+    assert session.calls == 3
+
+    # once the open period is over one probe goes out; a failed probe reopens
+    monkeypatch.setattr(store_client, "BREAKER_OPEN_SECONDS", 0)
+    with pytest.raises(ConnectionError):
+        store_client.get(url, "/pet-types")
+    assert store_client.stats()[url]["state"] == store_client.OPEN
+
+    # while a probe is in flight every other call is refused
+    session.release = threading.Event()
+    probe = threading.Thread(target=store_client.get, args=(url, "/pet-types"))
+    probe.start()
+    while session.calls < 5:
+        time.sleep(0.01)
+    assert store_client.stats()[url]["state"] == store_client.HALF_OPEN
+    assert not store_client.is_available(url)
+    with pytest.raises(store_client.StoreUnavailable):
+        store_client.delete(url, "/pet-types/1/pets/rex")
+    session.release.set()
+    probe.join()
+    assert store_client.stats()[url] == {"state": store_client.CLOSED, "failures": 0, "hedged": 0, "hedges_skipped": 0}
+    assert session.calls == 5
+
+
+def test_hedge_delay_is_kept_per_path_class(monkeypatch):
+    url = "http://hedge-test"
+    monkeypatch.setattr(store_client, "_session", FlakySession(*[200] * 30))
+    monkeypatch.setattr(store_client, "HEDGE_MIN_SAMPLES", 20)
+    for n in range(25):
+        store_client.get(url, f"/changes?since={n}")
+    store_client.delete(url, "/pet-types/1/pets/rex")
+
+    assert store_client._hedge_delay(url, "changes") is not None
+    # a listing is not hedged on the strength of the poll's latencies
+    assert store_client._hedge_delay(url, "pet-types") is None
+    assert store_client.path_class("/pet-types/3/pets?x=1") == "pet-types"
+
+
+class SlowSession:
+    # answers 200 after the delay queued for each call, noting the thread it ran on
+    def __init__(self, *delays):
+        self.delays = list(delays)
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def request(self, method, url, json=None, headers=None, timeout=None):
+        with self.lock:
+            delay = self.delays.pop(0)
+            self.threads.append(threading.current_thread().name)
+        time.sleep(delay)
+        return StoreResponse(pet_order.app.response_class(status=200))
+
+
+def test_primaries_stay_off_the_hedge_pool_and_a_busy_pool_skips_hedges(monkeypatch):
+    url = "http://hedge-pool-test"
+    session = SlowSession(0, 0.5, 0, 0.3)
+    monkeypatch.setattr(store_client, "_session", session)
+    monkeypatch.setattr(store_client, "HEDGE_ENABLED", True)
+    monkeypatch.setattr(store_client, "HEDGE_MIN_SAMPLES", 1)
+    store_client.get(url, "/pet-types")
+
+    # a slow primary is overtaken by its hedge
+    started = time.monotonic()
+    assert store_client.get(url, "/pet-types").status_code == 200
+    assert time.monotonic() - started < 0.4
+    assert session.threads[1] == "store-get" and session.threads[2].startswith("store-hedge")
+    assert store_client.stats()[url]["hedged"] == 1
+
+    # with every hedge slot taken the caller just waits for its primary
+    slots = threading.BoundedSemaphore(1)
+    slots.acquire()
+    monkeypatch.setattr(store_client, "_hedge_slots", slots)
+    started = time.monotonic()
+    assert store_client.get(url, "/pet-types").status_code == 200
+    assert time.monotonic() - started >= 0.3
+    assert len(session.threads) == 4 and session.delays == []
+    assert store_client.stats()[url]["hedges_skipped"] == 1
+
+
+def test_batch_item_moves_on_from_a_pet_already_gone(monkeypatch):
+    store = pet_store.app.test_client()
+    order = pet_order.app.test_client()
+    pet_order.initialize()
+
+    # store 1 may already list bulldogs (test_purchase_flow sells them all)
+    store.post("/stores/1/pet-types", json={"type": "bulldog"})
+    [bulldog] = store.get("/stores/1/pet-types", query_string={"type": "bulldog"}).get_json()
+    id_1 = bulldog["id"]
+    for name in ("Ace", "Buddy"):
+        assert store.post(f"/stores/1/pet-types/{id_1}/pets", json={"name": name}).status_code == 201
+    assert pet_order.refresh_store_availability(1)
+    monkeypatch.setattr(pet_order, "sync_store_availability", lambda store_num, max_age=None: True)
+    assert store.delete(f"/stores/1/pet-types/{id_1}/pets/ace").status_code == 204
+    # the index still offers Ace, and is made to offer it first
+    monkeypatch.setattr(pet_order.random, "choice", lambda candidates: min(candidates, key=lambda c: c[2]))
+
+    r = order.post("/purchases:batch", json={"purchases": [{"purchaser": "ann", "pet-type": "bulldog", "store": 1}]})
+    [result] = r.get_json()["results"]
+    assert result["status"] == 201 and result["purchase"]["pet-name"] == "Buddy"
+    entry = pet_order.outbox_collection.find_one({"purchase-id": result["purchase"]["purchase-id"]})
+    assert entry["pet-name"] == "Buddy" and entry["status"] == "committed"
+
+
+def test_finished_outbox_entries_expire_after_the_replay_window():
+    db = storage.MemoryClient()["pet_orders"]
+    order_migrations.run(db)
+    info = db["purchase_outbox"].index_information()["updated_at_ttl"]
+    assert info["expireAfterSeconds"] == order_migrations.OUTBOX_RETENTION_SECONDS
+
+    old = datetime.utcnow() - timedelta(seconds=order_migrations.OUTBOX_RETENTION_SECONDS + 60)
+    db["purchase_outbox"].insert_many([
+        {"_id": "done", "status": "committed", "created_at": old, "updated_at": old},
+        {"_id": "recent", "status": "aborted", "created_at": old, "updated_at": datetime.utcnow()},
+        {"_id": "stuck", "status": "pending", "created_at": old},
+    ])
+    assert sorted(e["_id"] for e in db["purchase_outbox"].find({})) == ["recent", "stuck"]
+
+
+def test_unique_index_rejects_duplicates():
+    coll = storage.MemoryClient()["db"]["things"]
+    coll.create_index([("key", 1)], name="key_unique", unique=True)
+    coll.insert_one({"key": "a", "tags": ["x"]})
+    try:
+        coll.insert_one({"key": "a"})
+    except storage.DuplicateKeyError:
+        pass
+    else:
+        raise AssertionError("duplicate key was accepted")
+    try:
+        coll.insert_many([{"key": "a"}, {"key": "c"}], ordered=False)
+    except storage.BulkWriteError as e:
+        assert [err["index"] for err in e.details["writeErrors"]] == [0]
+    else:
+        raise AssertionError("duplicate key was accepted")
+    assert coll.find_one({"key": "c"}) is not None
+    coll.update_one({"key": "b"}, {"$setOnInsert": {"n": 0}, "$inc": {"hits": 1}}, upsert=True)
+    assert coll.find_one({"key": "b"}, {"_id": 0}) == {"key": "b", "n": 0, "hits": 1}
+    assert coll.find_one({"tags": "x"}, {"_id": 0, "key": 1}) == {"key": "a"}
+
+    coll.bulk_write([storage.UpdateOne({"key": "b"}, {"$inc": {"hits": 2}})])
+    assert coll.find_one({"key": "b"})["hits"] == 3
+
+
+class FailingUnsets:
+    # a database whose transactions collection fails every $unset
+    def __init__(self, db):
+        self.db = db
+
+    def __getitem__(self, name):
+        coll = self.db[name]
+        if name != "transactions":
+            return coll
+
+        class Collection:
+            def __getattr__(self, attr):
+                return getattr(coll, attr)
+
+            def update_many(self, filter, update):
+                if "$unset" in update:
+                    raise RuntimeError("connection reset")
+                return coll.update_many(filter, update)
+
+        return Collection()
+
+
+def test_rollups_and_archive(monkeypatch):
+    store = pet_store.app.test_client()
+    order = pet_order.app.test_client()
+    pet_order.initialize()
+    owner = {"OwnerPC": pet_order.OWNER_PASSWORD}
+
+    id_1 = create_type(store, "2", "Abyssinian")
+    for name in ("Muscles", "Junior", "Tiger"):
+        assert store.post(f"/stores/2/pet-types/{id_1}/pets", json={"name": name}).status_code == 201
+    r = order.post("/purchases:batch", json={"purchases": [
+        {"purchaser": "cat-lover", "pet-type": "abyssinian", "store": 2, "pet-name": "muscles"},
+        {"purchaser": "cat-lover", "pet-type": "abyssinian", "store": 2, "pet-name": "junior"},
+    ]})
+    assert [item["status"] for item in r.get_json()["results"]] == [201, 201]
+
+    # the rollup write fails after counting: the item is left to the
+    # reconciler, which must not count it again
+    with monkeypatch.context() as m:
+        m.setattr(pet_order, "db", FailingUnsets(pet_order.db))
+        r = order.post("/purchases:batch", json={"purchases": [
+            {"purchaser": "zed", "pet-type": "abyssinian", "store": 2, "pet-name": "tiger"}]})
+        assert [item["status"] for item in r.get_json()["results"]] == [503]
+    with monkeypatch.context() as m:
+        m.setattr(pet_order, "RECONCILE_GRACE_SECONDS", -1)
+        pet_order.reconcile_pending_purchases()
+    pet_order.invalidate_transactions_cache()
+
+    summary = order.get("/transactions/summary", headers=owner).get_json()
+    assert summary["purchaser"]["cat-lover"] == 2
+    assert summary["purchaser"]["zed"] == 1
+    assert summary["pet-type"]["abyssinian"] == 3
+    assert sum(summary["day"].values()) == sum(summary["store"].values())
+    assert order.get("/transactions/summary", headers=owner, query_string={"dimension": "week"}).status_code == 400
+
+    # every row is counted once, so rebuilding the rollups from the ledger
+    # changes nothing
+    assert order_migrations.build_transaction_rollups(pet_order.db) > 0
+    rebuilt = ledger.summary(pet_order.db)
+    assert rebuilt == summary
+
+    # archival is off unless a retention is configured
+    hot = order.get("/transactions", headers=owner).get_json()
+    assert ledger.archive(pet_order.db, now=datetime.utcnow() + timedelta(days=365)) == 0
+    monkeypatch.setattr(ledger, "TRANSACTION_RETENTION_DAYS", 90)
+    assert ledger.archive(pet_order.db, now=datetime.utcnow() + timedelta(days=365)) == len(hot)
+    pet_order.invalidate_transactions_cache()
+    assert order.get("/transactions", headers=owner).get_json() == []
+
+    r = order.get("/transactions/export", headers=owner, query_string={"purchaser": "cat-lover"})
+    assert r.mimetype == "application/x-ndjson"
+    rows = [json.loads(line) for line in r.get_data(as_text=True).splitlines()]
+    assert [row["purchaser"] for row in rows] == ["cat-lover", "cat-lover"]
+    assert pet_order.outbox_collection.find_one({"purchaser": "zed"})["status"] == "committed"
+    assert order.get("/transactions/summary", headers=owner).get_json() == rebuilt